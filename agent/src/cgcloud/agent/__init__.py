@@ -12,7 +12,6 @@ import time
 
 from cgcloud.lib.context import Context
 from cgcloud.lib.message import Message, UnknownVersion
-from cgcloud.lib.util import UserError
 
 log = logging.getLogger( __name__ )
 
@@ -102,8 +101,9 @@ class Agent( object ):
         keypairs = self.ctx.expand_keypair_globs( self.options.ec2_keypair_names )
         fingerprints = set( keypair.fingerprint for keypair in keypairs )
         if fingerprints != self.fingerprints:
-            ssh_keys = set( self.download_ssh_key( keypair ) for keypair in keypairs )
-            if None in ssh_keys: ssh_keys.remove( None )
+            ssh_keys = set( ssh_key.strip( )
+                                for ssh_key in self.ctx.download_ssh_pubkeys( keypairs )
+                                if ssh_key is not None )
 
             for account in self.options.accounts:
                 pw = pwd.getpwnam( account )
@@ -125,13 +125,6 @@ class Agent( object ):
                         authorized_keys.writelines( ssh_key + '\n' for ssh_key in ssh_keys )
             self.fingerprints = fingerprints
 
-    def download_ssh_key( self, keypair ):
-        try:
-            return self.ctx.download_ssh_pubkey( keypair ).strip( )
-        except UserError:
-            log.warn( 'Exception while downloading SSH public key from S3.', exc_info=True )
-            return None
-
     def start_metric_thread( self ):
         try:
             import psutil
@@ -20,6 +20,8 @@ def roles( ):
 
 def command_classes( ):
     from cgcloud.core.commands import (ListRolesCommand,
+                                       InstanceTypesCommand,
+                                       SpotReportCommand,
                                        CreateCommand,
                                        RecreateCommand,
                                        StartCommand,
@@ -37,6 +39,7 @@ def command_classes( ):
                                        CleanupCommand,
                                        UpdateInstanceProfile,
                                        ResetSecurityCommand,
+                                       ClearIdentityCacheCommand,
                                        ListOptionsCommand)
     from cgcloud.core.cluster_commands import (CreateClusterCommand,
                                                StartClusterCommand,
@@ -1,4 +1,3 @@
-import datetime
 import hashlib
 import socket
 # cluster ssh and rsync commands need thread-safe subprocess
@@ -22,8 +21,8 @@ from bd2k.util.iterables import concat
 from bd2k.util.retry import retry
 from boto import logging
 from boto.ec2.blockdevicemapping import BlockDeviceType, BlockDeviceMapping
+from boto.ec2.image import Image
 from boto.ec2.instance import Instance
-from boto.ec2.spotpricehistory import SpotPriceHistory
 from boto.exception import BotoServerError, EC2ResponseError
 from fabric.api import execute
 from fabric.context_managers import settings
@@ -33,29 +32,41 @@ from paramiko.client import MissingHostKeyPolicy
 
 from cgcloud.core.project import project_artifacts
 from cgcloud.lib import aws_d32
+from cgcloud.fabric.connections import ssh_client, discard as discard_ssh_client
+from cgcloud.fabric.thread_local import isolate_threads
 from cgcloud.lib.context import Context, throttlePredicate
-from cgcloud.lib.ec2 import (ec2_instance_types,
-                             wait_instances_running,
+from cgcloud.lib.ec2 import (wait_instances_running,
                              inconsistencies_detected,
-                             create_spot_instances,
+                             create_diversified_spot_instances,
                              create_ondemand_instances,
-                             tag_object_persistently)
+                             tag_object_persistently,
+                             tag_objects_persistently)
 from cgcloud.lib.ec2 import retry_ec2, a_short_time, a_long_time, wait_transition
+from cgcloud.lib.instance_types import instance_type_catalog
+from cgcloud.lib.metering import aws_meter
+from cgcloud.lib.polling import PollingSchedule
+from cgcloud.lib.port_prober import PortProber
+from cgcloud.lib.spot_history import spot_price_history
+from cgcloud.lib.spot_markets import score_spot_markets, rank_spot_markets
 from cgcloud.lib.util import (UserError,
                               camel_to_snake,
                               ec2_keypair_fingerprint,
                               private_to_public_key,
-                              mean, std_dev)
+                              mean, pmap, partition_seq)
 
 log = logging.getLogger( __name__ )
 
 
 # noinspection PyPep8Naming
 class fabric_task( object ):
-    # A stack to stash the current fabric user before a new one is set via this decorator
-    user_stack = [ ]
-    # A reentrant lock to prevent multiple concurrent uses of fabric, which is not thread-safe
-    lock = threading.RLock( )
+    """
+    A decorator for Box methods that run as a Fabric task on the box's instance. Fabric's
+    settings are made thread-local, see cgcloud.fabric.thread_local, so tasks on different
+    boxes can run concurrently, in different threads.
+    """
+    # Per thread, a stack to stash the current fabric user before a new one is set via this
+    # decorator
+    local = threading.local( )
 
     def __new__( cls, user=None ):
         if callable( user ):
@@ -66,26 +77,53 @@ class fabric_task( object ):
     def __init__( self, user=None ):
         self.user = user
 
+    @property
+    def user_stack( self ):
+        try:
+            return self.local.user_stack
+        except AttributeError:
+            user_stack = self.local.user_stack = [ ]
+            return user_stack
+
     def __call__( self, function ):
+        isolate_threads( )
+
         @wraps( function )
         def wrapper( box, *args, **kwargs ):
-            with self.lock:
-                user = box.admin_account( ) if self.user is None else self.user
-                user_stack = self.user_stack
-                if user_stack and user_stack[ -1 ] == user:
-                    return function( box, *args, **kwargs )
-                else:
-                    user_stack.append( user )
-                    try:
-                        task = partial( function, box, *args, **kwargs )
-                        task.name = function.__name__
-                        # noinspection PyProtectedMember
-                        return box._execute_task( task, user )
-                    finally:
-                        assert user_stack.pop( ) == user
+            user = box.admin_account( ) if self.user is None else self.user
+            user_stack = self.user_stack
+            if user_stack and user_stack[ -1 ] == user:
+                return function( box, *args, **kwargs )
+            else:
+                user_stack.append( user )
+                try:
+                    task = partial( function, box, *args, **kwargs )
+                    task.name = function.__name__
+                    # noinspection PyProtectedMember
+                    return box._execute_task( task, user )
+                finally:
+                    assert user_stack.pop( ) == user
+
+        return wrapper
+
+
+def metered( phase ):
+    """
+    A decorator for Box methods that accounts the AWS requests made by the decorated method to
+    the given phase and to the box the method is invoked on, see cgcloud.lib.metering.
+    """
+
+    def decorator( method ):
+        @wraps( method )
+        def wrapper( box, *args, **kwargs ):
+            # noinspection PyProtectedMember
+            with aws_meter( ).activity( phase, subject=box._meter_subject ):
+                return method( box, *args, **kwargs )
 
         return wrapper
 
+    return decorator
+
 
 class Box( object ):
     """
@@ -275,7 +313,7 @@ class Box( object ):
                 root_bdt.delete_on_termination = True
                 bdm = spec.setdefault( 'block_device_map', BlockDeviceMapping( ) )
                 bdm[ '/dev/sda1' ] = root_bdt
-                for i in range( ec2_instance_types[ spec[ 'instance_type' ] ].disks ):
+                for i in range( instance_type_catalog( )[ spec[ 'instance_type' ] ].disks ):
                     device = '/dev/sd' + chr( ord( 'b' ) + i )
                     bdm[ device ] = BlockDeviceType( ephemeral_name='ephemeral%i' % i )
                 return
@@ -360,7 +398,8 @@ class Box( object ):
             dict( ip_protocol='icmp', from_port=3, to_port=4, cidr_ip='0.0.0.0/0' ) ]
 
     def __get_virtualization_types( self, instance_type, requested_vtype=None ):
-        instance_vtypes = OrderedSet( ec2_instance_types[ instance_type ].virtualization_types )
+        instance_vtypes = instance_type_catalog( )[ instance_type ].virtualization_types
+        instance_vtypes = OrderedSet( instance_vtypes )
         role_vtypes = OrderedSet( self.supported_virtualization_types( ) )
         supported_vtypes = instance_vtypes & role_vtypes
         if supported_vtypes:
@@ -402,9 +441,11 @@ class Box( object ):
 
     # Note: The name of all spot-related keyword arguments should begin with 'spot_'
 
+    @metered( 'prepare' )
     def prepare( self, ec2_keypair_globs,
                  instance_type=None, image_ref=None, virtualization_type=None,
                  spot_bid=None, spot_launch_group=None, spot_auto_zone=False,
+                 spot_instance_types=None, spot_zones=None,
                  vpc_id=None, subnet_id=None,
                  **options ):
         """
@@ -437,6 +478,16 @@ class Box( object ):
         :param bool spot_auto_zone: Use heuristic to automatically choose the "best" availability 
         zone to launch spot instances in. Can't be combined with subnet_id. Overrides the 
         availability zone in the context.
+
+        :param list[str] spot_instance_types: Additional instance types to request spot instances
+        of. If this argument or spot_zones is given, spot requests will be spread across markets,
+        i.e. combinations of instance type and availability zone, in proportion to the recent
+        price of each market and the stability thereof. Can't be combined with
+        spot_launch_group.
+
+        :param list[str] spot_zones: The availability zones to spread spot requests across. If
+        absent, the zone in the context will be used or, if spot_auto_zone is True, all zones in
+        the region. Can't be combined with subnet_id or spot_launch_group.
         
         :param: str vpc_id: The ID of a VPC to create the instance and associated security group 
         in. If this argument is None or absent and the AWS account has a default VPC, the default 
@@ -465,11 +516,29 @@ class Box( object ):
                              'while placing them in an explicitly defined subnet since the subnet '
                              'implies a specific availability zone.' )
 
+        spot_diversified = bool( spot_instance_types or spot_zones )
+
+        if spot_diversified and spot_bid is None:
+            raise UserError( 'Need a spot bid for spreading spot instances across instance types '
+                             'or zones' )
+
+        if spot_diversified and spot_launch_group is not None:
+            raise UserError( 'Cannot spread spot instances across instance types or zones while '
+                             'placing them in a launch group.' )
+
+        if subnet_id is not None and spot_zones:
+            raise UserError( 'Cannot spread spot instances across zones while placing them in an '
+                             'explicitly defined subnet since the subnet implies a specific '
+                             'availability zone.' )
+
         if self.instance_id is not None:
             raise AssertionError( 'Instance already bound or created' )
 
         if instance_type is None:
             instance_type = self.recommended_instance_type( )
+        elif instance_type not in instance_type_catalog( ):
+            raise UserError( "Unknown instance type '%s'. Use the instance-types command to list "
+                             "the known types." % instance_type )
 
         virtualization_types = self.__get_virtualization_types( instance_type, virtualization_type )
         image = self.__get_image( virtualization_types, image_ref )
@@ -479,15 +548,7 @@ class Box( object ):
 
         security_group_ids = self.__setup_security_groups( vpc_id=vpc_id )
         if vpc_id is not None and subnet_id is None:
-            log.info( 'Looking up suitable subnet for VPC %s in zone %s.', vpc_id, zone )
-            subnets = self.ctx.vpc.get_all_subnets( filters={ 'vpc-id': vpc_id,
-                                                              'availability-zone': zone } )
-            if subnets:
-                subnet_id = subnets[ 0 ].id
-            else:
-                raise UserError( 'There is no subnet belonging to VPC %s in availability zone %s. '
-                                 'Please create a subnet manually using the VPC console.'
-                                 % (vpc_id, zone) )
+            subnet_id = self.__find_subnet( vpc_id, zone )
 
         options = dict( image.tags, **options )
         self._set_instance_options( options )
@@ -511,12 +572,75 @@ class Box( object ):
         self._spec_spot_market( spec,
                                 bid=spot_bid,
                                 launch_group=spot_launch_group,
-                                auto_zone=spot_auto_zone )
+                                auto_zone=spot_auto_zone and not spot_diversified )
+        if spot_diversified:
+            if not spot_zones and spot_auto_zone:
+                spot_zones = [ z.name for z in self.ctx.ec2.get_all_zones( ) ]
+            spec.spot_markets = self._spec_spot_markets( spec, image, vpc_id,
+                                                         instance_types=spot_instance_types or [ ],
+                                                         zones=spot_zones or [ zone ] )
         return spec
 
+    def __find_subnet( self, vpc_id, zone ):
+        log.info( 'Looking up suitable subnet for VPC %s in zone %s.', vpc_id, zone )
+        subnets = self.ctx.vpc.get_all_subnets( filters={ 'vpc-id': vpc_id,
+                                                          'availability-zone': zone } )
+        if subnets:
+            return subnets[ 0 ].id
+        else:
+            raise UserError( 'There is no subnet belonging to VPC %s in availability zone %s. '
+                             'Please create a subnet manually using the VPC console.'
+                             % (vpc_id, zone) )
+
+    def _spec_spot_markets( self, spec, image, vpc_id, instance_types, zones ):
+        """
+        Return a list of pairs, one pair for each spot market that instances should be requested
+        in. The first element of each pair is a copy of the given spec, adjusted for the
+        market, the second element is the weight of the market.
+
+        :param list[str] instance_types: candidate instance types in addition to the instance
+        type in the given spec
+
+        :param list[str] zones: the names of the candidate availability zones
+
+        :rtype: list[(Expando,float)]
+        """
+        histories = [ ]
+        for instance_type in OrderedSet( [ spec.instance_type ] + instance_types ):
+            if not instance_type_catalog( )[ instance_type ].spot_availability:
+                raise UserError( 'The instance type %s is not available on the spot market.' %
+                                 instance_type )
+            if image.virtualization_type not in self.__get_virtualization_types( instance_type ):
+                raise UserError( 'The instance type %s does not support virtualization type %s '
+                                 'of image %s.' % (instance_type, image.virtualization_type,
+                                                   image.id) )
+            spot_history = self._get_spot_history( instance_type )
+            if spot_history:
+                self._check_spot_bid( spec.price, spot_history )
+                histories.append( (instance_type, spot_history) )
+            else:
+                log.warn( 'No spot price history for instance type %s, ignoring it.',
+                          instance_type )
+        markets = self._spot_markets( histories, zones, spec.price )
+        if not markets:
+            raise UserError( 'None of the spot markets has a price history.' )
+        specs = [ ]
+        for market, weight in self._weigh_spot_markets( markets, spec.price ):
+            log.info( 'Weight of spot market for %s in %s is %.2f.',
+                      market.instance_type, market.zone, weight )
+            market_spec = Expando( (k, v) for k, v in spec.iteritems( )
+                                   if k not in ('price', 'block_device_map', 'user_data') )
+            market_spec.instance_type = market.instance_type
+            market_spec.placement = market.zone
+            if vpc_id is not None:
+                market_spec.subnet_id = self.__find_subnet( vpc_id, market.zone )
+            self._spec_block_device_mapping( market_spec, image )
+            specs.append( (market_spec, weight) )
+        return specs
+
     def _spec_spot_market( self, spec, bid, launch_group, auto_zone ):
         if bid is not None:
-            if not ec2_instance_types[ spec.instance_type ].spot_availability:
+            if not instance_type_catalog( )[ spec.instance_type ].spot_availability:
                 raise UserError( 'The instance type %s is not available on the spot market.' %
                                  spec.instance_type )
             if auto_zone:
@@ -525,7 +649,81 @@ class Box( object ):
             if launch_group is not None:
                 spec.launch_group = self.ctx.to_aws_name( launch_group )
 
-    ZoneTuple = namedtuple( 'ZoneTuple', [ 'name', 'price_deviation' ] )
+    SpotMarket = namedtuple( 'SpotMarket', [ 'instance_type', 'zone', 'price', 'price_deviation' ] )
+
+    @classmethod
+    def _spot_markets( cls, histories, zones, bid ):
+        """
+        Summarize the spot price history of the given instance types in each of the given zones.
+        Zones without any history are omitted.
+
+        :param list[(str,list[SpotPrice])] histories: pairs of instance type name and the price
+        history of that instance type, most recent data point first
+
+        :param list[str] zones: the names of the zones
+
+        :rtype: list[SpotMarket]
+        """
+        return [ cls.SpotMarket( instance_type=score.instance_type,
+                                 zone=score.zone,
+                                 price=score.price,
+                                 price_deviation=score.volatility )
+                 for score in score_spot_markets( histories, bid, zones ) ]
+
+    @classmethod
+    def _weigh_spot_markets( cls, markets, bid ):
+        """
+        Returns pairs of market and weight for the markets that instances should be requested in.
+        Like in _choose_spot_zone(), markets with a current price under the bid are preferred.
+        Markets over the bid are only used if there are no markets under the bid. The weight of
+        each market is inversely proportional to the sum of its current price and the standard
+        deviation of its price, favoring cheap and stable markets. The weights add up to one.
+
+        :param list[SpotMarket] markets:
+        :param float bid:
+        :rtype: list[(SpotMarket,float)]
+
+        >>> M = Box.SpotMarket
+        >>> markets = [ M( 'm3.large', 'us-west-2a', 0.1, 0.0 ), \
+                        M( 'm3.large', 'us-west-2b', 0.2, 0.1 ), \
+                        M( 'c3.large', 'us-west-2a', 0.5, 0.0 ) ]
+        >>> # noinspection PyProtectedMember
+        >>> [ (m.instance_type, m.zone, round( w, 3 ))
+        ...   for m, w in Box._weigh_spot_markets( markets, 0.3 ) ]
+        [('m3.large', 'us-west-2a', 0.75), ('m3.large', 'us-west-2b', 0.25)]
+        >>> # noinspection PyProtectedMember
+        >>> [ (m.zone, round( w, 3 )) for m, w in Box._weigh_spot_markets( markets[ 1: ], 0.1 ) ]
+        [('us-west-2b', 0.625), ('us-west-2a', 0.375)]
+        """
+        candidates = [ m for m in markets if m.price < bid ] or markets
+        weights = [ 1 / max( m.price + m.price_deviation, 1e-6 ) for m in candidates ]
+        total = sum( weights )
+        return [ (m, w / total) for m, w in zip( candidates, weights ) ]
+
+    @staticmethod
+    def _split_spot_instances( num_instances, weights ):
+        """
+        Split the given number of instances into parts proportional to the given weights,
+        rounding by largest remainder.
+
+        >>> # noinspection PyProtectedMember
+        >>> Box._split_spot_instances( 10, [ 0.75, 0.25 ] )
+        [8, 2]
+        >>> # noinspection PyProtectedMember
+        >>> Box._split_spot_instances( 100, [ 1, 1, 1 ] )
+        [34, 33, 33]
+        >>> # noinspection PyProtectedMember
+        >>> Box._split_spot_instances( 1, [ 0.3, 0.4, 0.3 ] )
+        [0, 1, 0]
+        """
+        total = float( sum( weights ) )
+        quotas = [ num_instances * w / total for w in weights ]
+        counts = [ int( q ) for q in quotas ]
+        remainder = num_instances - sum( counts )
+        by_fraction = sorted( range( len( quotas ) ), key=lambda i: counts[ i ] - quotas[ i ] )
+        for i in by_fraction[ :remainder ]:
+            counts[ i ] += 1
+        return counts
 
     @classmethod
     def _choose_spot_zone( cls, zones, bid, spot_history ):
@@ -538,56 +736,43 @@ class Box( object ):
 
         :param list[boto.ec2.zone.Zone] zones:
         :param float bid:
-        :param list[boto.ec2.spotpricehistory.SpotPriceHistory] spot_history:
+        :param list[SpotPrice] spot_history:
 
         :rtype: str
         :return: the name of the selected zone
 
         >>> from collections import namedtuple
-        >>> FauxHistory = namedtuple( 'FauxHistory', [ 'price', 'availability_zone' ] )
+        >>> from cgcloud.lib.spot_history import SpotPrice
         >>> ZoneTuple = namedtuple( 'ZoneTuple', [ 'name' ] )
 
         >>> zones = [ ZoneTuple( 'us-west-2a' ), ZoneTuple( 'us-west-2b' ) ]
-        >>> spot_history = [ FauxHistory( 0.1, 'us-west-2a' ), \
-                             FauxHistory( 0.2,'us-west-2a'), \
-                             FauxHistory( 0.3,'us-west-2b'), \
-                             FauxHistory( 0.6,'us-west-2b')]
+        >>> spot_history = [ SpotPrice( 4, 'us-west-2a', 0.1 ), \
+                             SpotPrice( 3, 'us-west-2a', 0.2 ), \
+                             SpotPrice( 2, 'us-west-2b', 0.3 ), \
+                             SpotPrice( 1, 'us-west-2b', 0.6 ) ]
         >>> # noinspection PyProtectedMember
         >>> Box._choose_spot_zone( zones, 0.15, spot_history )
         'us-west-2a'
 
-        >>> spot_history=[ FauxHistory( 0.3, 'us-west-2a' ), \
-                           FauxHistory( 0.2, 'us-west-2a' ), \
-                           FauxHistory( 0.1, 'us-west-2b'), \
-                           FauxHistory( 0.6, 'us-west-2b') ]
+        >>> spot_history = [ SpotPrice( 4, 'us-west-2a', 0.3 ), \
+                             SpotPrice( 3, 'us-west-2a', 0.2 ), \
+                             SpotPrice( 2, 'us-west-2b', 0.1 ), \
+                             SpotPrice( 1, 'us-west-2b', 0.6 ) ]
         >>> # noinspection PyProtectedMember
-        >>> Box._choose_spot_zone(zones, 0.15, spot_history)
+        >>> Box._choose_spot_zone( zones, 0.15, spot_history )
         'us-west-2b'
 
-        >>> spot_history={ FauxHistory( 0.1, 'us-west-2a' ), \
-                           FauxHistory( 0.7, 'us-west-2a' ), \
-                           FauxHistory( 0.1, "us-west-2b" ), \
-                           FauxHistory( 0.6, 'us-west-2b' ) }
+        >>> spot_history = [ SpotPrice( 4, 'us-west-2a', 0.1 ), \
+                             SpotPrice( 3, 'us-west-2a', 0.7 ), \
+                             SpotPrice( 2, 'us-west-2b', 0.1 ), \
+                             SpotPrice( 1, 'us-west-2b', 0.6 ) ]
         >>> # noinspection PyProtectedMember
-        >>> Box._choose_spot_zone(zones, 0.15, spot_history)
+        >>> Box._choose_spot_zone( zones, 0.15, spot_history )
         'us-west-2b'
-       """
-
-        # Create two lists of tuples of form: [ (zone.name, std_deviation), ... ] one for zones
-        # over the bid price and one for zones under bid price. Each are sorted by increasing
-        # standard deviation values.
-        #
-        markets_under_bid, markets_over_bid = [ ], [ ]
-        for zone in zones:
-            zone_histories = filter( lambda zone_history:
-                                     zone_history.availability_zone == zone.name, spot_history )
-            price_deviation = std_dev( [ history.price for history in zone_histories ] )
-            recent_price = zone_histories[ 0 ]
-            zone_tuple = cls.ZoneTuple( name=zone.name, price_deviation=price_deviation )
-            (markets_over_bid, markets_under_bid)[ recent_price.price < bid ].append( zone_tuple )
-
-        return min( markets_under_bid or markets_over_bid,
-                    key=attrgetter( 'price_deviation' ) ).name
+        """
+        zones = [ zone.name for zone in zones ]
+        scores = score_spot_markets( [ (None, spot_history) ], bid, zones )
+        return rank_spot_markets( scores, bid, by='volatility' )[ 0 ].zone
 
     def _optimize_spot_bid( self, instance_type, spot_bid ):
         """
@@ -609,7 +794,7 @@ class Box( object ):
 
         :param spot_bid: float
 
-        :type spot_history: list[SpotPriceHistory]
+        :type spot_history: list[SpotPrice]
 
         :raises UserError: if bid is > 2X the spot price's average
 
@@ -633,21 +818,17 @@ class Box( object ):
             log.warn( "Your bid $ %f is more than double this instance type's average "
                       "spot price ($ %f) over the last week", spot_bid, average )
 
-    def _get_spot_history( self, instance_type ):
+    def _get_spot_history( self, instance_type, days=7 ):
         """
-        Returns list of 1,000 most recent spot market data points represented as SpotPriceHistory
-        objects. Note: The most recent object/data point will be first in the list.
+        Returns the spot market data points of the given instance type over the given number of
+        days, most recent data point first. The history is kept in a local store such that only
+        data points that were added since the last invocation need to be requested from EC2.
 
-        :rtype: list[SpotPriceHistory]
+        :rtype: list[SpotPrice]
         """
+        return spot_price_history( self.ctx, instance_type, days )
 
-        one_week_ago = datetime.datetime.now( ) - datetime.timedelta( days=7 )
-        spot_data = self.ctx.ec2.get_spot_price_history( start_time=one_week_ago.isoformat( ),
-                                                         instance_type=instance_type,
-                                                         product_description="Linux/UNIX" )
-        spot_data.sort( key=attrgetter( "timestamp" ), reverse=True )
-        return spot_data
-
+    @metered( 'create' )
     def create( self, spec,
                 num_instances=1,
                 wait_ready=True,
@@ -702,27 +883,40 @@ class Box( object ):
             :type adoptees: Iterator[Instance]
             """
             pending_ids.update( i.id for i in adoptees )
+            adopted = [ ]
             for box, instance in izip( adopters, adoptees ):
-                box.adopt( instance, next( cluster_ordinal ) )
+                box._link( instance, next( cluster_ordinal ) )
+                adopted.append( box )
+            # Tag the entire batch at once rather than one instance at a time
+            self._on_instances_created( adopted )
+            for box in adopted:
                 if not wait_ready:
                     # Without wait_ready, an instance is done as soon as it has been adopted.
-                    pending_ids.remove( instance.id )
+                    pending_ids.remove( box.instance_id )
                 boxes.append( box )
 
         try:
             if 'price' in spec:
                 price = spec.price
                 del spec.price
+                markets = spec.pop( 'spot_markets', None ) or [ (spec, 1.0) ]
+                counts = self._split_spot_instances( num_instances, [ w for _, w in markets ] )
+                markets = [ (s, n) for (s, _), n in zip( markets, counts ) ]
+                if len( markets ) > 1:
+                    for s, n in markets:
+                        log.info( 'Requesting %i spot instance(s) of type %s in %s.',
+                                  n, s.instance_type, s.placement )
                 tags = dict(cluster_name=self.cluster_name) if self.cluster_name else None
                 # Spot requests are fulfilled in batches. A batch could consist of one instance,
                 # all requested instances or a subset thereof. As soon as a batch comes back from
-                # _create_spot_instances(), we will want to adopt every instance in it. Part of
-                # adoption is tagging which is crucial for the boot code running on cluster nodes.
-                for batch in create_spot_instances( self.ctx.ec2, price, self.image_id, spec,
-                                                    num_instances=num_instances,
-                                                    timeout=spot_timeout,
-                                                    tentative=spot_tentative,
-                                                    tags=tags):
+                # create_diversified_spot_instances(), we will want to adopt every instance in it.
+                # Part of adoption is tagging which is crucial for the boot code running on
+                # cluster nodes.
+                for batch in create_diversified_spot_instances( self.ctx.ec2, price,
+                                                                self.image_id, markets,
+                                                                timeout=spot_timeout,
+                                                                tentative=spot_tentative,
+                                                                tags=tags ):
                     adopt( batch )
             else:
                 adopt( create_ondemand_instances( self.ctx.ec2, self.image_id, spec,
@@ -734,8 +928,10 @@ class Box( object ):
             assert boxes[ 0 ] is self
 
             if wait_ready:
-                def wait_ready_callback( box ):
+                def wait_ready_callback( box, failure=None ):
                     try:
+                        if failure is not None:
+                            raise failure
                         # noinspection PyProtectedMember
                         box._wait_ready( { 'pending' }, first_boot=True )
                     except:
@@ -760,7 +956,16 @@ class Box( object ):
         else:
             return boxes
 
+    # The number of seconds between bulk instance status checks while waiting for SSH
+    status_check_interval = 30
+
+    @metered( 'wait_running' )
     def _batch_wait_ready( self, boxes, executor, callback ):
+        """
+        :param callback: the function to pass each box to once it is ready to be waited on
+        individually. Its optional second argument is an exception to raise if the box won't
+        ever be ready.
+        """
         if len( boxes ) == 1:
             # For a single instance, self._wait_ready will wait for the instance to change to
             # running ...
@@ -769,27 +974,67 @@ class Box( object ):
             # .. but for multiple instances it is more efficient to wait for all of the
             # instances together.
             boxes_by_id = { box.instance_id: box for box in boxes }
-            # Wait for instances to enter the running state and as they do, pass them to
-            # the executor where they are waited on concurrently.
+            # Wait for instances to enter the running state and then for their SSH port to
+            # open. As they do, pass them to the executor where they are waited on concurrently.
             num_running, num_other = 0, 0
-            # TODO: timeout
-            instances = (box.instance for box in boxes)
-            for instance in wait_instances_running( self.ctx.ec2, instances ):
-                box = boxes_by_id[ instance.id ]
-                # equivalent to the instance.update() done in _wait_ready()
-                box.instance = instance
-                if instance.state == 'running':
-                    executor( callback, (box,) )
-                    num_running += 1
-                else:
-                    log.info( 'Instance %s in unexpected state %s.',
-                              instance.id, instance.state )
-                    num_other += 1
-            assert num_running + num_other == len( boxes )
-            if not num_running:
-                raise RuntimeError( 'None of the instances entered the running state.' )
-            if num_other:
-                log.warn( '%i instance(s) entered a state other than running.', num_other )
+            with self._ssh_port_prober( lambda box: executor( callback, (box,) ) ) as prober:
+                # TODO: timeout
+                instances = (box.instance for box in boxes)
+                for instance in wait_instances_running( self.ctx.ec2, instances ):
+                    box = boxes_by_id[ instance.id ]
+                    # equivalent to the instance.update() done in _wait_ready()
+                    box.instance = instance
+                    if instance.state == 'running':
+                        if instance.ip_address:
+                            prober.add( box, instance.ip_address )
+                        else:
+                            executor( callback, (box,) )
+                        num_running += 1
+                    else:
+                        log.info( 'Instance %s in unexpected state %s.',
+                                  instance.id, instance.state )
+                        num_other += 1
+                assert num_running + num_other == len( boxes )
+                if not num_running:
+                    raise RuntimeError( 'None of the instances entered the running state.' )
+                if num_other:
+                    log.warn( '%i instance(s) entered a state other than running.', num_other )
+                while not prober.wait( timeout=self.status_check_interval ):
+                    self.__check_instance_status( prober, executor, callback )
+
+    def _ssh_port_prober( self, callback ):
+        """
+        Return a PortProber that invokes the given callback with each box whose SSH port
+        accepts connections.
+
+        :rtype: PortProber
+        """
+        return PortProber( callback, timeout=a_short_time )
+
+    def __check_instance_status( self, prober, executor, callback ):
+        """
+        Look up the status of the instances whose SSH port is still being probed with as few
+        DescribeInstanceStatus requests as possible and give up on those that failed their
+        status checks.
+
+        :type prober: PortProber
+        """
+        boxes_by_id = { box.instance_id: box for box in prober.pending( ) }
+        for batch in partition_seq( boxes_by_id.keys( ), 100 ):
+            for status in self.ctx.ec2.get_all_instance_status( instance_ids=batch ):
+                checks = (status.system_status.status, status.instance_status.status)
+                if 'impaired' in checks:
+                    box = boxes_by_id[ status.id ]
+                    if prober.discard( box ):
+                        executor( callback, (box, RuntimeError(
+                            'Instance %s failed its status checks.' % status.id )) )
+
+    def _meter_subject( self ):
+        """
+        Describe this box for the purpose of accounting AWS requests to it.
+        """
+        instance_id = self.instance_id
+        return self.role( ) if instance_id is None else '%s %s' % (self.role( ), instance_id)
 
     def clones( self ):
         """
@@ -806,12 +1051,15 @@ class Box( object ):
         """
         Link the given newly created EC2 instance with this box.
         """
+        self._link( instance, cluster_ordinal )
+        self._on_instance_created( )
+
+    def _link( self, instance, cluster_ordinal ):
         log.info( '... created %s.', instance.id )
         self.instance = instance
         self.cluster_ordinal = cluster_ordinal
         if self.cluster_name is None:
             self.cluster_name = self.instance_id
-        self._on_instance_created( )
 
     def _set_instance_options( self, options ):
         """
@@ -891,10 +1139,22 @@ class Box( object ):
         """
         Invoked right after an instance was created.
         """
-        log.info( 'Tagging instance ... ' )
-        tags_dict = self._get_instance_options( )
-        tag_object_persistently( self.instance, tags_dict )
-        log.info( '... instance tagged %r.', tags_dict )
+        self._on_instances_created( [ self ] )
+
+    @metered( 'tag' )
+    def _on_instances_created( self, boxes ):
+        """
+        Invoked right after a batch of instances was created, one instance for each of the given
+        boxes. The boxes are this box and/or clones of it.
+
+        :type boxes: list[Box]
+        """
+        log.info( 'Tagging %i instance(s) ... ', len( boxes ) )
+        # noinspection PyProtectedMember
+        tag_objects_persistently( self.ctx.ec2, [ (box.instance, box._get_instance_options( ))
+            for box in boxes ] )
+        for box in boxes:
+            log.info( '... instance %s tagged %r.', box.instance_id, box.instance.tags )
 
     def _on_instance_running( self, first_boot ):
         """
@@ -1043,15 +1303,26 @@ class Box( object ):
         """
         return None
 
-    def image( self ):
+    @metered( 'image' )
+    def image( self, no_reboot=False, copy_to_regions=( ) ):
         """
         Create an image (AMI) of the EC2 instance represented by this box and return its ID.
         The EC2 instance needs to use an EBS-backed root volume. The box must be stopped or
-        an exception will be raised.
+        an exception will be raised, unless no_reboot is True.
+
+        :param bool no_reboot: If True, the image will be created from the instance in whatever
+        state it is in, running or stopped. A running instance will not be rebooted so the
+        consistency of its file systems is not guaranteed. The caller should make sure that the
+        instance is quiesced.
+
+        :param list[str] copy_to_regions: The names of other regions to copy the image to. The
+        copies are made concurrently, once the image is available. They will have the same name
+        and tags as the image.
         """
         # We've observed instance state to flap from stopped back to stoppping. As a best effort
         # we wait for it to flap back to stopped.
-        wait_transition( self.instance, { 'stopping' }, 'stopped' )
+        if not no_reboot or self.instance.state == 'stopping':
+            wait_transition( self.instance, { 'stopping' }, 'stopped' )
 
         log.info( "Creating image ..." )
         timestamp = time.strftime( '%Y-%m-%d_%H-%M-%S' )
@@ -1059,6 +1330,7 @@ class Box( object ):
         image_id = self.ctx.ec2.create_image(
             instance_id=self.instance_id,
             name=image_name,
+            no_reboot=no_reboot,
             block_device_mapping=self._image_block_device_mapping( ) )
         while True:
             try:
@@ -1072,17 +1344,63 @@ class Box( object ):
                 if e.error_code != 'InvalidAMIID.NotFound':
                     raise
         # There seems to be another race condition in EC2 that causes a freshly created image to
-        # not be included in queries other than by AMI ID.
+        # not be included in queries other than by AMI ID. Query by the image's exact name,
+        # like list_images() does by name prefix, but without listing every image of the role.
         log.info( 'Checking if image %s is discoverable ...' % image_id )
+        schedule = PollingSchedule( 'image', 'undiscoverable', 'discoverable' )
         while True:
-            if image_id in (_.id for _ in self.list_images( )):
+            discoverable = False
+            with schedule.polling( ):
+                images = self.ctx.ec2.get_all_images( filters={ 'name': image_name } )
+                discoverable = image_id in (_.id for _ in images)
+            if discoverable:
                 log.info( '... image now discoverable.' )
+                schedule.observe( 'discoverable' )
                 break
-            log.info( '... image %s not yet discoverable, trying again in %is ...', image_id,
-                      a_short_time )
-            time.sleep( a_short_time )
+            delay = schedule.delay( )
+            log.info( '... image %s not yet discoverable, trying again in %.1fs ...', image_id,
+                      delay )
+            time.sleep( delay )
+        if copy_to_regions:
+            self.copy_image( image, copy_to_regions )
         return image_id
 
+    def copy_image( self, image, regions ):
+        """
+        Copy the given image to each of the given regions, tag each copy like the given image
+        and wait for all copies to become available. The copies are made concurrently, one thread
+        per region.
+
+        :param boto.ec2.image.Image image: an available image in this box' region
+
+        :param list[str] regions: the names of the regions to copy the image to
+
+        :return: a dictionary mapping each region name to the ID of the copy in that region
+        :rtype: dict[str,str]
+        """
+        tags = dict( image.tags )
+
+        def copy( region ):
+            # Each region needs its own connection and so does each thread
+            ec2 = self.ctx.connect_ec2( region )
+            try:
+                log.info( 'Copying image %s to region %s ...', image.id, region )
+                copy_id = ec2.copy_image( source_region=self.ctx.region,
+                                          source_image_id=image.id,
+                                          name=image.name,
+                                          description=image.description ).image_id
+                copy = Image( ec2 )
+                copy.id, copy.state = copy_id, 'pending'
+                if tags:
+                    tag_objects_persistently( ec2, [ (copy, tags) ], pool_size=0 )
+                wait_transition( copy, { 'pending' }, 'available' )
+                log.info( '... copied image %s to %s in region %s.', image.id, copy_id, region )
+                return region, copy_id
+            finally:
+                ec2.close( )
+
+        return dict( pmap( copy, regions, pool_size=len( regions ) ) )
+
     def stop( self ):
         """
         Stop the EC2 instance represented by this box. Stopped instances can be started later using
@@ -1119,6 +1437,7 @@ class Box( object ):
         self.stop( )
         self.start( )
 
+    @metered( 'terminate' )
     def terminate( self, wait=True ):
         """
         Terminate the EC2 instance represented by this box.
@@ -1146,6 +1465,8 @@ class Box( object ):
         # host = "%s@%s" % ( user, self.ip_address )
         with settings( user=user ):
             host = self.ip_address
+            # Let Fabric use the cached SSH connection, replacing it first if it died
+            self._ssh_session( user )
             return execute( task, hosts=[ host ] )[ host ]
 
     def __assert_state( self, expected_state ):
@@ -1161,6 +1482,7 @@ class Box( object ):
             raise UserError( "Expected instance state '%s' but got '%s'"
                              % (expected_state, actual_state) )
 
+    @metered( 'wait_ready' )
     def _wait_ready( self, from_states, first_boot ):
         """
         Wait until the given instance transistions from stopped or pending state to being fully
@@ -1195,9 +1517,13 @@ class Box( object ):
 
         :type instance: boto.ec2.instance.Instance
         """
-        while not instance.ip_address or not instance.public_dns_name:
-            time.sleep( a_short_time )
-            instance.update( )
+        if not instance.ip_address or not instance.public_dns_name:
+            schedule = PollingSchedule( 'instance', 'without-public-ip', 'with-public-ip' )
+            while not instance.ip_address or not instance.public_dns_name:
+                schedule.sleep( )
+                with schedule.polling( ):
+                    instance.update( )
+            schedule.observe( 'with-public-ip' )
 
     def __wait_ssh_port_open( self ):
         """
@@ -1223,9 +1549,8 @@ class Box( object ):
 
     def __wait_ssh_working( self ):
         while True:
-            client = None
             try:
-                client = self._ssh_client( )
+                client = self._ssh_session( )
                 stdin, stdout, stderr = client.exec_command( 'echo hi' )
                 try:
                     line = stdout.readline( )
@@ -1243,19 +1568,34 @@ class Box( object ):
                 raise
             except Exception as e:
                 logging.info( e )
-            finally:
-                if client is not None:
-                    client.close( )
+                discard_ssh_client( self.admin_account( ), self.ip_address )
             time.sleep( a_short_time )
 
-    def _ssh_client( self ):
+    def _ssh_client( self, user=None ):
+        """
+        Make a new SSH connection to the instance represented by this box. Most callers should
+        use _ssh_session() instead.
+        """
         client = SSHClient( )
         client.set_missing_host_key_policy( self.IgnorePolicy( ) )
         client.connect( hostname=self.ip_address,
-                        username=self.admin_account( ),
+                        username=self.admin_account( ) if user is None else user,
                         timeout=a_short_time )
         return client
 
+    def _ssh_session( self, user=None ):
+        """
+        Return an SSH connection to the instance represented by this box, reusing the connection
+        that was made by a previous invocation of this method or by Fabric, if that connection is
+        still active. The connection is shared with Fabric tasks on this box. It must not be
+        closed by the caller.
+
+        :rtype: SSHClient
+        """
+        if user is None:
+            user = self.admin_account( )
+        return ssh_client( user, self.ip_address, connect=partial( self._ssh_client, user ) )
+
     def ssh( self, user=None, command=None ):
         if command is None: command = [ ]
         status = subprocess32.call( self._ssh_args( user, command ) )
@@ -1286,22 +1626,14 @@ class Box( object ):
             get( local_path=authorized_keys, remote_path='~/.ssh/authorized_keys' )
             authorized_keys.seek( 0 )
             ssh_pubkeys = set( l.strip( ) for l in authorized_keys.readlines( ) )
-            for ec2_keypair in ec2_keypairs:
-                ssh_pubkey = self.__download_ssh_pubkey( ec2_keypair )
-                if ssh_pubkey: ssh_pubkeys.add( ssh_pubkey )
+            for ssh_pubkey in self.ctx.download_ssh_pubkeys( ec2_keypairs ):
+                if ssh_pubkey: ssh_pubkeys.add( ssh_pubkey.strip( ) )
             authorized_keys.seek( 0 )
             authorized_keys.truncate( )
             authorized_keys.write( '\n'.join( ssh_pubkeys ) )
             authorized_keys.write( '\n' )
             put( local_path=authorized_keys, remote_path='~/.ssh/authorized_keys' )
 
-    def __download_ssh_pubkey( self, keypair ):
-        try:
-            return self.ctx.download_ssh_pubkey( keypair ).strip( )
-        except UserError as e:
-            log.warn( 'Exception while downloading SSH public key from S3', e )
-            return None
-
     @fabric_task
     def _propagate_authorized_keys( self, user, group=None ):
         """
@@ -1322,6 +1654,8 @@ class Box( object ):
         args = dict( src_user=self.admin_account( ),
                      dst_user=user,
                      dst_group=group )
+        # Not batched since this is invoked before requiretty is disabled on CentOS, and sudo
+        # needs a pty until then.
         sudo( 'install -d ~{dst_user}/.ssh '
               '-m 755 -o {dst_user} -g {dst_group}'.format( **args ) )
         sudo( 'install -t ~{dst_user}/.ssh ~{src_user}/.ssh/authorized_keys '
@@ -1433,11 +1767,9 @@ class Box( object ):
     # http://aws.amazon.com/amazon-linux-ami/instance-type-matrix/
     #
     virtualization_types = [ 'paravirtual', 'hvm' ]
-    paravirtual_families = [ 'm1', 'c1', 'm2', 't1' ]
 
     def __default_virtualization_type( self, instance_type ):
-        family = instance_type.split( '.', 2 )[ 0 ].lower( )
-        return 'paravirtual' if family in self.paravirtual_families else 'hvm'
+        return instance_type_catalog( )[ instance_type ].virtualization_types[ 0 ]
 
     def delete_image( self, image_ref, wait=True, delete_snapshot=True ):
         image = self.__select_image( image_ref )
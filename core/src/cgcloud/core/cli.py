@@ -1,6 +1,8 @@
 # PYTHON_ARGCOMPLETE_OK
 
-from __future__ import absolute_import
+from __future__ import absolute_import, print_function
+
+import atexit
 from collections import OrderedDict
 from importlib import import_module
 import logging
@@ -8,8 +10,10 @@ import os
 import sys
 import imp
 from bd2k.util.iterables import concat
+from tabulate import tabulate
 
-from cgcloud.lib.util import Application, app_name, UserError
+from cgcloud.lib.metering import aws_meter
+from cgcloud.lib.util import Application, app_name, UserError, heredoc
 import cgcloud.core
 
 log = logging.getLogger( __name__ )
@@ -82,6 +86,14 @@ class CGCloud( Application ):
                      help='Write debug log to %s in current directory.' % self.debug_log_file_name )
         self.option( '--script', '-s', metavar='PATH',
                      help='The path to a Python script with additional role definitions.' )
+        self.option( '--aws-stats',
+                     default=False, action='store_true',
+                     help=heredoc( """Record every request made to AWS and print a summary of
+                     the number of requests, retries, throttles and latencies per operation,
+                     activity and box when the program exits.""" ) )
+        self.option( '--aws-stats-json', metavar='PATH',
+                     help=heredoc( """Also write every recorded AWS request to the given file,
+                     as JSON. Implies --aws-stats.""" ) )
         self.roles = OrderedDict( )
         self.cluster_types = OrderedDict( )
         for plugin in plugins:
@@ -107,11 +119,33 @@ class CGCloud( Application ):
                 self.root_logger.addHandler( file_handler )
             else:
                 self.silence_boto_and_paramiko( )
+        if options.aws_stats or options.aws_stats_json:
+            aws_meter( ).enable( )
+            atexit.register( self.report_aws_stats, options.aws_stats_json )
         if options.script:
             plugin = imp.load_source( os.path.splitext( os.path.basename( options.script ) )[ 0 ],
                                       options.script )
             self._import_plugin_roles( plugin )
 
+    @staticmethod
+    def report_aws_stats( json_path=None ):
+        meter = aws_meter( )
+        headers = [ 'calls', 'retries', 'throttles', 'errors', 'total s', 'max s' ]
+        for key, title in (('operation', 'operation'), ('phase', 'activity'), ('subject', 'box')):
+            print( tabulate( meter.summarize( key ),
+                             headers=[ title ] + headers,
+                             floatfmt='.3f',
+                             missingval='-' ),
+                   file=sys.stderr )
+            print( file=sys.stderr )
+        print( tabulate( meter.wall_times( ),
+                         headers=[ 'activity', 'count', 'wall s' ],
+                         floatfmt='.3f' ),
+               file=sys.stderr )
+        if json_path is not None:
+            meter.dump( json_path )
+            print( 'Wrote AWS request statistics to %s.' % json_path, file=sys.stderr )
+
     @classmethod
     def setup_logging( cls ):
         root_logger = logging.getLogger( )
@@ -11,7 +11,7 @@ from paramiko import Channel
 
 from cgcloud.core.box import Box, fabric_task
 from cgcloud.core.package_manager_box import PackageManagerBox
-from cgcloud.lib.ec2 import ec2_instance_types
+from cgcloud.lib.instance_types import instance_type_catalog
 from cgcloud.lib.util import heredoc
 
 log = logging.getLogger( __name__ )
@@ -94,8 +94,17 @@ class CloudInitBox( PackageManagerBox ):
         num_disks = instance_type.disks
         device_prefix = self._get_virtual_block_device_prefix( )
 
-        def device_name( i ):
-            return device_prefix + (chr( ord( 'b' ) + i ))
+        if instance_type.nvme:
+            # NVMe instance store volumes are enumerated by the kernel in no predictable order
+            # and possibly interleaved with NVMe EBS volumes, so we look them up by model at boot
+            # time. That requires a shell, hence the commands being strings further down.
+            def device_name( i ):
+                return ("$(for d in /sys/block/nvme*n1; do "
+                        "grep -qs 'Instance Storage' $d/device/model && echo /dev/${d##*/}; "
+                        "done | sed -n %ip)" % (i + 1))
+        else:
+            def device_name( i ):
+                return device_prefix + (chr( ord( 'b' ) + i ))
 
         if num_disks == 0:
             pass
@@ -140,6 +149,9 @@ class CloudInitBox( PackageManagerBox ):
         else:
             assert False
 
+        if instance_type.nvme:
+            commands = [ ' '.join( c ) if isinstance( c, list ) else c for c in commands ]
+
         # Prepend commands as a best effort to getting volume preparation done as early as
         # possible in the boot sequence. Note that CloudInit's 'bootcmd' is run on every boot,
         # 'runcmd' only once after instance creation.
@@ -149,7 +161,7 @@ class CloudInitBox( PackageManagerBox ):
     def _spec_block_device_mapping( self, spec, image ):
         super( CloudInitBox, self )._spec_block_device_mapping( spec, image )
         cloud_config = { }
-        instance_type = ec2_instance_types[ spec[ 'instance_type' ] ]
+        instance_type = instance_type_catalog( )[ spec[ 'instance_type' ] ]
         self._populate_cloud_config( instance_type, cloud_config )
         if cloud_config:
             if 'user_data' in spec:
@@ -192,13 +204,9 @@ class CloudInitBox( PackageManagerBox ):
         # For example, it isn't being written by the cloud-init for Lucid. We must use our own file
         # created by a runcmd, see _populate_cloud_config()
         #
-        # This function is called on every node in a cluster during that cluster's creation. For
-        # that reason we want to avoid contention on the lock in @fabric_task that's protecting
-        # the thread-unsafe Fabric code. This contention is aggravated by the fact that,
-        # for some unkown reason, the first SSH connection to a node takes unusually long. With a
-        # lock serialising all calls to this method we have to wait for the delay for every node
-        # in sequence, in O(N) time. Paramiko, OTOH, is thread-safe allowing us to do the wait
-        # in concurrently, in O(1) time.
+        # This function is called on every node in a cluster during that cluster's creation.
+        # Paramiko is thread-safe, allowing us to do the wait concurrently, in O(1) time, over
+        # the SSH connection that was made when the box was checked for SSH readiness.
 
         command = ';'.join( [
             'echo -n "Waiting for cloud-init to finish ..."',
@@ -232,19 +240,15 @@ class CloudInitBox( PackageManagerBox ):
                 if r: logger( r )
             return i
 
-        client = self._ssh_client( )
-        try:
-            with client.get_transport( ).open_session( ) as chan:
-                assert isinstance( chan, Channel )
-                chan.exec_command( cmd )
-                streams = (
-                    partial( stream, 'stderr', chan.recv_stderr_ready, chan.recv_stderr, log.warn ),
-                    partial( stream, 'stdout', chan.recv_ready, chan.recv, log.info ))
-                while sum( stream( ) for stream in streams ) or not chan.exit_status_ready( ):
-                    time.sleep( paramiko.common.io_sleep )
-                assert 0 == chan.recv_exit_status( )
-        finally:
-            client.close( )
+        with self._ssh_session( ).get_transport( ).open_session( ) as chan:
+            assert isinstance( chan, Channel )
+            chan.exec_command( cmd )
+            streams = (
+                partial( stream, 'stderr', chan.recv_stderr_ready, chan.recv_stderr, log.warn ),
+                partial( stream, 'stdout', chan.recv_ready, chan.recv, log.info ))
+            while sum( stream( ) for stream in streams ) or not chan.exit_status_ready( ):
+                time.sleep( paramiko.common.io_sleep )
+            assert 0 == chan.recv_exit_status( )
 
     def _list_packages_to_install( self ):
         # As a fallback from failed installations of mdadm at boot time, we should install mdadm
@@ -1,7 +1,11 @@
 import logging
 from abc import ABCMeta, abstractproperty
+from operator import attrgetter
+
+from bd2k.util import less_strict_bool
 
 from cgcloud.core.box import Box
+from cgcloud.lib.ec2 import attach_volume, provision_volumes, wait_transition
 from cgcloud.lib.util import (abreviated_snake_case_class_name, papply, thread_pool)
 
 log = logging.getLogger( __name__ )
@@ -80,9 +84,59 @@ class ClusterBox( Box ):
     A mixin for a box that is part of a cluster
     """
 
+    # The device at which the persistent EBS volume of each node is attached
+    ebs_volume_device = '/dev/sdf'
+
+    def __init__( self, ctx ):
+        super( ClusterBox, self ).__init__( ctx )
+        self.ebs_volume = None
+
     def _set_instance_options( self, options ):
         super( ClusterBox, self )._set_instance_options( options )
         self.ebs_volume_size = int( options.get( 'ebs_volume_size' ) or 0 )
+        # Not persisted as a tag, only meaningful while creating instances
+        self.provision_ebs_volumes = less_strict_bool( options.get( 'provision_ebs_volumes' ) )
+
+    def ebs_volume_name( self ):
+        """
+        Return the name of the persistent EBS volume of the node represented by this box. The
+        name is derived from the name and cluster ordinal of the instance such that the volume
+        can be found again by the code running on that instance.
+        """
+        return '%s__%d' % (self.instance.tags[ 'Name' ], self.cluster_ordinal)
+
+    def _on_instances_created( self, boxes ):
+        super( ClusterBox, self )._on_instances_created( boxes )
+        if self.ebs_volume_size and self.provision_ebs_volumes:
+            # Create the volumes while the instances are booting. Once an instance is running,
+            # its volume will be attached, see _on_instance_running(). The code on the instance
+            # then finds the volume already attached. Don't wait for the volumes to become
+            # available here, that would hold up the adoption of the next batch of instances.
+            names = [ box.ebs_volume_name( ) for box in boxes ]
+            volumes = provision_volumes( self.ctx.ec2,
+                                         volumes=[ (name, box.instance.placement)
+                                             for name, box in zip( names, boxes ) ],
+                                         size=self.ebs_volume_size,
+                                         volume_type='gp2' )
+            for name, box in zip( names, boxes ):
+                box.ebs_volume = volumes[ name ]
+
+    def _on_instance_running( self, first_boot ):
+        super( ClusterBox, self )._on_instance_running( first_boot )
+        if first_boot and self.ebs_volume is not None:
+            if self.ebs_volume.status == 'creating':
+                log.info( 'Waiting for volume %s to be created ...', self.ebs_volume.id )
+                wait_transition( self.ebs_volume, { 'creating' }, 'available',
+                                 attrgetter( 'status' ) )
+            log.info( 'Attaching volume %s to instance %s ...', self.ebs_volume.id,
+                      self.instance_id )
+            attach_volume( self.ctx.ec2, self.ebs_volume, self.instance_id,
+                           self.ebs_volume_device )
+            log.info( '... attached.' )
+
+    def unbind( self ):
+        super( ClusterBox, self ).unbind( )
+        self.ebs_volume = None
 
     def _get_instance_options( self ):
         return dict( super( ClusterBox, self )._get_instance_options( ),
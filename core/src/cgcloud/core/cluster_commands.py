@@ -77,6 +77,13 @@ class CreateClusterCommand( ClusterTypeCommand, RecreateCommand ):
                      help=heredoc( """The size in GB of an EBS volume to be attached to each node
                      for persistent data. The volume will be mounted at /mnt/persistent.""" ) )
 
+        self.option( '--provision-ebs-volumes', '-P',
+                     default=False, action='store_true',
+                     help=heredoc( """Create the EBS volumes requested via --ebs-volume-size
+                     concurrently from this machine while the instances are booting and attach
+                     them as soon as the instances are running, instead of having each node
+                     create and attach its own volume during boot.""" ) )
+
         self.option( '--leader-on-demand', '-D',
                      default=False, action='store_true',
                      help=heredoc( """Use this option to insure that the leader will be an
@@ -96,7 +103,8 @@ class CreateClusterCommand( ClusterTypeCommand, RecreateCommand ):
     def preparation_kwargs( self, options, box ):
         return dict( super( CreateClusterCommand, self ).preparation_kwargs( options, box ),
                      cluster_name=options.cluster_name,
-                     ebs_volume_size=options.ebs_volume_size )
+                     ebs_volume_size=options.ebs_volume_size,
+                     provision_ebs_volumes=options.provision_ebs_volumes )
 
     def creation_kwargs( self, options, box ):
         return dict( super( CreateClusterCommand, self ).creation_kwargs( options, box ),
@@ -241,6 +249,14 @@ class GrowClusterCommand( ClusterCommand, RecreateCommand ):
         self.option( '--num-workers', '-s', metavar='NUM',
                      type=int, default=1,
                      help='The number of workers to add.' )
+        self.option( '--provision-ebs-volumes', '-P',
+                     default=False, action='store_true',
+                     help=heredoc( """Create the EBS volumes of the new workers concurrently
+                     from this machine while the instances are booting and attach them as soon
+                     as the instances are running, instead of having each worker create and
+                     attach its own volume during boot. The volumes will be of the same size as
+                     the leader's volume. Without this option, the new workers don't get an EBS
+                     volume.""" ) )
 
     def option( self, option_name, *args, **kwargs ):
         _super = super( GrowClusterCommand, self )
@@ -282,9 +298,13 @@ class GrowClusterCommand( ClusterCommand, RecreateCommand ):
         cluster_ordinal = allocate_cluster_ordinals( num=options.num_workers,
                                                      used=used_cluster_ordinals )
         first_worker.unbind( )  # list() bound it
+        preparation_kwargs = self.preparation_kwargs( options, first_worker )
+        if options.provision_ebs_volumes:
+            preparation_kwargs.update( ebs_volume_size=leader.ebs_volume_size,
+                                       provision_ebs_volumes=True )
         spec = first_worker.prepare( leader_instance_id=leader.instance_id,
                                      cluster_name=leader.cluster_name,
-                                     **self.preparation_kwargs( options, first_worker ) )
+                                     **preparation_kwargs )
         with thread_pool( min( options.num_threads, options.num_workers ) ) as pool:
             workers = first_worker.create( spec,
                                            cluster_ordinal=cluster_ordinal,
@@ -2,25 +2,34 @@ from __future__ import print_function
 
 import argparse
 import functools
+import json
 import logging
 import os
 import re
 import sys
 from abc import abstractmethod
+from collections import OrderedDict
 from operator import itemgetter
 
+from bd2k.util.collections import OrderedSet
 from bd2k.util.exceptions import panic
 from bd2k.util.expando import Expando
 from bd2k.util.iterables import concat
+from boto.ec2 import regions as ec2_regions
 from boto.ec2.blockdevicemapping import BlockDeviceType
 from boto.ec2.connection import EC2Connection
 from boto.ec2.group import Group
+from boto.provider import Provider
 from fabric.operations import prompt
 from tabulate import tabulate
 
 from cgcloud.core.box import Box
 from cgcloud.lib.context import Context
-from cgcloud.lib.ec2 import ec2_instance_types
+from cgcloud.lib.governor import aws_governor, Governor
+from cgcloud.lib.identity_cache import identity_cache
+from cgcloud.lib.instance_types import instance_type_catalog, InstanceTypeCatalog
+from cgcloud.lib.spot_history import spot_price_history
+from cgcloud.lib.spot_markets import stream_spot_markets, rank_spot_markets
 from cgcloud.lib.util import Application, heredoc
 from cgcloud.lib.util import UserError, Command
 
@@ -71,9 +80,22 @@ class ContextCommand( Command ):
                      anything after the first occurrance of that character will be discarded
                      before the substitution is done.""" ) )
 
+        self.option( '--max-api-rate', metavar='N', type=float,
+                     default=os.environ.get( 'CGCLOUD_MAX_API_RATE' ),
+                     help=heredoc( """The maximum number of requests per second to issue to each
+                     AWS API action, e.g. DescribeInstances, across all threads. The actual rate
+                     is lowered automatically while AWS throttles requests and raised again
+                     afterwards. The value of the environment variable CGCLOUD_MAX_API_RATE,
+                     if that variable is present, overrides the default of %g."""
+                                   % Governor.default_max_rate ) )
+
     def run( self, options ):
         zone = options.availability_zone
         namespace = options.namespace
+        if options.max_api_rate is not None:
+            if options.max_api_rate <= 0:
+                raise UserError( '--max-api-rate must be positive' )
+            aws_governor( ).set_max_rate( options.max_api_rate )
         ctx = None
         try:
             ctx = Context( availability_zone=zone, namespace=namespace )
@@ -306,13 +328,32 @@ class RsyncCommand( RsyncCommandMixin, InstanceCommand ):
 
 class ImageCommand( InstanceCommand ):
     """
-    Create an AMI image of a box performing a given role. The box must be stopped.
+    Create an AMI image of a box performing a given role. The box must be stopped unless
+    --no-reboot is specified.
     """
 
     wait_ready = False
 
+    def __init__( self, application ):
+        super( ImageCommand, self ).__init__( application )
+        self.option( '--no-reboot', default=False, action='store_true',
+                     help=heredoc( """Create the image from the box even if it is running,
+                     without rebooting it. The consistency of the file systems in the image is
+                     not guaranteed unless the box is quiesced, e.g. by stopping any services
+                     that write to disk.""" ) )
+        self.option( '--copy-to-regions', metavar='REGION', nargs='+', default=[ ],
+                     help=heredoc( """The names of other regions to copy the image to once it
+                     is available. The copies are made concurrently.""" ) )
+
     def run_on_instance( self, options, box ):
-        box.image( )
+        regions = set( region.name for region in ec2_regions( ) )
+        for region in options.copy_to_regions:
+            if region not in regions:
+                raise UserError( "Unknown region '%s'" % region )
+            if region == box.ctx.region:
+                raise UserError( "Can't copy the image to its own region '%s'" % region )
+        box.image( no_reboot=options.no_reboot,
+                   copy_to_regions=list( OrderedSet( options.copy_to_regions ) ) )
 
 
 class ShowCommand( InstanceCommand ):
@@ -442,7 +483,8 @@ class CreationCommand( BoxCommand ):
                      list of SSH keys authorized to login to the box. Shell-style globs can not
                      be combined with @ or @@ substitutions within one argument.""" ) )
 
-        self.option( '--instance-type', '-t', metavar='TYPE', choices=ec2_instance_types.keys( ),
+        self.option( '--instance-type', '-t', metavar='TYPE',
+                     choices=instance_type_catalog( ).names( ),
                      default=os.environ.get( 'CGCLOUD_INSTANCE_TYPE', None ),
                      help=heredoc( """The type of EC2 instance to launch for the box,
                      e.g. t2.micro, m3.small, m3.medium, or m3.large etc. The value of the
@@ -489,6 +531,26 @@ class CreationCommand( BoxCommand ):
                      help=heredoc( """Ignore --zone/CGCLOUD_ZONE and instead choose the best EC2
                      availability zone for spot instances based on a heuristic.""" ) )
 
+        def comma_separated( s ):
+            return filter( None, s.split( ',' ) )
+
+        self.option( '--spot-instance-types', metavar='TYPES', type=comma_separated,
+                     help=heredoc( """A comma-separated list of additional instance types to
+                     request spot instances of, e.g. m3.large,m4.large. If this option or
+                     --spot-zones is present, spot requests will be spread across markets,
+                     i.e. combinations of instance type and availability zone, in proportion to
+                     each market's recent price and the stability thereof. This shortens the wait
+                     for large numbers of spot instances when a single market can't satisfy the
+                     demand quickly. Can't be combined with --spot-launch-group.""" ) )
+
+        self.option( '--spot-zones', metavar='ZONES', type=comma_separated,
+                     help=heredoc( """A comma-separated list of availability zones to spread
+                     spot requests across, e.g. us-west-2a,us-west-2b. All zones must be in the
+                     region of --zone/CGCLOUD_ZONE. If this option is absent but
+                     --spot-instance-types is present, the zone given via --zone/CGCLOUD_ZONE
+                     will be used or, if --spot-auto-zone is present, all zones in the region.
+                     Can't be combined with --subnet or --spot-launch-group.""" ) )
+
         self.option( '--spot-timeout', metavar='SECONDS', type=float,
                      help=heredoc( """The maximum time to wait for spot instance requests to
                      enter the active state. Requests that are not active when the timeout fires
@@ -557,7 +619,9 @@ class CreationCommand( BoxCommand ):
                      subnet_id=options.subnet_id,
                      spot_bid=options.spot_bid,
                      spot_launch_group=options.spot_launch_group,
-                     spot_auto_zone=options.spot_auto_zone )
+                     spot_auto_zone=options.spot_auto_zone,
+                     spot_instance_types=options.spot_instance_types,
+                     spot_zones=options.spot_zones )
 
     def creation_kwargs( self, options, box ):
         return dict( terminate_on_error=options.terminate is not False,
@@ -656,6 +720,152 @@ class ListRolesCommand( Command ):
                   "the CGCLOUD_PLUGINS environment variable." )
 
 
+class InstanceTypesCommand( Command ):
+    """
+    List EC2 instance types meeting the given hardware requirements, optionally ranked by their
+    on-demand price in a given region. The instance types are read from a catalog file that ships
+    with cgcloud. The value of the environment variable CGCLOUD_INSTANCE_TYPES, if that variable
+    is present, is the path of a catalog file to be used instead.
+    """
+
+    def __init__( self, application, **kwargs ):
+        super( InstanceTypesCommand, self ).__init__( application, **kwargs )
+        zone = os.environ.get( 'CGCLOUD_ZONE' )
+        self.option( '--region', '-r', metavar='REGION', default=zone and zone[ :-1 ],
+                     help=heredoc( """The region whose prices to display and rank by, e.g.
+                     us-west-2. If absent, the region of the availability zone in the
+                     CGCLOUD_ZONE environment variable will be used, if that variable is
+                     present.""" ) )
+        self.option( '--min-cores', metavar='N', type=int, default=0,
+                     help='Only list types with at least the given number of cores.' )
+        self.option( '--min-memory', metavar='GB', type=float, default=0,
+                     help='Only list types with at least the given amount of RAM.' )
+        self.option( '--min-disks', metavar='N', type=int, default=0,
+                     help='Only list types with at least the given number of ephemeral volumes.' )
+        self.option( '--disk-type', metavar='TYPE', choices=[ 'SSD', 'HDD' ],
+                     help='Only list types with ephemeral volumes of the given type.' )
+        self.option( '--nvme', default=None, action='store_true',
+                     help='Only list types with NVMe ephemeral volumes.' )
+        self.option( '--spot', default=None, action='store_true',
+                     help='Only list types that are available on the spot market.' )
+        self.option( '--rank-by', metavar='CRITERION', choices=InstanceTypeCatalog.rankings,
+                     help=heredoc( """Sort the listed types by ascending price, price per core or
+                     price per GB of RAM in the specified region. Types without a known price in
+                     that region will be omitted. By default, types are listed in catalog
+                     order.""" ) )
+        self.option( '--cheapest', default=False, action='store_true',
+                     help=heredoc( """Only list the cheapest type meeting the requirements in
+                     the specified region.""" ) )
+
+    def run( self, options ):
+        catalog = instance_type_catalog( )
+        region = options.region
+        if (options.rank_by or options.cheapest) and region is None:
+            raise UserError( 'Need a region for ranking instance types by price.' )
+        requirements = dict( min_cores=options.min_cores,
+                             min_memory=options.min_memory,
+                             min_disks=options.min_disks,
+                             disk_type=options.disk_type,
+                             nvme=options.nvme,
+                             spot=options.spot )
+        if options.cheapest:
+            instance_types = [ catalog.cheapest( region, **requirements ) ]
+        else:
+            instance_types = catalog.find( **requirements )
+            if options.rank_by:
+                instance_types = catalog.rank( instance_types, region, by=options.rank_by )
+
+        def price( t, resource=None ):
+            return region and catalog.price_per( t, region, resource )
+
+        print( tabulate( ((t.name, t.cores, t.memory,
+                           t.disks, t.disk_capacity, t.disk_type, 'yes' if t.nvme else 'no',
+                           t.network, 'yes' if t.spot_availability else 'no',
+                           price( t ), price( t, 'cores' ), price( t, 'memory' ))
+                          for t in instance_types),
+                         headers=[ 'name', 'cores', 'memory', 'disks', 'disk size', 'disk type',
+                                   'nvme', 'network', 'spot', 'price', 'per core', 'per GB' ] ) )
+
+
+class SpotReportCommand( ContextCommand ):
+    """
+    Summarize the recent behaviour of the spot markets for the given instance types in every
+    availability zone of the region. For each market, print the current, mean and percentile
+    prices, the volatility of the price and the fraction of time the price was above the given
+    bid, a proxy for the risk of spot instances being interrupted. Also mark the cheapest stable
+    market, i.e. the market with the lowest sum of current price and volatility among the
+    markets whose price was above the bid no more than a given fraction of the time.
+    """
+
+    percentiles = (50, 90, 99)
+
+    def __init__( self, application ):
+        super( SpotReportCommand, self ).__init__( application )
+
+        def comma_separated( s ):
+            return filter( None, s.split( ',' ) )
+
+        self.option( '--instance-types', '-t', metavar='TYPES', type=comma_separated,
+                     required=True,
+                     help=heredoc( """A comma-separated list of instance types to report on,
+                     e.g. m3.large,m4.large.""" ) )
+        self.option( '--bid', metavar='AMOUNT', type=float, required=True,
+                     help='The bid in dollars per hour to compute the time above bid for.' )
+        self.option( '--days', metavar='N', type=float, default=7,
+                     help='The number of days of price history to summarize.' )
+        self.option( '--max-risk', metavar='FRACTION', type=float, default=0.05,
+                     help=heredoc( """The maximum fraction of time the price of a market may
+                     have been above the bid for the market to be considered stable.""" ) )
+        self.option( '--format', '-f', choices=('table', 'tsv', 'json'), default='table',
+                     help=heredoc( """The output format. With tsv and json, the cheapest stable
+                     market is marked by the cheapest_stable field.""" ) )
+
+    def run_in_ctx( self, options, ctx ):
+        catalog = instance_type_catalog( )
+        for instance_type in options.instance_types:
+            if not catalog[ instance_type ].spot_availability:
+                raise UserError( 'The instance type %s is not available on the spot market.' %
+                                 instance_type )
+        zones = set( zone.name for zone in ctx.ec2.get_all_zones( ) )
+        markets = stream_spot_markets( ((instance_type,
+                                         spot_price_history( ctx, instance_type, options.days,
+                                                             stream=True ))
+                                        for instance_type in options.instance_types),
+                                       bid=options.bid, zones=zones )
+        scores = [ market.score( ) for market in markets ]
+        stable = [ score for score in scores if score.time_above_bid <= options.max_risk ]
+        cheapest = rank_spot_markets( stable, options.bid )[ 0 ] if stable else None
+        rows = [ OrderedDict( [ ('instance_type', score.instance_type),
+                                ('zone', score.zone),
+                                ('price', score.price),
+                                ('mean', score.mean) ] +
+                              [ ('p%i' % q, market.percentile( q )) for q in self.percentiles ] +
+                              [ ('volatility', score.volatility),
+                                ('time_above_bid', score.time_above_bid),
+                                ('cheapest_stable', score is cheapest) ] )
+                 for market, score in zip( markets, scores ) ]
+        if options.format == 'json':
+            json.dump( rows, sys.stdout, indent=4 )
+            print( )
+        elif options.format == 'tsv':
+            if rows:
+                print( '\t'.join( rows[ 0 ].keys( ) ) )
+            for row in rows:
+                print( '\t'.join( str( v ).lower( ) if isinstance( v, bool ) else str( v )
+                                   for v in row.values( ) ) )
+        else:
+            print( tabulate( ([ v for k, v in row.items( ) if k != 'cheapest_stable' ] +
+                              [ '*' if row[ 'cheapest_stable' ] else '' ]
+                              for row in rows),
+                             headers=[ 'type', 'zone', 'price', 'mean' ] +
+                                     [ 'p%i' % q for q in self.percentiles ] +
+                                     [ 'volatility', 'above bid', 'cheapest stable' ],
+                             floatfmt='.4f' ) )
+            if cheapest is None:
+                print( 'None of the markets was above the bid for at most %g%% of the time.'
+                       % (options.max_risk * 100) )
+
+
 # noinspection PyAbstractClass
 class ImageReferenceCommand( Command ):
     """
@@ -823,19 +1033,48 @@ class ListOptionsCommand( RoleCommand ):
             print( 'The role %s does not define any options' % role.role( ) )
 
 
-class CleanupCommand( ContextCommand ):
+class ResourceDeletionCommand( ContextCommand ):
+    """
+    A command that deletes AWS resources concurrently and can report what it would delete
+    instead.
+    """
+
+    def __init__( self, application ):
+        super( ResourceDeletionCommand, self ).__init__( application )
+        self.option( '--num-threads', metavar='NUM', type=int, default=10,
+                     help='The maximum number of resources to delete concurrently.' )
+        self.option( '--dry-run', default=False, action='store_true',
+                     help=heredoc( """Don't delete anything, just print how many resources
+                     would be deleted and an estimate of how long that would take.""" ) )
+
+    @staticmethod
+    def print_cleanup_reports( reports ):
+        """
+        :param list reports: the reports returned by Cleanup.stage()
+        """
+        print( tabulate( [ (r.kind, r.count, r.failed, r.estimated_time, r.time)
+                             for r in reports ],
+                         headers=[ 'resource', 'count', 'failed', 'estimated s', 'actual s' ],
+                         floatfmt='.1f',
+                         missingval='-' ) )
+
+
+class CleanupCommand( ResourceDeletionCommand ):
     """
     Lists and optionally deletes unused AWS resources after prompting for confirmation.
     """
 
     def run_in_ctx( self, options, ctx ):
-        self.cleanup_image_snapshots( ctx )
-        self.cleanup_ssh_pubkeys( ctx )
+        self.cleanup_image_snapshots( ctx, options )
+        self.cleanup_ssh_pubkeys( ctx, options )
 
     @staticmethod
-    def cleanup_ssh_pubkeys( ctx ):
+    def cleanup_ssh_pubkeys( ctx, options ):
         unused_fingerprints = ctx.unused_fingerprints( )
-        if unused_fingerprints:
+        if options.dry_run:
+            print( '%i public keys in S3 are not referenced by any EC2 keypairs.'
+                   % len( unused_fingerprints ) )
+        elif unused_fingerprints:
             print( 'The following public keys in S3 are not referenced by any EC2 keypairs:' )
             for fingerprint in unused_fingerprints:
                 print( fingerprint )
@@ -844,32 +1083,69 @@ class CleanupCommand( ContextCommand ):
         else:
             print( 'No orphaned public keys in S3.' )
 
-    @staticmethod
-    def cleanup_image_snapshots( ctx ):
+    def cleanup_image_snapshots( self, ctx, options ):
+        if options.dry_run:
+            self.print_cleanup_reports( [ ctx.delete_snapshots( ctx.iter_unused_snapshots( ),
+                                                                num_threads=options.num_threads,
+                                                                dry_run=True ) ] )
+            return
         unused_snapshots = ctx.unused_snapshots( )
         if unused_snapshots:
             print( 'The following snapshots are not referenced by any images:' )
             for snapshot_id in unused_snapshots:
                 print( snapshot_id )
             if 'yes' == prompt( 'Delete these snapshots? (yes/no)', default='no' ):
-                ctx.delete_snapshots( unused_snapshots )
+                self.print_cleanup_reports( [ ctx.delete_snapshots(
+                    unused_snapshots, num_threads=options.num_threads ) ] )
         else:
             print( 'No unused EBS volume snapshots in EC2.' )
 
 
-class ResetSecurityCommand( ContextCommand ):
+class ResetSecurityCommand( ResourceDeletionCommand ):
     """
     Delete security-related objects like IAM instance profiles or EC2 security groups in a
     namespace and its children.
     """
 
     def run_in_ctx( self, options, ctx ):
+        if options.dry_run:
+            self.print_cleanup_reports( ctx.reset_namespace_security(
+                num_threads=options.num_threads, dry_run=True ) )
+            return
         message = ("Do you really want to delete all IAM instance profiles, IAM roles and EC2 "
                    "security groups in namespace %s and its children? Although these resources "
                    "will be created on-the-fly for newly created boxes, existing boxes will "
                    "likely be impacted negatively." % ctx.namespace)
         if 'yes' == prompt( message + ' (yes/no)', default='no' ):
-            ctx.reset_namespace_security( )
+            self.print_cleanup_reports( ctx.reset_namespace_security(
+                num_threads=options.num_threads ) )
+
+
+class ClearIdentityCacheCommand( Command ):
+    """
+    Forget the cached account ID, IAM user name and other facts about the AWS credentials in use.
+
+    To avoid making the same requests to AWS in every invocation, cgcloud caches these facts
+    locally for a day. Use this command after renaming the IAM user or otherwise changing what
+    the credentials refer to.
+    """
+
+    def __init__( self, application ):
+        super( ClearIdentityCacheCommand, self ).__init__( application )
+        self.option( '--all', '-a', default=False, action='store_true',
+                     help=heredoc( """Forget the facts about all credentials ever used, not just
+                     the ones currently in use.""" ) )
+
+    def run( self, options ):
+        if options.all:
+            access_key_id = None
+        else:
+            access_key_id = Provider( 'aws' ).access_key
+            if access_key_id is None:
+                raise UserError( "Can't determine the AWS credentials currently in use. Use "
+                                 "--all to forget the facts about all credentials." )
+        num_entries = identity_cache( ).invalidate( access_key_id )
+        log.info( 'Removed %i entries from the identity cache.', num_entries )
 
 
 class UpdateInstanceProfile( InstanceCommand ):
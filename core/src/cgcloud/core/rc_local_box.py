@@ -7,6 +7,7 @@ from fabric.operations import get, put, sudo
 
 from cgcloud.lib.util import prepend_shell_script
 from cgcloud.core.box import fabric_task, Box
+from cgcloud.fabric.batch import remote_batch
 
 InitCommand = namedtuple( "InitCommand", [ "command", "provides", "depends" ] )
 
@@ -21,15 +22,25 @@ class RcLocalBox( Box ):
     def __init__( self, ctx ):
         super( RcLocalBox, self ).__init__( ctx )
         self._init_commands = [ ]
+        # The ID of the instance, the path to its rc.local and the content of that file as last
+        # written by _register_init_command(). Saves reading the file before every update.
+        self._rc_local = None
 
     @fabric_task
     def _register_init_command( self, cmd ):
-        rc_local_path = self._get_rc_local_path( )
-        self._prepend_remote_shell_script( script=cmd,
-                                           remote_path=rc_local_path,
-                                           use_sudo=True,
-                                           mirror_local_mode=True )
-        sudo( 'chown root:root {0} && chmod +x {0}'.format( rc_local_path ) )
+        if self._rc_local is None or self._rc_local[ 0 ] != self.instance_id:
+            rc_local_path = self._get_rc_local_path( )
+            with closing( StringIO( ) ) as in_file:
+                get( remote_path=rc_local_path, local_path=in_file )
+                self._rc_local = self.instance_id, rc_local_path, in_file.getvalue( )
+        instance_id, rc_local_path, rc_local = self._rc_local
+        with closing( StringIO( ) ) as out_file:
+            prepend_shell_script( '\n' + cmd, StringIO( rc_local ), out_file )
+            rc_local = out_file.getvalue( )
+        with remote_batch( ) as batch:
+            batch.put( StringIO( rc_local ), rc_local_path, use_sudo=True )
+            batch.sudo( 'chown root:root {0} && chmod +x {0}'.format( rc_local_path ) )
+        self._rc_local = instance_id, rc_local_path, rc_local
 
     @fabric_task
     def _get_rc_local_path( self ):
@@ -1,6 +1,4 @@
-from fabric.operations import run
-
-from cgcloud.fabric.operations import sudo
+from cgcloud.fabric.batch import remote_batch
 from cgcloud.core.box import fabric_task
 from cgcloud.core.package_manager_box import PackageManagerBox
 
@@ -16,14 +14,15 @@ class SourceControlClient( PackageManagerBox ):
         # Pre-seed the host keys from bitbucket and github, such that ssh doesn't prompt during
         # the initial checkouts.
         #
-        for host in [ 'bitbucket.org', 'github.com' ]:
-            command = 'ssh-keyscan -t rsa %s >> ~/.ssh/known_hosts' % host
-            if user is None:
-                run( command )
-            elif user == 'root':
-                sudo( command )
-            else:
-                sudo( command, user=user, sudo_args='-i' )
+        with remote_batch( ) as batch:
+            for host in [ 'bitbucket.org', 'github.com' ]:
+                command = 'ssh-keyscan -t rsa %s >> ~/.ssh/known_hosts' % host
+                if user is None:
+                    batch.run( command )
+                elif user == 'root':
+                    batch.sudo( command )
+                else:
+                    batch.sudo( command, user=user, sudo_args='-i' )
 
     def _list_packages_to_install(self):
         return super( SourceControlClient, self )._list_packages_to_install( ) + [
@@ -0,0 +1,140 @@
+"""
+A benchmark of how Fabric tasks on many boxes scale with the number of threads running them.
+For each number of threads T, it runs a Fabric task on each of N boxes, using a pool of T
+threads. The boxes are stubbed: no instance exists and no SSH connection is made. Instead,
+each task sleeps for a while, simulating the latency of remote commands, and checks that the
+Fabric settings it sees are those of its own box. Making a connection is simulated by a sleep,
+too, but the stubbed connections still go through the shared connection cache every Fabric task
+on a box uses. Without thread-safe Fabric settings, or if connecting to one box blocked the
+others, the wall clock time would stay the same regardless of T. Otherwise it should drop
+linearly with T, up to T = N.
+
+Run it with
+
+    python -m cgcloud.core.test.fabric_benchmark --help
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+from bd2k.util.expando import Expando
+from fabric.state import env
+from tabulate import tabulate
+
+from cgcloud.core.box import Box, fabric_task
+from cgcloud.lib.util import pmap
+
+
+class StubTransport( object ):
+    def set_keepalive( self, interval ):
+        pass
+
+    def is_active( self ):
+        return True
+
+
+class StubClient( object ):
+    """
+    Stands in for a paramiko SSHClient in the connection cache.
+    """
+
+    def __init__( self ):
+        super( StubClient, self ).__init__( )
+        self.transport = StubTransport( )
+
+    def get_transport( self ):
+        return self.transport
+
+    def close( self ):
+        pass
+
+
+class StubBox( Box ):
+    """
+    A box whose Fabric tasks don't actually connect to its instance.
+    """
+
+    def __init__( self, ip_address, latency, connect_latency ):
+        super( StubBox, self ).__init__( ctx=None )
+        self.instance = Expando( ip_address=ip_address )
+        self.latency = latency
+        self.connect_latency = connect_latency
+
+    def admin_account( self ):
+        return 'admin'
+
+    def _base_image( self, virtualization_type ):
+        raise NotImplementedError( )
+
+    def setup( self, **kwargs ):
+        raise NotImplementedError( )
+
+    def _ephemeral_mount_point( self, i ):
+        return None
+
+    def _register_init_command( self, cmd ):
+        pass
+
+    def _ssh_client( self, user=None ):
+        time.sleep( self.connect_latency )
+        return StubClient( )
+
+    @fabric_task
+    def provision( self ):
+        for i in range( 2 ):
+            time.sleep( self.latency / 4 )
+            self.__check_settings( 'admin' )
+            self.__run_as_other_user( )
+
+    @fabric_task( user='other' )
+    def __run_as_other_user( self ):
+        time.sleep( self.latency / 4 )
+        self.__check_settings( 'other' )
+
+    def __check_settings( self, user ):
+        expected = (user, self.ip_address)
+        actual = (env.user, env.host_string)
+        if actual != expected:
+            raise AssertionError( 'Expected Fabric settings %r but got %r' % (expected, actual) )
+
+
+def run( num_boxes, num_threads, latency, connect_latency, subnet ):
+    """
+    :param int subnet: a number that is unique to each run such that the boxes get addresses
+    that aren't in the connection cache yet
+    """
+    boxes = [ StubBox( '10.%i.%i.%i' % ((subnet,) + divmod( i, 256 )), latency, connect_latency )
+              for i in range( num_boxes ) ]
+    start = time.time( )
+    list( pmap( StubBox.provision, boxes, pool_size=num_threads ) )
+    return time.time( ) - start
+
+
+def main( args=None ):
+    parser = argparse.ArgumentParser( description=__doc__.split( '\n\n' )[ 0 ].strip( ) )
+    parser.add_argument( '--num-boxes', metavar='N', type=int, default=64,
+                         help='The number of boxes to run the task on.' )
+    parser.add_argument( '--num-threads', metavar='T', type=int, nargs='+',
+                         default=[ 1, 2, 4, 8, 16, 32, 64 ],
+                         help='The numbers of threads to benchmark. The speedup is relative to the '
+                              'first.' )
+    parser.add_argument( '--latency', metavar='SECONDS', type=float, default=0.2,
+                         help='The time the task takes on each box.' )
+    parser.add_argument( '--connect-latency', metavar='SECONDS', type=float, default=0.1,
+                         help='The time it takes to make an SSH connection to a box.' )
+    options = parser.parse_args( args )
+
+    table = [ ]
+    baseline = None
+    for subnet, num_threads in enumerate( options.num_threads ):
+        duration = run( options.num_boxes, num_threads, options.latency,
+                        options.connect_latency, subnet )
+        if baseline is None:
+            baseline = duration
+        table.append( (num_threads, duration, baseline / duration) )
+    print( tabulate( table, headers=[ 'threads', 'wall s', 'speedup' ], floatfmt='.2f' ) )
+
+
+if __name__ == '__main__':
+    main( )
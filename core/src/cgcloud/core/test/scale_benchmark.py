@@ -0,0 +1,302 @@
+"""
+A benchmark of how the cluster commands scale with the number of nodes. For each cluster size N,
+it creates a cluster of N nodes, grows it by another N workers, lists the workers and
+terminates the cluster. It runs offline, against the in-memory fake of the AWS APIs in
+cgcloud.lib.test.fake_aws, with SSH readiness checks stubbed out. For each command and N it
+reports the wall clock time, the number of API calls by action and the peak number of threads.
+The exponent columns estimate k in O(N^k) from the previous N.
+
+Run it with
+
+    python -m cgcloud.core.test.scale_benchmark --help
+"""
+from __future__ import print_function
+
+import argparse
+import atexit
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from tabulate import tabulate
+
+import cgcloud.core
+from cgcloud.core.cli import CGCloud
+from cgcloud.core.cluster import Cluster, ClusterBox, ClusterLeader, ClusterWorker
+from cgcloud.lib.context import Context
+from cgcloud.lib.polling import transition_times
+from cgcloud.lib.port_prober import PortProber
+from cgcloud.lib.test.fake_aws import FakeAWS
+
+log = logging.getLogger( __name__ )
+
+
+class BenchNode( ClusterBox ):
+    """
+    A node that doesn't run any software. Its instances are booted from an image registered
+    with the fake and are considered ready as soon as they are running and have a public IP.
+    """
+
+    def admin_account( self ):
+        return 'admin'
+
+    def _base_image( self, virtualization_type ):
+        raise self.NoSuchImageException( 'Benchmark nodes are only booted from their own image' )
+
+    def setup( self, **kwargs ):
+        raise NotImplementedError( )
+
+    def _ephemeral_mount_point( self, i ):
+        return '/mnt/ephemeral' if i == 0 else None
+
+    def _register_init_command( self, cmd ):
+        pass
+
+    def _manages_keys_internally( self ):
+        return True
+
+    @classmethod
+    def supported_virtualization_types( cls ):
+        return [ 'hvm' ]
+
+    # Stub out the SSH readiness checks
+
+    def _Box__wait_ssh_port_open( self ):
+        return 0
+
+    def _Box__wait_ssh_working( self ):
+        pass
+
+    def _ssh_port_prober( self, callback ):
+        return OpenPortProber( callback )
+
+
+class OpenPortProber( PortProber ):
+    """
+    A prober that considers the port open on every host.
+    """
+
+    def add( self, key, host ):
+        self.callback( key )
+
+
+class BenchLeader( BenchNode, ClusterLeader ):
+    pass
+
+
+class BenchWorker( BenchNode, ClusterWorker ):
+    pass
+
+
+class BenchCluster( Cluster ):
+    @property
+    def leader_role( self ):
+        return BenchLeader
+
+    @property
+    def worker_role( self ):
+        return BenchWorker
+
+
+def roles( ):
+    return [ BenchNode, BenchLeader, BenchWorker ]
+
+
+def cluster_types( ):
+    return [ BenchCluster ]
+
+
+class ThreadSampler( object ):
+    """
+    Samples the number of live threads in the background, remembering the maximum.
+    """
+
+    def __init__( self, interval=0.005 ):
+        super( ThreadSampler, self ).__init__( )
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event( )
+        self.thread = threading.Thread( target=self.__run, name='ThreadSampler' )
+        self.thread.daemon = True
+
+    def __run( self ):
+        while not self.stopped.is_set( ):
+            # Don't count the sampler itself
+            self.peak = max( self.peak, threading.active_count( ) - 1 )
+            time.sleep( self.interval )
+
+    def __enter__( self ):
+        self.thread.start( )
+        return self
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        self.stopped.set( )
+        self.thread.join( )
+
+
+@contextmanager
+def silenced_stdout( ):
+    stdout = sys.stdout
+    with open( os.devnull, 'w' ) as sys.stdout:
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+class Benchmark( object ):
+    zone = 'us-west-2a'
+    namespace = '/bench/'
+
+    def __init__( self, aws, num_threads=None ):
+        """
+        :param FakeAWS aws: the fake to run the commands against
+
+        :param int num_threads: the value of --num-threads to pass to the cluster commands or
+        None to use the commands' default
+        """
+        super( Benchmark, self ).__init__( )
+        self.aws = aws
+        self.num_threads = num_threads
+        plugins = [ cgcloud.core, sys.modules[ __name__ ] ]
+        self.app = CGCloud( plugins )
+        for command_class in cgcloud.core.command_classes( ):
+            self.app.add( command_class )
+        with aws.patch_context( ):
+            ctx = Context( self.zone, self.namespace )
+            aws.add_image( ctx.to_aws_name( BenchNode.role( ) + '_' ) + '2016-01-01' )
+
+    def cgcloud( self, command, *args ):
+        options = [ '--zone', self.zone, '--namespace', self.namespace ]
+        if command in ('create-cluster', 'grow-cluster'):
+            options += [ '--keypairs', '__me__' ]
+        if self.num_threads is not None and command.endswith( '-cluster' ):
+            options += [ '--num-threads', str( self.num_threads ) ]
+        with self.aws.patch_context( ):
+            with silenced_stdout( ):
+                self.app.run( [ command ] + options + list( args ) )
+
+    def steps( self, n, cluster_name ):
+        """
+        Yield the name and the arguments of each command run for a cluster of the given size.
+        """
+        yield 'create-cluster', ('create-cluster', '--num-workers', str( n - 1 ),
+                                 '--cluster-name', cluster_name, BenchCluster.name( ))
+        yield 'grow-cluster', ('grow-cluster', '--num-workers', str( n ),
+                               '--cluster-name', cluster_name, BenchCluster.name( ))
+        yield 'list', ('list', '--cluster-name', cluster_name, BenchWorker.role( ))
+        yield 'terminate-cluster', ('terminate-cluster',
+                                    '--cluster-name', cluster_name, BenchCluster.name( ))
+
+    def run( self, sizes ):
+        """
+        Run the scenario for each of the given cluster sizes and return one row per command and
+        size, consisting of the command, N, the wall clock time in seconds, the number of API
+        calls, the peak number of threads and the number of calls per action.
+        """
+        rows = [ ]
+        for n in sizes:
+            for step, args in self.steps( n, cluster_name='bench-%i' % n ):
+                log.warn( 'Running %s for N=%i ...', step, n )
+                self.aws.calls.clear( )
+                start = time.time( )
+                with ThreadSampler( ) as sampler:
+                    self.cgcloud( *args )
+                duration = time.time( ) - start
+                calls = dict( self.aws.calls )
+                rows.append( (step, n, duration, sum( calls.itervalues( ) ), sampler.peak, calls) )
+                log.warn( '... took %.2fs.', duration )
+        return rows
+
+
+def exponent( x0, y0, x1, y1 ):
+    """
+    Estimate k such that y grows like x to the k-th power between the two given points.
+
+    >>> exponent( 10, 3, 100, 30 ), exponent( 10, 3, 100, 300 )
+    (1.0, 2.0)
+    >>> exponent( 1, 0, 10, 5 ) is None
+    True
+    """
+    if x0 == x1 or y0 <= 0 or y1 <= 0:
+        return None
+    return round( math.log( float( y1 ) / y0 ) / math.log( float( x1 ) / x0 ), 2 )
+
+
+def report( rows, max_actions=4 ):
+    table = [ ]
+    previous = { }
+    for step, n, duration, num_calls, peak_threads, calls in rows:
+        prev = previous.get( step )
+        previous[ step ] = n, duration, num_calls
+        if prev is None:
+            duration_exponent, calls_exponent = None, None
+        else:
+            prev_n, prev_duration, prev_num_calls = prev
+            duration_exponent = exponent( prev_n, prev_duration, n, duration )
+            calls_exponent = exponent( prev_n, prev_num_calls, n, num_calls )
+        calls = sorted( calls.iteritems( ), key=lambda (a, c): (-c, a) )
+        by_action = ', '.join( '%s %i' % (action.split( ':' )[ 1 ], count)
+                               for action, count in calls[ :max_actions ] )
+        if len( calls ) > max_actions:
+            by_action += ', ...'
+        table.append( (step, n, duration, duration_exponent, num_calls, calls_exponent,
+                       peak_threads, by_action) )
+    return tabulate( table,
+                     headers=[ 'command', 'N', 'wall s', 'k(wall)', 'calls', 'k(calls)',
+                               'threads', 'calls by action' ],
+                     floatfmt='.2f',
+                     missingval='-' )
+
+
+def main( args=None ):
+    parser = argparse.ArgumentParser( description=__doc__.split( '\n\n' )[ 0 ].strip( ) )
+    parser.add_argument( '--sizes', metavar='N', type=int, nargs='+', default=[ 1, 10, 100, 1000 ],
+                         help='The cluster sizes to benchmark.' )
+    parser.add_argument( '--latency', metavar='SECONDS', type=float, default=0.05,
+                         help='The time every fake API call takes.' )
+    parser.add_argument( '--boot-time', metavar='SECONDS', type=float, default=2.0,
+                         help='The time a fake instance spends in the pending state.' )
+    parser.add_argument( '--termination-time', metavar='SECONDS', type=float, default=2.0,
+                         help='The time a fake instance spends in the shutting-down state.' )
+    parser.add_argument( '--consistency-delay', metavar='SECONDS', type=float, default=1.0,
+                         help="The time during which a new fake instance can't be described or "
+                              "tagged." )
+    parser.add_argument( '--num-threads', metavar='NUM', type=int,
+                         help='Pass --num-threads to the cluster commands.' )
+    parser.add_argument( '--verbose', '-v', default=False, action='store_true',
+                         help="Show the commands' log output." )
+    options = parser.parse_args( args )
+
+    root_logger = CGCloud.setup_logging( )
+    if root_logger is not None and not options.verbose:
+        root_logger.setLevel( logging.WARN )
+
+    # Keep the transition times learned by the benchmark out of the user's cache and start out
+    # with the true ones so the polling schedules are as good as they get in real life.
+    cache_dir = tempfile.mkdtemp( prefix='cgcloud-bench.' )
+    atexit.register( shutil.rmtree, cache_dir, ignore_errors=True )
+    os.environ[ 'CGCLOUD_CACHE_DIR' ] = cache_dir
+    transition_times( ).times.update( {
+        'instance:pending>running': options.boot_time,
+        'instance:running>terminated': options.termination_time,
+        'instance:shutting-down>terminated': options.termination_time,
+        'instance:without-public-ip>with-public-ip': options.boot_time } )
+
+    aws = FakeAWS( region=Benchmark.zone[ :-1 ],
+                   latency=options.latency,
+                   boot_time=options.boot_time,
+                   termination_time=options.termination_time,
+                   consistency_delay=options.consistency_delay )
+    benchmark = Benchmark( aws, num_threads=options.num_threads )
+    print( report( benchmark.run( options.sizes ) ) )
+
+
+if __name__ == '__main__':
+    main( )
@@ -0,0 +1,285 @@
+import os
+import re
+import sys
+from base64 import b64encode
+from pipes import quote
+from uuid import uuid4
+
+from fabric.context_managers import settings, hide
+from fabric.operations import (run as real_run,
+                               _AttributeString,
+                               _prefix_commands,
+                               _prefix_env_vars,
+                               _shell_wrap,
+                               _sudo_prefix)
+from fabric.state import env, output
+from fabric.utils import error
+
+
+class BatchedCommand( object ):
+    """
+    A command recorded by remote_batch. Its result attribute is None until the batch was
+    executed and remains None if the batch was aborted before the command was run.
+    """
+
+    def __init__( self, which, command, real_command, quiet, warn_only, ok_ret_codes ):
+        super( BatchedCommand, self ).__init__( )
+        self.which = which
+        self.command = command
+        self.real_command = real_command
+        self.quiet = quiet
+        self.warn_only = warn_only
+        self.ok_ret_codes = ok_ret_codes
+        self.result = None
+
+
+# noinspection PyPep8Naming
+class remote_batch( object ):
+    """
+    A context manager that records remote commands and file uploads and, on exit, executes them
+    in order, as a single script, over a single SSH exec request. Fabric's run(), sudo() and put()
+    each take at least one round trip to the remote host, so batching long sequences of them
+    saves a lot of time on high-latency links.
+
+    The recording methods mirror Fabric's run(), sudo() and put() and respect the same settings,
+    like cd(), prefix(), warn_only and ok_ret_codes. The script stops at the first failing
+    command, unless that command was recorded with warn_only or quiet, and the failure is then
+    reported exactly like Fabric's run() or sudo() would report it, by aborting or warning.
+
+    The result of each command, a string with the same attributes as the return value of Fabric's
+    run(), is available after the batch via the `result` attribute of the BatchedCommand returned
+    by the method recording it. Since the script has no terminal attached, the commands are run
+    without a pty. Their output to stdout is printed after the batch completes, while their
+    output to stderr is printed as it occurs and isn't included in the results. Without a pty,
+    recorded sudo() commands fail on hosts whose sudoers configuration has requiretty in effect
+    for the current user, e.g. on CentOS 6 before CentosBox disables it for the admin account.
+
+    Commands are recorded, not executed, so their results can't be used to decide which
+    commands to record next. For the same reason, any other Fabric operation invoked inside the
+    `with` block is run immediately, before the recorded commands.
+
+    >>> with settings( host_string='localhost' ): # doctest: +SKIP
+    ...     with remote_batch( ) as batch:
+    ...         foo = batch.run( 'echo foo' )
+    ...         bar = batch.sudo( 'echo bar' )
+    [localhost] run: echo foo
+    [localhost] out: foo
+    [localhost] sudo: echo bar
+    [localhost] out: bar
+    >>> foo.result, bar.result.succeeded # doctest: +SKIP
+    ('foo', True)
+    """
+
+    # The maximum size of the script for a single exec request. Commands in excess of this limit
+    # are executed in additional requests. Linux limits the length of a single command line
+    # argument to 128 KiB and the base64 encoding inflates the script by a third.
+    max_script_size = 64 * 1024
+
+    def __init__( self ):
+        super( remote_batch, self ).__init__( )
+        self.commands = [ ]
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        if exc_type is None:
+            for commands in self.__chunks( ):
+                self.__execute( commands )
+        return False
+
+    def run( self, command, shell=True, quiet=False, warn_only=False ):
+        """
+        Record a command to be run as the current user.
+
+        :rtype: BatchedCommand
+        """
+        return self.__record( 'run', command, shell, quiet, warn_only, sudo_prefix=None )
+
+    def sudo( self, command, shell=True, user=None, group=None, sudo_args=None, quiet=False,
+              warn_only=False ):
+        """
+        Record a command to be run as the given user and group, root by default. Only
+        password-less sudo is supported, a password prompt makes the command fail.
+
+        :param sudo_args: additional arguments to sudo, see cgcloud.fabric.operations.sudo()
+
+        :rtype: BatchedCommand
+        """
+        sudo_prefix = env.sudo_prefix if sudo_args is None else '%s %s' % (env.sudo_prefix,
+                                                                          sudo_args)
+        with settings( sudo_prefix=sudo_prefix ):
+            sudo_prefix = _sudo_prefix( user, group )
+        return self.__record( 'sudo', command, shell, quiet, warn_only, sudo_prefix )
+
+    def put( self, local_path, remote_path, use_sudo=False, mirror_local_mode=False, mode=None,
+             append=False ):
+        """
+        Record the upload of a small file. The file is read right away and its content
+        embedded in the script. Unlike Fabric's put(), the remote path must be the path of a
+        file, not a directory, and the file's owner is only changed if it doesn't exist.
+
+        :param local_path: the path to a local file or a file-like object to read from, starting
+        at its current position
+
+        :param bool append: whether to append to the remote file instead of overwriting it
+
+        :rtype: BatchedCommand
+        """
+        if hasattr( local_path, 'read' ):
+            content = local_path.read( )
+            name = getattr( local_path, 'name', '<file obj>' )
+        else:
+            with open( local_path ) as f:
+                content = f.read( )
+            name = local_path
+            if mirror_local_mode and mode is None:
+                mode = os.stat( local_path ).st_mode & 07777
+        command = 'echo %s | base64 -d %s %s' % (b64encode( content ),
+                                                 '>>' if append else '>',
+                                                 quote( remote_path ))
+        if mode is not None:
+            command += ' && chmod %o %s' % (mode, quote( remote_path ))
+        sudo_prefix = _sudo_prefix( None ) if use_sudo else None
+        batched_command = self.__record( 'put', command, True, False, False, sudo_prefix )
+        batched_command.command = '%s -> %s' % (name, remote_path)
+        return batched_command
+
+    def __record( self, which, command, shell, quiet, warn_only, sudo_prefix ):
+        real_command = _shell_wrap( _prefix_commands( _prefix_env_vars( command ), 'remote' ),
+                                    shell_escape=True,
+                                    shell=shell,
+                                    sudo_prefix=sudo_prefix )
+        if len( real_command ) > self.max_script_size:
+            raise ValueError( "Command is too large to be batched: '%s'" % command[ :80 ] )
+        batched_command = BatchedCommand( which=which,
+                                          command=command,
+                                          real_command=real_command,
+                                          quiet=quiet,
+                                          warn_only=warn_only or quiet or env.warn_only,
+                                          ok_ret_codes=list( env.ok_ret_codes ) )
+        self.commands.append( batched_command )
+        return batched_command
+
+    def __chunks( self ):
+        """
+        Split the recorded commands into chunks that fit into a script each.
+        """
+        chunk, size = [ ], 0
+        for command in self.commands:
+            # Allow for the status reporting appended to each command
+            command_size = len( command.real_command ) + 256
+            if chunk and size + command_size > self.max_script_size:
+                yield chunk
+                chunk, size = [ ], 0
+            chunk.append( command )
+            size += command_size
+        if chunk:
+            yield chunk
+
+    def __execute( self, commands ):
+        marker = 'cgcloud-batch-' + uuid4( ).hex
+        script = _script( commands, marker )
+        # Bypass the login shell Fabric would wrap the command in, the script has one per command
+        with settings( hide( 'running', 'stdout', 'warnings' ), warn_only=True ):
+            out = real_run( 'bash -c "$(echo %s | base64 -d)" < /dev/null' % b64encode( script ),
+                            shell=False,
+                            pty=False )
+        executed = _parse( out, marker )
+        for i, status, stdout in executed:
+            command = commands[ i ]
+            command.result = result = _AttributeString( stdout )
+            result.command = command.command
+            result.real_command = command.real_command
+            result.return_code = status
+            result.succeeded = status in command.ok_ret_codes
+            result.failed = not result.succeeded
+            result.stderr = ''
+            _report( command )
+            if result.failed and not command.quiet:
+                message = '%s() received nonzero return code %s while executing' % (
+                    command.which, status)
+                if command.warn_only:
+                    message += " '%s'!" % command.command
+                else:
+                    message += '!\n\nRequested: %s\nExecuted: %s' % (
+                        command.command, command.real_command)
+                with settings( warn_only=command.warn_only ):
+                    error( message=message, stdout=result )
+            if result.failed and not command.warn_only:
+                return
+        if len( executed ) < len( commands ):
+            error( message='Batch of commands ended after %i of %i commands with return code %s'
+                           % (len( executed ), len( commands ), out.return_code),
+                   stdout=out,
+                   stderr=out.stderr )
+
+
+def _script( commands, marker ):
+    """
+    Return a shell script that runs the given commands, reporting the exit status of each on a
+    line by itself, starting with the given marker. The script stops after the first command
+    that fails and wasn't recorded with warn_only.
+
+    >>> import subprocess
+    >>> def run_script( *commands ):
+    ...     commands = [ BatchedCommand( which='run', command=command, real_command=command,
+    ...                                  quiet=False, warn_only=warn_only,
+    ...                                  ok_ret_codes=ok_ret_codes )
+    ...                  for command, warn_only, ok_ret_codes in commands ]
+    ...     script = _script( commands, 'M' )
+    ...     bash = subprocess.Popen( [ 'bash', '-c', script ], stdout=subprocess.PIPE )
+    ...     return _parse( bash.communicate( )[ 0 ], 'M' ), bash.returncode
+    >>> run_script( ('echo foo', False, [ 0 ]), ('echo bar', False, [ 0 ]) )
+    ([(0, 0, 'foo'), (1, 0, 'bar')], 0)
+
+    A failing command ends the script ...
+
+    >>> run_script( ('echo foo', False, [ 0 ]),
+    ...             ('(exit 3)', False, [ 0 ]),
+    ...             ('echo bar', False, [ 0 ]) )
+    ([(0, 0, 'foo'), (1, 3, '')], 1)
+
+    ... unless it was recorded with warn_only or its exit status is deemed ok:
+
+    >>> run_script( ('(exit 3)', True, [ 0 ]),
+    ...             ('(exit 3)', False, [ 0, 3 ]),
+    ...             ('echo bar', False, [ 0 ]) )
+    ([(0, 3, ''), (1, 3, ''), (2, 0, 'bar')], 0)
+    """
+    lines = [ ]
+    for i, command in enumerate( commands ):
+        lines.append( command.real_command )
+        lines.append( "s=$?; printf '\\n%s %i %%i\\n' $s" % (marker, i) )
+        if not command.warn_only:
+            ok_ret_codes = ' '.join( str( code ) for code in command.ok_ret_codes )
+            lines.append( 'case " %s " in *" $s "*) ;; *) exit 1 ;; esac' % ok_ret_codes )
+    return '\n'.join( lines ) + '\n'
+
+
+def _parse( stdout, marker ):
+    """
+    Split the output of a script made by _script() into the index, exit status and output of
+    each command that was run.
+
+    >>> _parse( 'M 0 0\\nfoo\\n\\nM 1 2\\n\\nM 2 0', 'M' )
+    [(0, 0, ''), (1, 2, 'foo'), (2, 0, '')]
+    >>> _parse( 'foo\\n\\nM 0 0\\nbar', 'M' )
+    [(0, 0, 'foo')]
+    """
+    parts = re.split( r'(?:^|\n)%s (\d+) (\d+)(?:\n|$)' % re.escape( marker ), stdout )
+    return [ (int( i ), int( status ), output.strip( ))
+             for output, i, status in zip( parts[ 0::3 ], parts[ 1::3 ], parts[ 2::3 ] ) ]
+
+
+def _report( command ):
+    """
+    Print the command and its output the way Fabric's run() and sudo() do.
+    """
+    if not command.quiet:
+        if output.running:
+            print( '[%s] %s: %s' % (env.host_string, command.which, command.command) )
+        if output.stdout and command.result:
+            for line in command.result.splitlines( ):
+                sys.stdout.write( '[%s] out: %s\n' % (env.host_string, line) )
+            sys.stdout.flush( )
@@ -0,0 +1,81 @@
+import logging
+import threading
+
+from fabric.network import join_host_strings
+from fabric.state import connections
+
+log = logging.getLogger( __name__ )
+
+# The interval in seconds at which keepalive packets are sent on idle SSH connections
+keepalive_interval = 30
+
+# Guards Fabric's connection cache and the per-host locks below. It is never held while
+# connecting so connections to different hosts are made concurrently.
+_lock = threading.RLock( )
+
+# Maps each connection key to the lock that serializes connecting to that host
+_host_locks = { }
+
+
+def ssh_client( user, host, connect, port=22 ):
+    """
+    Return a paramiko SSHClient connected to the given host as the given user. If a previous
+    invocation of this function or Fabric made such a connection and that connection is still
+    active, it will be reused. Otherwise the given function is invoked to make a new connection.
+    The new connection is entered into Fabric's connection cache such that Fabric operations on
+    the host will use it, too. Keepalive packets are sent on idle connections to prevent
+    firewalls from dropping them.
+
+    Concurrent invocations for the same host and user share a single connection, while those for
+    different hosts or users don't block each other.
+
+    The returned client should not be closed by the caller, use discard() instead.
+
+    :param callable connect: a function that takes no arguments and returns a connected
+    paramiko SSHClient
+
+    :rtype: paramiko.SSHClient
+    """
+    key = join_host_strings( user, host, port )
+    with _host_lock( key ):
+        with _lock:
+            # dict.get() avoids HostConnectionCache.__getitem__(), which would make a connection
+            client = connections.get( key )
+            if client is not None:
+                transport = client.get_transport( )
+                if transport is not None and transport.is_active( ):
+                    return client
+                log.info( 'SSH connection to %s is no longer active, reconnecting.', key )
+                _close( key )
+        client = connect( )
+        client.get_transport( ).set_keepalive( keepalive_interval )
+        with _lock:
+            connections[ key ] = client
+        return client
+
+
+def discard( user, host, port=22 ):
+    """
+    Close the connection to the given host as the given user, if there is one. The next call
+    to ssh_client() for the host will make a new connection.
+    """
+    key = join_host_strings( user, host, port )
+    with _host_lock( key ):
+        with _lock:
+            _close( key )
+
+
+def _host_lock( key ):
+    with _lock:
+        try:
+            return _host_locks[ key ]
+        except KeyError:
+            lock = _host_locks[ key ] = threading.RLock( )
+            return lock
+
+
+def _close( key ):
+    client = connections.get( key )
+    if client is not None:
+        del connections[ key ]
+        client.close( )
@@ -1,20 +1,25 @@
+import errno
 import os
 import sys
 import time
 from StringIO import StringIO
 from contextlib import contextmanager
-from fcntl import fcntl, F_GETFL, F_SETFL
 from pipes import quote
+from select import select
 from threading import Thread
 
 from bd2k.util.expando import Expando
 from bd2k.util.iterables import concat
 from bd2k.util.strings import interpolate as fmt
+from fabric.context_managers import settings
+from fabric.network import ssh
 from fabric.operations import sudo as real_sudo, get, put, run
 from fabric.state import env
 import fabric.io
 import fabric.operations
 
+from cgcloud.fabric.thread_local import isolate_threads, copy_settings
+
 
 def sudo( command, sudo_args=None, **kwargs ):
     """
@@ -122,7 +127,17 @@ def remote_open( remote_path, use_sudo=False ):
 # noinspection PyPep8Naming
 class remote_popen( object ):
     """
-    A context manager that yields a file handle and a
+    A context manager that runs the given command remotely and yields a file-like object whose
+    content is streamed to the command's stdin as it is being written. The command's stdin is
+    closed when the context is exited, after which the context waits for the command to finish.
+    The return value of run() is stored in the `result` attribute of the file-like object. If
+    the body of the `with` statement raises an exception, the command is terminated before its
+    stdin is closed.
+
+    Data written to the file-like object passes through a pipe, so memory use is independent of
+    the amount of data and writes block while the command isn't consuming its input. Each use
+    of this class has its own pipe and copy of Fabric's settings, so it can be used from several
+    threads concurrently.
 
     >>> from fabric.context_managers import hide, settings
     >>> with settings(host_string='localhost'):
@@ -151,39 +166,40 @@ class remote_popen( object ):
             kwargs[ 'pty' ] = False
         self.args = args
         self.kwargs = kwargs
-        # FIXME: Eliminate this buffer and have caller write directly into the pipe
-        self.stdin = StringIO( )
-        self.stdin.result = None
+        self.stdin = None
+        self.thread = None
+        self.exc_info = None
 
     def __enter__( self ):
-        return self.stdin
+        isolate_threads( )
+        read_fd, write_fd = os.pipe( )
+        source = _InputSource( read_fd )
+        self.stdin = _PipeWriter( write_fd, source )
+        adopt_settings = copy_settings( )
 
-    def __exit__( self, exc_type, exc_val, exc_tb ):
-        if exc_type is None:
-            _r, _w = os.pipe( )
-
-            def copy( ):
-                with os.fdopen( _w, 'w' ) as w:
-                    w.write( self.stdin.getvalue( ) )
-
-            t = Thread( target=copy )
-            t.start( )
+        def run_command( ):
             try:
-                _stdin = sys.stdin.fileno( )
-                _old_stdin = os.dup( _stdin )
-                os.close( _stdin )
-                assert _stdin == os.dup( _r )
-                # monkey-patch Fabric
-                _input_loop = fabric.operations.input_loop
-                fabric.operations.input_loop = input_loop
-                try:
+                adopt_settings( )
+                with settings( **{ _input_source_key: source } ):
                     self.stdin.result = self._run( )
-                finally:
-                    fabric.operations.input_loop = _input_loop
-                    os.close( _stdin )
-                    os.dup( _old_stdin )
+            except:
+                self.exc_info = sys.exc_info( )
             finally:
-                t.join( )
+                os.close( read_fd )
+
+        self.thread = Thread( target=run_command, name='remote_popen' )
+        self.thread.daemon = True
+        self.thread.start( )
+        return self.stdin
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        if exc_type is not None:
+            self.stdin.abort( )
+        self.stdin.close( )
+        self.thread.join( )
+        if exc_type is None and self.exc_info is not None:
+            exc_info, self.exc_info = self.exc_info, None
+            raise exc_info[ 0 ], exc_info[ 1 ], exc_info[ 2 ]
         return False
 
     def _run( self ):
@@ -193,41 +209,109 @@ class remote_popen( object ):
 # noinspection PyPep8Naming
 class remote_sudo_popen( remote_popen ):
     def _run( self ):
-        sudo( *self.args, **self.kwargs )
+        return sudo( *self.args, **self.kwargs )
 
 
-# Version of Fabric's input_loop that handles EOF on stdin and reads more greedily with
-# non-blocking mode.
+class _PipeWriter( object ):
+    """
+    The file-like object yielded by remote_popen, the write end of the pipe to the command.
+    """
 
-# TODO: We should open a ticket for this.
+    def __init__( self, fd, source ):
+        super( _PipeWriter, self ).__init__( )
+        self.fd = fd
+        self.source = source
+        self.result = None
+        self.closed = False
+        # Set when the command stopped consuming its input, e.g. because it exited
+        self.broken = False
+
+    def write( self, data ):
+        if self.closed:
+            raise ValueError( 'I/O operation on closed file' )
+        offset = 0
+        while offset < len( data ) and not self.broken:
+            try:
+                offset += os.write( self.fd, buffer( data, offset ) )
+            except OSError as e:
+                if e.errno == errno.EPIPE:
+                    # The command's exit status will tell what happened
+                    self.broken = True
+                else:
+                    raise
 
-from select import select
-from fabric.network import ssh
+    def writelines( self, lines ):
+        for line in lines:
+            self.write( line )
+
+    def flush( self ):
+        pass
+
+    def abort( self ):
+        """
+        Make the command terminate instead of reading EOF when this writer is closed.
+        """
+        self.source.aborted = True
+
+    def close( self ):
+        if not self.closed:
+            self.closed = True
+            os.close( self.fd )
+
+
+class _InputSource( object ):
+    """
+    The read end of the pipe from a remote_popen to the input_loop() feeding its command.
+    """
+
+    def __init__( self, fd ):
+        super( _InputSource, self ).__init__( )
+        self.fd = fd
+        self.aborted = False
+
+
+# The key under which the _InputSource of a remote_popen is placed into Fabric's settings
+_input_source_key = 'cgcloud_remote_popen_input'
+
+# The maximum number of seconds input_loop() blocks in select() before checking whether the
+# command exited without consuming all of its input
+input_loop_timeout = 1
+
+_fabric_input_loop = fabric.io.input_loop
 
 
 def input_loop( chan, using_pty ):
-    opts = fcntl( sys.stdin.fileno( ), F_GETFL )
-    fcntl( sys.stdin.fileno( ), F_SETFL, opts | os.O_NONBLOCK )
-    try:
-        while not chan.exit_status_ready( ):
-            r, w, x = select( [ sys.stdin ], [ ], [ ], 0.0 )
-            have_char = (r and r[ 0 ] == sys.stdin)
-            if have_char and chan.input_enabled:
-                # Send all local stdin to remote end's stdin
-                bytes = sys.stdin.read( )
-                if bytes is None:
-                    pass
-                elif not bytes:
-                    chan.shutdown_write( )
-                    break
-                else:
-                    chan.sendall( bytes )
-                    # Optionally echo locally, if needed.
-                    if not using_pty and env.echo_stdin:
-                        # Not using fastprint() here -- it prints as 'user'
-                        # output level, don't want it to be accidentally hidden
-                        sys.stdout.write( bytes )
-                        sys.stdout.flush( )
+    """
+    A replacement for Fabric's input_loop() that sends the input of a remote_popen to the
+    command's channel. It blocks until the input is readable instead of polling for it,
+    and it handles EOF on the input by closing the channel for writing. Commands that are not run
+    by remote_popen get Fabric's input_loop(), which reads from sys.stdin.
+    """
+    source = env.get( _input_source_key )
+    if source is None:
+        return _fabric_input_loop( chan, using_pty )
+    while not chan.exit_status_ready( ):
+        if not chan.input_enabled:
+            # Fabric is answering a sudo password prompt on the channel
             time.sleep( ssh.io_sleep )
-    finally:
-        fcntl( sys.stdin.fileno( ), F_SETFL, opts )
+            continue
+        readable, _, _ = select( [ source.fd ], [ ], [ ], input_loop_timeout )
+        if readable:
+            data = os.read( source.fd, 65536 )
+            if data:
+                chan.sendall( data )
+                # Optionally echo locally, if needed.
+                if not using_pty and env.echo_stdin:
+                    # Not using fastprint() here -- it prints as 'user'
+                    # output level, don't want it to be accidentally hidden
+                    sys.stdout.write( data )
+                    sys.stdout.flush( )
+            elif source.aborted:
+                chan.close( )
+                break
+            else:
+                chan.shutdown_write( )
+                break
+
+
+fabric.operations.input_loop = input_loop
@@ -0,0 +1,201 @@
+"""
+Makes Fabric's global state thread-local such that Fabric tasks can run concurrently in
+multiple threads, as long as each thread operates on a different host.
+
+Fabric 1.x keeps its settings in the module-level dictionaries fabric.state.env and
+fabric.state.output. Since other Fabric modules and cgcloud code hold references to these
+objects, they can't be replaced. Instead, isolate_threads() changes their class to one that
+redirects every access to a per-thread copy of the dictionary. A thread's copy is made from the
+original contents on the thread's first access. Threads started by Fabric itself, e.g. to
+pump the output of a remote command, share the copy of the thread that started them.
+"""
+import threading
+
+import fabric.state
+import fabric.thread_handling
+
+_lock = threading.Lock( )
+
+_isolated = [ ]
+
+
+class _ThreadLocalDict( dict ):
+    """
+    A mixin for dict subclasses that redirects all item access to a per-thread dictionary.
+    Mixed in after the subclass such that the latter's overrides of dict methods, like
+    alias expansion in Fabric's _AliasDict.__setitem__, keep working.
+    """
+
+    def _data( self ):
+        local = self.__dict__[ '_local' ]
+        try:
+            return local.data
+        except AttributeError:
+            data = local.data = dict( dict.iteritems( self ) )
+            return data
+
+    def _adopt( self, data ):
+        self.__dict__[ '_local' ].data = data
+
+    def __getitem__( self, key ):
+        return self._data( )[ key ]
+
+    def __setitem__( self, key, value ):
+        self._data( )[ key ] = value
+
+    def __delitem__( self, key ):
+        del self._data( )[ key ]
+
+    def __contains__( self, key ):
+        return key in self._data( )
+
+    def __iter__( self ):
+        return iter( self._data( ) )
+
+    def __len__( self ):
+        return len( self._data( ) )
+
+    def __repr__( self ):
+        return repr( self._data( ) )
+
+    def __eq__( self, other ):
+        return self._data( ) == other
+
+    def __ne__( self, other ):
+        return self._data( ) != other
+
+    def has_key( self, key ):
+        return key in self._data( )
+
+    def get( self, key, default=None ):
+        return self._data( ).get( key, default )
+
+    def keys( self ):
+        return self._data( ).keys( )
+
+    def values( self ):
+        return self._data( ).values( )
+
+    def items( self ):
+        return self._data( ).items( )
+
+    def iterkeys( self ):
+        return self._data( ).iterkeys( )
+
+    def itervalues( self ):
+        return self._data( ).itervalues( )
+
+    def iteritems( self ):
+        return self._data( ).iteritems( )
+
+    def update( self, *args, **kwargs ):
+        # Go through __setitem__ so subclass overrides apply
+        for key, value in dict( *args, **kwargs ).iteritems( ):
+            self[ key ] = value
+
+    def setdefault( self, key, default=None ):
+        if key not in self:
+            self[ key ] = default
+        return self[ key ]
+
+    def pop( self, key, *default ):
+        return self._data( ).pop( key, *default )
+
+    def popitem( self ):
+        return self._data( ).popitem( )
+
+    def clear( self ):
+        self._data( ).clear( )
+
+    def copy( self ):
+        return self._data( ).copy( )
+
+
+def _isolate( obj ):
+    cls = type( obj )
+    obj.__dict__[ '_local' ] = threading.local( )
+    # Fabric's _AttributeDict turns attribute assignments into item assignments
+    object.__setattr__( obj, '__class__',
+                        type( 'ThreadLocal' + cls.__name__, (cls, _ThreadLocalDict), { } ) )
+    _isolated.append( obj )
+
+
+def _thread_handler_init( init ):
+    """
+    Wrap ThreadHandler.__init__ such that the threads it starts share the per-thread state of
+    the thread starting them.
+    """
+
+    def wrapper( self, name, callable, *args, **kwargs ):
+        # noinspection PyProtectedMember
+        states = [ (obj, obj._data( )) for obj in _isolated ]
+
+        def inherit( *args, **kwargs ):
+            for obj, data in states:
+                obj._adopt( data )
+            return callable( *args, **kwargs )
+
+        init( self, name, inherit, *args, **kwargs )
+
+    return wrapper
+
+
+def isolate_threads( ):
+    """
+    Make Fabric's env and output settings thread-local. Idempotent.
+
+    >>> isolate_threads( )
+    >>> from fabric.state import env
+    >>> from fabric.context_managers import settings
+    >>> seen = { }
+    >>> def task( host ):
+    ...     with settings( host_string=host ):
+    ...         start.wait( )
+    ...         seen[ host ] = env.host_string
+    >>> start = threading.Event( )
+    >>> threads = [ threading.Thread( target=task, args=( h, ) ) for h in ( 'a', 'b' ) ]
+    >>> for t in threads: t.start( )
+    >>> start.set( )
+    >>> for t in threads: t.join( )
+    >>> sorted( seen.items( ) ), env.host_string
+    ([('a', 'a'), ('b', 'b')], None)
+    """
+    with _lock:
+        if not _isolated:
+            _isolate( fabric.state.env )
+            _isolate( fabric.state.output )
+            handler = fabric.thread_handling.ThreadHandler
+            handler.__init__ = _thread_handler_init( handler.__init__ )
+
+
+def copy_settings( ):
+    """
+    Return a function that, when invoked in another thread, gives that thread a copy of the
+    calling thread's current Fabric settings. Unlike threads started by Fabric, which share the
+    settings of the thread starting them, the other thread can then change its settings without
+    affecting the calling thread.
+
+    >>> isolate_threads( )
+    >>> from fabric.state import env
+    >>> from fabric.context_managers import settings
+    >>> seen = [ ]
+    >>> def task( ):
+    ...     adopt( )
+    ...     seen.append( env.host_string )
+    ...     env.host_string = 'b'
+    >>> with settings( host_string='a' ):
+    ...     adopt = copy_settings( )
+    ...     thread = threading.Thread( target=task )
+    ...     thread.start( )
+    ...     thread.join( )
+    ...     seen, env.host_string
+    (['a'], 'a')
+    """
+    # noinspection PyProtectedMember
+    states = [ (obj, obj._data( ).copy( )) for obj in _isolated ]
+
+    def adopt( ):
+        for obj, data in states:
+            obj._adopt( data )
+
+    return adopt
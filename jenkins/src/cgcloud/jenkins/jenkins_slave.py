@@ -1,6 +1,7 @@
 from bd2k.util.xml.builder import E
 from cgcloud.core.agent_box import AgentBox
 from cgcloud.lib.util import snake_to_camel, UserError
+from cgcloud.fabric.batch import remote_batch
 from cgcloud.fabric.operations import sudo
 from cgcloud.core.box import fabric_task
 from cgcloud.core.source_control_client import SourceControlClient
@@ -55,31 +56,32 @@ class JenkinsSlave( SourceControlClient, AgentBox ):
         #
         sudo( 'useradd -m -s /bin/bash {0}'.format( Jenkins.user ) )
         self._propagate_authorized_keys( Jenkins.user )
-
-        # Ensure that jenkins@jenkins-master can log into this box as the build user
-        #
-        sudo( "echo '{pubkey}' >> ~/.ssh/authorized_keys".format( **kwargs ),
-              user=Jenkins.user,
-              sudo_args='-i' )
-
         self.setup_repo_host_keys( user=Jenkins.user )
 
-        # Setup working directory for all builds in either the build user's home or as a symlink to
-        # the ephemeral volume if available. Remember, the ephemeral volume comes back empty every
-        # time the box starts.
-        #
-        if sudo( 'test -d {ephemeral}'.format( **kwargs ), quiet=True ).failed:
-            sudo( 'mkdir {ephemeral}'.format( **kwargs ) )
         chown_cmd = "mount {ephemeral} || true ; chown -R {user}:{user} {ephemeral}".format(
                 **kwargs )
-        # chown ephemeral storage now ...
-        sudo( chown_cmd )
+
+        with remote_batch( ) as batch:
+            # Ensure that jenkins@jenkins-master can log into this box as the build user
+            #
+            batch.sudo( "echo '{pubkey}' >> ~/.ssh/authorized_keys".format( **kwargs ),
+                        user=Jenkins.user,
+                        sudo_args='-i' )
+
+            # Setup working directory for all builds in either the build user's home or as a
+            # symlink to the ephemeral volume if available. Remember, the ephemeral volume comes
+            # back empty every time the box starts.
+            #
+            batch.sudo( 'test -d {ephemeral} || mkdir {ephemeral}'.format( **kwargs ) )
+            # chown ephemeral storage now ...
+            batch.sudo( chown_cmd )
+            # link build directory as symlink to ephemeral volume
+            batch.sudo( 'ln -snf {ephemeral} {dir}'.format( **kwargs ),
+                        user=Jenkins.user,
+                        sudo_args='-i' )
+
         # ... and every time instance boots. Note that command must work when set -e is in effect.
         self._register_init_command( chown_cmd )
-        # link build directory as symlink to ephemeral volume
-        sudo( 'ln -snf {ephemeral} {dir}'.format( **kwargs ),
-              user=Jenkins.user,
-              sudo_args='-i' )
 
     def __jenkins_labels( self ):
         labels = self.role( ).split( '-' )
@@ -16,6 +16,8 @@ setup(
     package_dir={ '': 'src' },
     packages=find_packages( 'src' ),
     namespace_packages=[ 'cgcloud' ],
+    package_data={
+        'cgcloud.lib': [ 'instance_types.json' ] },
     install_requires=[
         bd2k_python_lib_dep,
         boto_dep ] )
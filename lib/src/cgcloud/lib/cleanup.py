@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+from collections import Counter
+
+from bd2k.util.expando import Expando
+
+from cgcloud.lib.governor import aws_governor
+from cgcloud.lib.util import thread_pool
+
+log = logging.getLogger( __name__ )
+
+
+class Cleanup( object ):
+    """
+    Deletes AWS resources in stages. The stages are run one after the other, so the resources
+    deleted in one stage, e.g. instance profiles, are gone before the next stage deletes the
+    resources they depend on, e.g. the roles in those profiles. Within a stage, resources are
+    deleted by a bounded pool of threads while they are still being listed. Requests are subject
+    to the process-wide rate limit imposed by the governor in cgcloud.lib.governor. Failure to
+    delete a resource is logged and doesn't prevent the deletion of other resources.
+
+    In a dry run, resources are listed and counted but not deleted and the report for each stage
+    includes an estimate of how long the deletion would take.
+
+    >>> deleted = [ ]
+    >>> def delete( snapshot_id ):
+    ...     if snapshot_id == 'snap-3': raise RuntimeError( 'in use' )
+    ...     deleted.append( snapshot_id )
+    >>> snapshot_ids = [ 'snap-%i' % i for i in range( 5 ) ]
+    >>> cleanup = Cleanup( num_threads=2, max_rate=10 )
+    >>> r = cleanup.stage( 'snapshot', iter( snapshot_ids ), delete,
+    ...                    actions=lambda _: [ 'ec2:DeleteSnapshot' ] )
+    >>> r.kind, r.count, r.failed, r.calls
+    ('snapshot', 5, 1, Counter({'ec2:DeleteSnapshot': 5}))
+    >>> sorted( deleted )
+    ['snap-0', 'snap-1', 'snap-2', 'snap-4']
+
+    The estimate is bounded by the rate limit for each action and by the number of threads:
+
+    >>> cleanup = Cleanup( num_threads=2, max_rate=10, dry_run=True )
+    >>> r = cleanup.stage( 'snapshot', snapshot_ids * 20, delete,
+    ...                    actions=lambda _: [ 'ec2:DeleteSnapshot' ] )
+    >>> r.count, r.failed, r.estimated_time, len( deleted )
+    (100, 0, 10.0, 4)
+    >>> cleanup = Cleanup( num_threads=1, max_rate=10, dry_run=True )
+    >>> r = cleanup.stage( 'role', [ 'foo', 'bar' ], delete,
+    ...                    actions=lambda _: [ 'iam:ListRolePolicies', 'iam:DeleteRole' ] )
+    >>> r.estimated_time == 4 * Cleanup.assumed_latency
+    True
+    """
+
+    # The number of seconds a single request is assumed to take when estimating the time
+    # needed for deleting resources
+    assumed_latency = 0.2
+
+    def __init__( self, num_threads=None, max_rate=None, dry_run=False ):
+        """
+        :param int num_threads: the maximum number of resources to delete concurrently
+
+        :param float max_rate: the maximum rate in requests per second for each API action,
+        used for estimating the time needed to delete resources. The actual rate is controlled by
+        the governor. The default is the governor's current maximum rate.
+
+        :param bool dry_run: if True, resources will only be counted, not deleted
+        """
+        super( Cleanup, self ).__init__( )
+        self.num_threads = num_threads or 10
+        self.max_rate = float( max_rate or aws_governor( ).max_rate )
+        self.dry_run = dry_run
+
+    def stage( self, kind, resources, delete, actions, name=str ):
+        """
+        Delete the given resources and return a report about their deletion, once all of them
+        have been dealt with.
+
+        :param str kind: the kind of resources, e.g. 'snapshot'
+
+        :param collections.Iterable resources: the resources to delete, possibly a generator
+        that pages through a listing
+
+        :param callable delete: a function that deletes the resource passed to it
+
+        :param callable actions: a function that returns a list of the API actions needed to
+        delete the resource passed to it, e.g. [ 'ec2:DeleteSnapshot' ]
+
+        :param callable name: a function that returns the name of the resource passed to it,
+        for logging
+
+        :return: an object with the attributes kind, count (the number of resources),
+        failed (the number of resources that couldn't be deleted), calls (a Counter of
+        the API actions by name), estimated_time and time (the time, in seconds, that the
+        deletion is estimated to take or took, respectively)
+        """
+        start = time.time( )
+        calls = Counter( )
+        failed = [ 0 ]
+        count = 0
+        if self.dry_run:
+            for resource in resources:
+                count += 1
+                calls.update( actions( resource ) )
+        else:
+            lock = threading.Lock( )
+            # Don't let the listing get too far ahead of the deletion
+            pending = threading.BoundedSemaphore( 2 * self.num_threads )
+
+            def delete_one( resource ):
+                try:
+                    log.info( 'Deleting %s %s', kind, name( resource ) )
+                    delete( resource )
+                except:
+                    log.warn( "Failed to remove %s '%s'", kind, name( resource ), exc_info=True )
+                    with lock:
+                        failed[ 0 ] += 1
+                finally:
+                    pending.release( )
+
+            with thread_pool( self.num_threads ) as pool:
+                for resource in resources:
+                    count += 1
+                    calls.update( actions( resource ) )
+                    pending.acquire( )
+                    pool.apply_async( delete_one, [ resource ] )
+        return Expando( kind=kind,
+                        count=count,
+                        failed=failed[ 0 ],
+                        calls=calls,
+                        estimated_time=self.estimate( calls ),
+                        time=None if self.dry_run else time.time( ) - start )
+
+    def estimate( self, calls ):
+        """
+        Estimate the number of seconds it takes to make the given numbers of requests, given that
+        each action is subject to its own rate limit and that at most num_threads requests are
+        made concurrently.
+
+        :param Counter calls: the number of requests by API action
+        """
+        if not calls:
+            return 0.0
+        by_rate = max( calls.itervalues( ) ) / self.max_rate
+        by_latency = sum( calls.itervalues( ) ) * self.assumed_latency / self.num_threads
+        return max( by_rate, by_latency )
@@ -0,0 +1,99 @@
+import threading
+
+
+class ConnectionPool( object ):
+    """
+    Hands out boto connections such that each live thread asking the pool for a connection to
+    a service gets one that the pool hands to no other live thread. Each thread gets its own
+    connection to a service the first time it asks for one and keeps getting that connection
+    for as long as it lives. Once a thread dies, its connections are handed to the next thread
+    that needs a connection to the same service, so the number of connections is bounded by the
+    peak number of threads talking to a service concurrently, not by the total number of threads
+    ever started. Each boto connection keeps its HTTP connections alive between requests.
+
+    The pool only controls which connection a thread gets from it. Boto resource objects, like
+    instances, volumes or spot requests, remember the connection they were fetched with and use
+    it for their own requests, e.g. Instance.update(). A thread using an object fetched by
+    another thread, or by a dead thread whose connection was handed on, therefore shares a
+    connection with that thread. Boto draws the HTTP connections for each request from a locked,
+    per-connection pool so this is safe, but such requests don't benefit from the pool.
+
+    >>> made, closed = [ ], [ ]
+    >>> class FauxConnection( object ):
+    ...     def __init__( self, service ): made.append( service ); self.service = service
+    ...     def close( self ): closed.append( self.service )
+    >>> pool = ConnectionPool( FauxConnection )
+    >>> pool.get( 'iam' ) is pool.get( 'iam' ), pool.get( 'iam' ) is pool.get( 'ec2' )
+    (True, False)
+    >>> def run( target ):
+    ...     t = threading.Thread( target=target )
+    ...     t.start( ); t.join( )
+
+    The second thread reuses the connection of the first one:
+
+    >>> run( lambda: pool.get( 'iam' ) ); run( lambda: pool.get( 'iam' ) )
+    >>> pool.size( ), pool.size( 'iam' ), made
+    (3, 2, ['iam', 'ec2', 'iam'])
+    >>> pool.close( )
+    >>> pool.size( ), sorted( closed )
+    (0, ['ec2', 'iam', 'iam'])
+    """
+
+    def __init__( self, connect ):
+        """
+        :param connect: a callable that takes the name of a service, e.g. 'ec2', and returns a
+        new connection to that service
+        """
+        super( ConnectionPool, self ).__init__( )
+        self.connect = connect
+        self.lock = threading.Lock( )
+        self.local = threading.local( )
+        # For every connection handed out, a list containing the thread it was handed to, the
+        # service and the connection itself
+        self.entries = [ ]
+
+    def get( self, service ):
+        """
+        Return the current thread's connection to the given service, creating it if necessary.
+        """
+        try:
+            connections = self.local.connections
+        except AttributeError:
+            connections = self.local.connections = { }
+        try:
+            return connections[ service ]
+        except KeyError:
+            pass
+        thread = threading.current_thread( )
+        with self.lock:
+            for entry in self.entries:
+                owner, entry_service, connection = entry
+                if entry_service == service and not owner.is_alive( ):
+                    entry[ 0 ] = thread
+                    break
+            else:
+                connection = None
+        if connection is None:
+            connection = self.connect( service )
+            with self.lock:
+                self.entries.append( [ thread, service, connection ] )
+        connections[ service ] = connection
+        return connection
+
+    def size( self, service=None ):
+        """
+        Return the number of connections in this pool, optionally only those to the given service.
+        """
+        with self.lock:
+            return sum( 1 for _, s, _ in self.entries if service is None or s == service )
+
+    def close( self ):
+        """
+        Close all connections in this pool. Threads asking for a connection after this method
+        was invoked will get a new one.
+        """
+        with self.lock:
+            entries, self.entries = self.entries, [ ]
+            self.local = threading.local( )
+        for _, service, connection in entries:
+            connection.close( )
@@ -1,6 +1,6 @@
 # coding=utf-8
+import functools
 import hashlib
-from contextlib import contextmanager
 import json
 import os
 import urllib
@@ -19,16 +19,66 @@ from boto.sns.connection import SNSConnection
 from boto.vpc import VPCConnection
 from boto.iam.connection import IAMConnection
 from boto.ec2.keypair import KeyPair
+from boto.ec2.snapshot import Snapshot
 from bd2k.util import fnmatch
 from bd2k.util import memoize
 from boto.utils import get_instance_metadata
 
+from cgcloud.lib.cleanup import Cleanup
+from cgcloud.lib.connection_pool import ConnectionPool
+from cgcloud.lib.governor import aws_governor
+from cgcloud.lib.identity_cache import identity_cache
 from cgcloud.lib.message import Message
-from cgcloud.lib.util import ec2_keypair_fingerprint, UserError
+from cgcloud.lib.metering import aws_meter
+from cgcloud.lib.paging import iam_pager, ec2_pager
+from cgcloud.lib.ssh_pubkey_cache import ssh_pubkey_cache
+from cgcloud.lib.util import ec2_keypair_fingerprint, UserError, pmap
 
 log = logging.getLogger( __name__ )
 
 
+def glob_matcher( globs ):
+    """
+    Compile the given list of fnmatch-style globs into a function that takes a name and returns
+    the index of the first glob in the list that matches the name or None if no glob matches.
+    Globs without wildcards are looked up by name, the others are combined into a single
+    regular expression, so the cost of matching a name is independent of the number of globs.
+
+    >>> match = glob_matcher( [ 'bob', 'a*', 'alice', 'c?', 'd[0-9]' ] )
+    >>> map( match, [ 'bob', 'alice', 'amy', 'cy', 'carl', 'd1', 'dx', 'a/b' ] )
+    [0, 1, 1, 3, None, 4, None, None]
+    >>> glob_matcher( [ ] )( 'bob' ) is None
+    True
+    """
+    literals = { }
+    patterns = [ ]
+    for i, glob in enumerate( globs ):
+        if any( c in glob for c in '*?[' ):
+            pattern = fnmatch.translate( glob )
+            suffix = r'\Z(?ms)'
+            assert pattern.endswith( suffix )
+            patterns.append( (i, pattern[ :-len( suffix ) ]) )
+        else:
+            literals.setdefault( glob, i )
+    if patterns:
+        regex = re.compile( '(?ms)(?:%s)\\Z' % '|'.join( '(%s)' % p for _, p in patterns ) )
+    else:
+        regex = None
+
+    def match( name ):
+        i = literals.get( name )
+        if regex is not None:
+            m = regex.match( name )
+            if m is not None:
+                # Of the alternatives that match, the regular expression engine picks the first
+                j = patterns[ m.lastindex - 1 ][ 0 ]
+                if i is None or j < i:
+                    i = j
+        return i
+
+    return match
+
+
 class Context( object ):
     """
     Encapsulates all EC2-specific settings used by components in this project
@@ -123,11 +173,7 @@ class Context( object ):
         """
         super( Context, self ).__init__( )
 
-        self.__iam = None
-        self.__vpc = None
-        self.__s3 = None
-        self.__sns = None
-        self.__sqs = None
+        self.__connections = ConnectionPool( self.__connect )
 
         self.availability_zone = availability_zone
         m = self.availability_zone_re.match( availability_zone )
@@ -149,15 +195,18 @@ class Context( object ):
             raise ValueError( "Invalid namespace '%s'" % namespace )
 
         self.namespace = namespace
+        # The transliteration is done character by character so the AWS names of all resources
+        # in the namespace start with the transliterated namespace.
+        self.__aws_namespace_prefix = self.to_aws_name( namespace )
+
+    # Each thread gets its own connection to each service, see ConnectionPool
 
     @property
     def iam( self ):
         """
         :rtype: IAMConnection
         """
-        if self.__iam is None:
-            self.__iam = self.__aws_connect( iam, 'universal' )
-        return self.__iam
+        return self.__connections.get( 'iam' )
 
     # VPCConnection extends EC2Connection so we can use one instance of the former for both 
 
@@ -166,9 +215,7 @@ class Context( object ):
         """
         :rtype: VPCConnection
         """
-        if self.__vpc is None:
-            self.__vpc = self.__aws_connect( vpc )
-        return self.__vpc
+        return self.__connections.get( 'vpc' )
 
     # ec2 = vpc works, too, but confuses the type hinter in PyCharm
 
@@ -184,30 +231,47 @@ class Context( object ):
         """
         :rtype: S3Connection
         """
-        if self.__s3 is None:
-            # We let S3 route buckets to regions for us. If we connected to a specific region,
-            # bucket lookups (HEAD request against bucket URL) would fail with 301 status but
-            # without a Location header.
-            self.__s3 = S3Connection( )
-        return self.__s3
+        return self.__connections.get( 's3' )
 
     @property
     def sns( self ):
         """
         :rtype: SNSConnection
         """
-        if self.__sns is None:
-            self.__sns = self.__aws_connect( sns )
-        return self.__sns
+        return self.__connections.get( 'sns' )
 
     @property
     def sqs( self ):
         """
         :rtype: SQSConnection
         """
-        if self.__sqs is None:
-            self.__sqs = self.__aws_connect( sqs )
-        return self.__sqs
+        return self.__connections.get( 'sqs' )
+
+    def connection_pool_size( self, service=None ):
+        """
+        Return the number of connections this context has made, optionally only those to the
+        given service, e.g. 'vpc' or 'iam'.
+        """
+        return self.__connections.size( service )
+
+    def __connect( self, service ):
+        if service == 'iam':
+            return self.__aws_connect( iam, 'universal' )
+        elif service == 's3':
+            # We let S3 route buckets to regions for us. If we connected to a specific region,
+            # bucket lookups (HEAD request against bucket URL) would fail with 301 status but
+            # without a Location header.
+            return self.__instrument( S3Connection( ), 's3' )
+        else:
+            return self.__aws_connect( dict( vpc=vpc, sns=sns, sqs=sqs )[ service ] )
+
+    def connect_ec2( self, region ):
+        """
+        Return a new connection to EC2 in the given region, e.g. for copying images to another
+        region. Unlike the connection returned by the ec2 property, this connection is not
+        pooled. The caller should close it when done with it.
+        """
+        return self.__aws_connect( vpc, region )
 
     def __aws_connect( self, aws_module, region=None, **kwargs ):
         if region is None:
@@ -216,6 +280,15 @@ class Context( object ):
         if conn is None:
             raise RuntimeError( "%s couldn't connect to region %s" % (
                 aws_module.__name__, region) )
+        return self.__instrument( conn, aws_module.__name__.split( '.' )[ -1 ] )
+
+    @staticmethod
+    def __instrument( conn, service ):
+        conn = aws_governor( ).install( conn, service )
+        meter = aws_meter( )
+        if meter.enabled:
+            # Install the meter on top of the governor so latencies include throttling delays
+            conn = meter.install( conn, service )
         return conn
 
     def __enter__( self ):
@@ -225,11 +298,8 @@ class Context( object ):
         self.close( )
 
     def close( self ):
-        if self.__vpc is not None: self.__vpc.close( )
-        if self.__s3 is not None: self.__s3.close( )
-        if self.__iam is not None: self.__iam.close( )
-        if self.__sns is not None: self.__sns.close( )
-        if self.__sqs is not None: self.__sqs.close( )
+        log.debug( 'Closing %i connection(s) to AWS.', self.__connections.size( ) )
+        self.__connections.close( )
 
     @staticmethod
     def is_absolute_name( name ):
@@ -450,21 +520,50 @@ class Context( object ):
         return self.contains_name( self.from_aws_name( aws_name ) )
 
     def try_contains_aws_name( self, aws_name ):
+        """
+        Like contains_aws_name() but returns False instead of raising an exception if the given
+        name is invalid. Names that can't be in the namespace are ruled out without decoding
+        them, which makes filtering large listings cheap.
+
+        >>> ctx = Context( 'us-west-1b', namespace='/this_ns/' )
+        >>> map( ctx.try_contains_aws_name, [ 'this__ns_foo', 'this__ns__foo', 'other_foo', '_' ] )
+        [True, False, False, False]
+        """
+        if not aws_name.startswith( self.__aws_namespace_prefix ):
+            return False
         try:
             return self.contains_aws_name( aws_name )
         except self.InvalidPathError:
             return False
 
+    def _cached( self, name, lookup, ttl=None ):
+        """
+        Return the value of the named fact about the credentials used by this context, looking
+        it up by invoking the given callable unless the persistent identity cache has a current
+        value for it.
+        """
+        return identity_cache( ).get( self.iam.aws_access_key_id, self.region, name, lookup,
+                                      ttl=ttl )
+
+    def _peek_cached( self, name, ttl=None ):
+        return identity_cache( ).peek( self.iam.aws_access_key_id, self.region, name, ttl=ttl )
+
+    def _put_cached( self, name, value ):
+        identity_cache( ).put( self.iam.aws_access_key_id, self.region, name, value )
+
     @property
     @memoize
     def account( self ):
-        try:
-            arn = self.iam.get_user( ).arn
-        except:
-            # Agent boxes run with IAM role credentials instead of user credentials.
-            arn = get_instance_metadata( )[ 'iam' ][ 'info' ][ 'InstanceProfileArn' ]
-        _, partition, service, region, account, resource = arn.split( ':', 6 )
-        return account
+        def lookup( ):
+            try:
+                arn = self.iam.get_user( ).arn
+            except:
+                # Agent boxes run with IAM role credentials instead of user credentials.
+                arn = get_instance_metadata( )[ 'iam' ][ 'info' ][ 'InstanceProfileArn' ]
+            _, partition, service, region, account, resource = arn.split( ':', 6 )
+            return account
+
+        return self._cached( 'account', lookup )
 
     @property
     @memoize
@@ -531,46 +630,118 @@ class Context( object ):
         self.__publish_key_update_agent_message( )
         return ec2_keypair
 
+    # The number of seconds for which the members of an IAM group and the existence of an IAM
+    # user are remembered when expanding key pair globs
+    iam_glob_cache_ttl = 5 * 60
+
+    # The maximum number of values in an EC2 request filter
+    max_filter_values = 200
+
     def expand_keypair_globs( self, globs ):
         """
         Returns a list of EC2 key pair objects matching the specified globs. The order of the
         objects in the returned list will be consistent with the order of the globs and it will
         not contain any elements more than once. In other words, the returned list will start
         with all key pairs matching the first glob, followed by key pairs matching the second
-        glob but not the first glob and so on.
+        glob but not the first glob and so on. Key pairs matching the same glob are ordered by
+        name.
+
+        This method is invoked by the agent on every box whenever it polls for key updates so
+        it is designed to make one DescribeKeyPairs request and nothing else in the common case:
+        the results of the IAM lookups for globs starting in '@' are cached for
+        iam_glob_cache_ttl seconds, globs that the EC2 API can evaluate are passed along as a
+        filter such that only the key pairs of interest are returned and the globs are compiled
+        into a single matcher.
+
+        >>> from cgcloud.lib.test.fake_aws import FakeAWS
+        >>> aws = FakeAWS( 'us-west-2', latency=0 )
+        >>> aws.add_key_pairs( 'alice', 'amy', 'bob', 'jenkins/master' )
+        >>> with aws.patch_context( ):
+        ...     ctx = Context( 'us-west-2a', namespace='/' )
+        ...     [ k.name for k in ctx.expand_keypair_globs( [ 'bob', 'a*', 'alice', '*' ] ) ]
+        ['bob', 'alice', 'amy', 'bench']
+        >>> aws.calls.items( )
+        [('ec2:DescribeKeyPairs', 1)]
 
         :rtype: list of KeyPair
         """
 
         def iam_lookup( glob ):
             if glob.startswith( '@@' ):
-                return (_.user_name for _ in self.iam.get_group( 'developers' ).users)
+                return self._cached( 'iam_group_members:developers',
+                                     lambda: [ _.user_name
+                                         for _ in self.iam.get_group( 'developers' ).users ],
+                                     ttl=self.iam_glob_cache_ttl )
             elif glob.startswith( '@' ):
-                return (self.iam.get_user( glob[ 1: ] ).user_name,)
+                user_name = glob[ 1: ]
+                return (self._cached( 'iam_user:' + user_name,
+                                      lambda: self.iam.get_user( user_name ).user_name,
+                                      ttl=self.iam_glob_cache_ttl ),)
             else:
                 return (glob,)
 
-        globs = itertools.chain.from_iterable( map( iam_lookup, globs ) )
+        globs = list( itertools.chain.from_iterable( map( iam_lookup, globs ) ) )
+        if not globs:
+            return [ ]
+        match = glob_matcher( globs )
+        # EC2 interprets '*' and '?' like fnmatch does, except that its '*' also matches '/' so
+        # the filter may let through a superset of the matching key pairs, which is fine. EC2
+        # doesn't support character classes and limits the number of values in a filter.
+        if len( globs ) <= self.max_filter_values and not any(
+                        '[' in glob or '\\' in glob for glob in globs ):
+            filters = { 'key-name': globs }
+        else:
+            filters = None
+        matches = [ ]
+        for keypair in self.ec2.get_all_key_pairs( filters=filters ):
+            i = match( keypair.name )
+            if i is not None:
+                matches.append( (i, keypair.name, keypair) )
+        matches.sort( key=lambda (i, name, _): (i, name) )
+        return [ keypair for _, _, keypair in matches ]
 
-        result = [ ]
-        keypairs = dict( (keypair.name, keypair) for keypair in self.ec2.get_all_key_pairs( ) )
-        for glob in globs:
-            i = len( result )
-            for name, keypair in keypairs.iteritems( ):
-                if fnmatch.fnmatch( name, glob ):
-                    result.append( keypair )
+    def download_ssh_pubkey( self, ec2_keypair ):
+        """
+        Returns the SSH public key stored in S3 for the given EC2 key pair. Public keys are
+        cached locally by fingerprint, so each key is only downloaded once. Cached keys are
+        subjected to the same fingerprint check as downloaded ones.
+        """
+        cache = ssh_pubkey_cache( )
+        ssh_pubkey = cache.get( ec2_keypair.fingerprint,
+                                lambda _: self.__fetch_ssh_pubkey( ec2_keypair ) )
+        try:
+            self.__verify_ssh_pubkey( ec2_keypair, ssh_pubkey )
+        except UserError:
+            log.warn( 'Cached SSH public key for EC2 key pair %s is corrupt, downloading it '
+                      'again.', ec2_keypair.name )
+            cache.discard( ec2_keypair.fingerprint )
+            ssh_pubkey = cache.get( ec2_keypair.fingerprint,
+                                    lambda _: self.__fetch_ssh_pubkey( ec2_keypair ) )
+            self.__verify_ssh_pubkey( ec2_keypair, ssh_pubkey )
+        return ssh_pubkey
 
-            # since we can't modify the set during iteration
-            for keypair in result[ i: ]:
-                keypairs.pop( keypair.name )
-        return result
+    def download_ssh_pubkeys( self, ec2_keypairs, pool_size=8 ):
+        """
+        Returns a list with the SSH public key for each of the given EC2 key pairs, or None for
+        key pairs whose public key could not be downloaded. Keys that aren't cached yet are
+        downloaded concurrently, using at most the given number of threads.
+        """
 
-    def download_ssh_pubkey( self, ec2_keypair ):
+        def download( ec2_keypair ):
+            try:
+                return self.download_ssh_pubkey( ec2_keypair )
+            except UserError:
+                log.warn( 'Exception while downloading SSH public key from S3.', exc_info=True )
+                return None
+
+        return pmap( download, ec2_keypairs, pool_size=pool_size )
+
+    def __fetch_ssh_pubkey( self, ec2_keypair ):
         try:
-            bucket = self.s3.get_bucket( self.s3_bucket_name )
+            bucket = self.s3.get_bucket( self.s3_bucket_name, validate=False )
             s3_entry = S3Key( bucket )
             s3_entry.key = self.ssh_pubkey_s3_key_prefix + ec2_keypair.fingerprint
-            ssh_pubkey = s3_entry.get_contents_as_string( )
+            return s3_entry.get_contents_as_string( )
         except S3ResponseError as e:
             if e.status == 404:
                 raise UserError(
@@ -579,6 +750,9 @@ class Context( object ):
                     ec2_keypair.name )
             else:
                 raise
+
+    @staticmethod
+    def __verify_ssh_pubkey( ec2_keypair, ssh_pubkey ):
         fingerprint_len = len( ec2_keypair.fingerprint.split( ':' ) )
         if fingerprint_len == 20:  # 160 bit SHA-1
             # The fingerprint is that of a private key. We can't get at the private key so we
@@ -595,16 +769,18 @@ class Context( object ):
                     "Fingerprint mismatch for key %s! Expected %s but got %s. The EC2 keypair "
                     "doesn't match the public key stored in S3." %
                     (ec2_keypair.name, ec2_keypair.fingerprint, fingerprint) )
-        return ssh_pubkey
 
     @property
     @memoize
     def iam_user_name( self ):
-        try:
-            return self.iam.get_user( ).user_name
-        except:
-            log.warn( "IAMConnection.get_user() failed.", exc_info=True )
-            return None
+        def lookup( ):
+            try:
+                return self.iam.get_user( ).user_name
+            except:
+                log.warn( "IAMConnection.get_user() failed.", exc_info=True )
+                return None
+
+        return self._cached( 'iam_user_name', lookup )
 
     current_user_placeholder = '__me__'
 
@@ -648,66 +824,107 @@ class Context( object ):
         else:
             return s
 
+    # The number of seconds during which the IAM policies of a role or user are assumed to be
+    # unchanged after they were last set up by this or another cgcloud process
+    iam_policy_cache_ttl = 10 * 60
+
     def setup_iam_ec2_role( self, role_name, policies ):
         aws_role_name = self.to_aws_name( role_name )
-        try:
-            self.iam.create_role( aws_role_name, assume_role_policy_document=json.dumps( {
-                "Version": "2012-10-17",
-                "Statement": [ {
-                    "Effect": "Allow",
-                    "Principal": { "Service": [ "ec2.amazonaws.com" ] },
-                    "Action": [ "sts:AssumeRole" ] }
-                ] } ) )
-        except BotoServerError as e:
-            if e.status == 409 and e.error_code == 'EntityAlreadyExists':
-                pass
-            else:
-                raise
 
-        self.__setup_entity_policies( aws_role_name, policies,
-                                      list_policies=self.iam.list_role_policies,
-                                      delete_policy=self.iam.delete_role_policy,
-                                      get_policy=self.iam.get_role_policy,
-                                      put_policy=self.iam.put_role_policy )
+        def setup( ):
+            try:
+                self.iam.create_role( aws_role_name, assume_role_policy_document=json.dumps( {
+                    "Version": "2012-10-17",
+                    "Statement": [ {
+                        "Effect": "Allow",
+                        "Principal": { "Service": [ "ec2.amazonaws.com" ] },
+                        "Action": [ "sts:AssumeRole" ] }
+                    ] } ) )
+            except BotoServerError as e:
+                if e.status == 409 and e.error_code == 'EntityAlreadyExists':
+                    pass
+                else:
+                    raise
+
+            self.__setup_entity_policies( aws_role_name, policies,
+                                          list_policies='list_role_policies',
+                                          delete_policy='delete_role_policy',
+                                          get_policy='get_role_policy',
+                                          put_policy='put_role_policy' )
 
+        self.__setup_unless_current( 'iam_role_policies:' + aws_role_name, policies, setup )
         return aws_role_name
 
     def setup_iam_user_policies( self, user_name, policies ):
-        try:
-            self.iam.create_user( user_name )
-        except BotoServerError as e:
-            if e.status == 409 and e.error_code == 'EntityAlreadyExists':
-                pass
-            else:
-                raise
-        self.__setup_entity_policies( user_name, policies,
-                                      list_policies=self.iam.get_all_user_policies,
-                                      delete_policy=self.iam.delete_user_policy,
-                                      get_policy=self.iam.get_user_policy,
-                                      put_policy=self.iam.put_user_policy )
+        def setup( ):
+            try:
+                self.iam.create_user( user_name )
+            except BotoServerError as e:
+                if e.status == 409 and e.error_code == 'EntityAlreadyExists':
+                    pass
+                else:
+                    raise
+            self.__setup_entity_policies( user_name, policies,
+                                          list_policies='get_all_user_policies',
+                                          delete_policy='delete_user_policy',
+                                          get_policy='get_user_policy',
+                                          put_policy='put_user_policy' )
+
+        self.__setup_unless_current( 'iam_user_policies:' + user_name, policies, setup )
+
+    def __setup_unless_current( self, cache_key, policies, setup ):
+        """
+        Invoke the given function to set up an IAM entity with the given policies unless the
+        identity cache records that the entity was set up with the same policies less than
+        iam_policy_cache_ttl seconds ago.
+        """
+        digest = hashlib.sha1( json.dumps( policies, sort_keys=True ) ).hexdigest( )
+        if self._peek_cached( cache_key, ttl=self.iam_policy_cache_ttl ) == digest:
+            log.debug( 'Skipping setup of %s, its policies were set up recently.', cache_key )
+        else:
+            setup( )
+            self._put_cached( cache_key, digest )
 
     def __setup_entity_policies( self, entity_name, policies,
                                  list_policies, delete_policy, get_policy, put_policy ):
-        # Delete superfluous policies
-        policy_names = set( list_policies( entity_name ).policy_names )
-        for policy_name in policy_names.difference( set( policies.keys( ) ) ):
-            delete_policy( entity_name, policy_name )
+        """
+        Make the given IAM entity have exactly the given policies. The last four arguments are
+        the names of the IAMConnection methods that deal with the entity's policies. Superfluous
+        policies are deleted and the other policies are compared and updated concurrently.
+        """
+
+        def iam( method_name ):
+            # Look up the connection in the current thread, connections aren't thread-safe
+            return getattr( self.iam, method_name )
 
-        # Create expected policies
-        for policy_name, policy in policies.iteritems( ):
+        def delete( policy_name ):
+            iam( delete_policy )( entity_name, policy_name )
+
+        def update( policy_name ):
+            policy = policies[ policy_name ]
             current_policy = None
             try:
                 current_policy = json.loads( urllib.unquote(
-                    get_policy( entity_name, policy_name ).policy_document ) )
+                    iam( get_policy )( entity_name, policy_name ).policy_document ) )
             except BotoServerError as e:
                 if e.status == 404 and e.error_code == 'NoSuchEntity':
                     pass
                 else:
                     raise
             if current_policy != policy:
-                for attempt in retry(predicate=throttlePredicate):
+                for attempt in retry( predicate=throttlePredicate ):
                     with attempt:
-                        put_policy( entity_name, policy_name, json.dumps( policy ) )
+                        iam( put_policy )( entity_name, policy_name, json.dumps( policy ) )
+
+        superfluous_policy_names = set( iam( list_policies )( entity_name ).policy_names )
+        superfluous_policy_names.difference_update( policies.iterkeys( ) )
+        tasks = [ functools.partial( delete, policy_name )
+                     for policy_name in superfluous_policy_names ]
+        tasks.extend( functools.partial( update, policy_name ) for policy_name in policies )
+        pmap( lambda task: task( ), tasks, pool_size=self.iam_policy_setup_threads )
+
+    # The maximum number of concurrent requests made while setting up the policies of an entity
+    iam_policy_setup_threads = 8
 
     _agent_topic_name = "cgcloud-agent-notifications"
 
@@ -722,9 +939,12 @@ class Context( object ):
         """
         The ARN of the SNS topic on which the agents listen for messages and returns its ARN.
         """
-        # Note that CreateTopic is idempotent
-        return self.sns.create_topic( self._agent_topic_name )[
-            'CreateTopicResponse' ][ 'CreateTopicResult' ][ 'TopicArn' ]
+        def lookup( ):
+            # Note that CreateTopic is idempotent
+            return self.sns.create_topic( self._agent_topic_name )[
+                'CreateTopicResponse' ][ 'CreateTopicResult' ][ 'TopicArn' ]
+
+        return self._cached( 'agent_topic_arn', lookup )
 
     def publish_agent_message( self, message ):
         """
@@ -735,7 +955,7 @@ class Context( object ):
     def __publish_key_update_agent_message( self ):
         self.publish_agent_message( Message( type=Message.TYPE_UPDATE_SSH_KEYS ) )
 
-    def reset_namespace_security( self ):
+    def reset_namespace_security( self, num_threads=None, dry_run=False ):
         """
         Delete all
 
@@ -744,66 +964,101 @@ class Context( object ):
         - IAM policies and
         - EC2 security groups
 
-        associated with this context, or rather the namespace this context represents.
+        associated with this context, or rather the namespace this context represents. Instance
+        profiles are deleted before the roles they contain and roles before security groups.
+
+        :param int num_threads: the maximum number of resources to delete concurrently
+
+        :param bool dry_run: if True, only count the resources that would be deleted
+
+        :return: a report for each kind of resource, see Cleanup.stage()
         """
-        self.delete_instance_profiles( self.local_instance_profiles( ) )
-        self.delete_roles( self.local_roles( ) )
-        self.delete_security_groups( self.local_security_groups( ) )
+        cleanup = Cleanup( num_threads=num_threads, dry_run=dry_run )
+        return [ self.__delete_instance_profiles( cleanup, self.local_instance_profiles( ) ),
+            self.__delete_roles( cleanup, self.local_roles( ) ),
+            self.__delete_security_groups( cleanup, self.local_security_groups( ) ) ]
 
     def local_instance_profiles( self ):
-        return [ p for p in self._get_all_instance_profiles( )
-                 if self.try_contains_aws_name( p.instance_profile_name ) ]
+        """
+        :rtype: collections.Iterator
+        """
+        return (p for p in self._get_all_instance_profiles( )
+            if self.try_contains_aws_name( p.instance_profile_name ))
 
     def _get_all_instance_profiles( self ):
-        return self._pager( self.iam.list_instance_profiles, 'instance_profiles' )
-
-    def _pager( self, requestor_callable, result_attribute_name ):
-        marker = None
-        while True:
-            result = requestor_callable( marker=marker )
-            for p in getattr( result, result_attribute_name ):
-                yield p
-            if result.is_truncated == 'true':
-                marker = result.marker
-            else:
-                break
+        return self._pager( 'list_instance_profiles', 'instance_profiles' )
+
+    def _pager( self, method_name, result_attribute_name ):
+        """
+        Page through the results of the given IAMConnection list method, fetching each page
+        while the previous one is being consumed.
+        """
+        # The pages are fetched in another thread, with that thread's connection
+        return iam_pager( lambda marker: getattr( self.iam, method_name )( marker=marker ),
+                          result_attribute_name )
 
-    def delete_instance_profiles( self, instance_profiles ):
-        log.debug( 'Deleting profiles %r', instance_profiles )
-        for p in instance_profiles:
+    def delete_instance_profiles( self, instance_profiles, num_threads=None ):
+        return self.__delete_instance_profiles( Cleanup( num_threads ), instance_profiles )
+
+    def __delete_instance_profiles( self, cleanup, instance_profiles ):
+        def delete( p ):
             profile_name = p.instance_profile_name
-            with out_exception( 'instance profile', profile_name ):
-                # currently EC2 allows only one role per profile
-                if p.roles:
-                    role_name = p.roles.member.role_name
-                    log.debug( 'Removing role %s from profile %s', role_name, profile_name )
-                    self.iam.remove_role_from_instance_profile( profile_name, role_name )
-                log.debug( 'Deleting profile %s', profile_name )
-                self.iam.delete_instance_profile( profile_name )
+            # currently EC2 allows only one role per profile
+            if p.roles:
+                role_name = p.roles.member.role_name
+                log.debug( 'Removing role %s from profile %s', role_name, profile_name )
+                self.iam.remove_role_from_instance_profile( profile_name, role_name )
+            self.iam.delete_instance_profile( profile_name )
+
+        def actions( p ):
+            return ([ 'iam:RemoveRoleFromInstanceProfile' ] if p.roles else [ ]) + [
+                'iam:DeleteInstanceProfile' ]
+
+        return cleanup.stage( 'instance profile', instance_profiles, delete, actions,
+                              name=lambda p: p.instance_profile_name )
 
     def local_roles( self ):
-        return [ r for r in self._get_all_roles( ) if self.try_contains_aws_name( r.role_name ) ]
+        """
+        :rtype: collections.Iterator
+        """
+        return (r for r in self._get_all_roles( ) if self.try_contains_aws_name( r.role_name ))
 
     def _get_all_roles( self ):
-        return self._pager( self.iam.list_roles, 'roles' )
+        return self._pager( 'list_roles', 'roles' )
+
+    def delete_roles( self, roles, num_threads=None ):
+        return self.__delete_roles( Cleanup( num_threads ), roles )
 
-    def delete_roles( self, roles ):
-        log.debug( 'Deleting roles %r', roles )
-        for r in roles:
-            with out_exception( 'role', r.role_name ):
-                for policy_name in self.iam.list_role_policies( r.role_name ).policy_names:
-                    self.iam.delete_role_policy( r.role_name, policy_name )
-                self.iam.delete_role( r.role_name )
+    def __delete_roles( self, cleanup, roles ):
+        def delete( r ):
+            # Make sure setup_iam_ec2_role() recreates the role
+            self._put_cached( 'iam_role_policies:' + r.role_name, None )
+            for policy_name in self.iam.list_role_policies( r.role_name ).policy_names:
+                self.iam.delete_role_policy( r.role_name, policy_name )
+            self.iam.delete_role( r.role_name )
+
+        def actions( r ):
+            # Listing the policies of each role would defeat the purpose of a dry run so assume
+            # one policy per role, which is what cgcloud creates.
+            return [ 'iam:ListRolePolicies', 'iam:DeleteRolePolicy', 'iam:DeleteRole' ]
+
+        return cleanup.stage( 'role', roles, delete, actions, name=lambda r: r.role_name )
 
     def local_security_groups( self ):
         return [ sg for sg in self.ec2.get_all_security_groups( )
                  if self.try_contains_aws_name( sg.name ) ]
 
-    def delete_security_groups( self, security_groups ):
-        log.debug( 'Deleting security groups %r', security_groups )
-        for sg in security_groups:
-            with out_exception( 'security group', sg.name ):
-                sg.delete( )
+    def delete_security_groups( self, security_groups, num_threads=None ):
+        return self.__delete_security_groups( Cleanup( num_threads ), security_groups )
+
+    def __delete_security_groups( self, cleanup, security_groups ):
+        def delete( sg ):
+            # Don't use sg.delete(), the group's connection belongs to the thread that listed it
+            self.ec2.delete_security_group( group_id=sg.id )
+
+        return cleanup.stage( 'security group', security_groups, delete,
+                              actions=lambda sg: [ 'ec2:DeleteSecurityGroup' ],
+                              name=lambda sg: sg.name )
 
     def unused_fingerprints( self ):
         """
@@ -838,25 +1093,62 @@ class Context( object ):
 
         :rtype: set[str]
         """
-        all_snapshots = self.ec2.get_all_snapshots(
-            owner='self',
-            filters=dict( description='Created by CreateImage*' ) )
-        all_snapshots = set( snapshot.id for snapshot in all_snapshots )
+        return set( self.iter_unused_snapshots( ) )
+
+    def iter_unused_snapshots( self ):
+        """
+        Like unused_snapshots() but yields the snapshot IDs while paging through the snapshots.
+        Only the IDs of snapshots referenced by images are kept in memory.
+
+        :rtype: collections.Iterator[str]
+        """
         used_snapshots = set( bdt.snapshot_id
                               for image in self.ec2.get_all_images( owners=[ 'self' ] )
                               for bdt in image.block_device_mapping.itervalues( )
                               if bdt.snapshot_id is not None )
-        return all_snapshots - used_snapshots
+        for snapshot in self._get_all_snapshots(
+                owner='self',
+                filters=dict( description='Created by CreateImage*' ) ):
+            if snapshot.id not in used_snapshots:
+                yield snapshot.id
+
+    # The number of snapshots to request per DescribeSnapshots request
+    snapshot_page_size = 1000
+
+    def _get_all_snapshots( self, owner=None, filters=None ):
+        """
+        Like EC2Connection.get_all_snapshots() but pages through the results instead of
+        retrieving all snapshots in a single response, fetching each page while the previous one
+        is being consumed.
 
-    def delete_snapshots( self, unused_snapshots ):
+        :rtype: collections.Iterator[Snapshot]
+        """
+        params = { 'MaxResults': self.snapshot_page_size }
+        if owner:
+            self.ec2.build_list_params( params, owner, 'Owner' )
+        if filters:
+            self.ec2.build_filter_params( params, filters )
+
+        def fetch_page( token ):
+            page_params = params if token is None else dict( params, NextToken=token )
+            return self.ec2.get_list( 'DescribeSnapshots', page_params,
+                                      [ ('item', Snapshot) ], verb='POST' )
+
+        return ec2_pager( fetch_page )
+
+    def delete_snapshots( self, unused_snapshots, num_threads=None, dry_run=False ):
         """
         Delete the snapshots with the given IDs.
 
         :type unused_snapshots: collections.Iterable[str]
+
+        :return: a report, see Cleanup.stage()
         """
-        for snapshot_id in unused_snapshots:
-            log.info( 'Deleting snapshot %s', snapshot_id )
-            self.ec2.delete_snapshot( snapshot_id )
+        return Cleanup( num_threads=num_threads, dry_run=dry_run ).stage(
+            'snapshot', unused_snapshots,
+            # Look up the connection in the deleting thread, connections aren't thread-safe
+            lambda snapshot_id: self.ec2.delete_snapshot( snapshot_id ),
+            actions=lambda _: [ 'ec2:DeleteSnapshot' ] )
 
 
 def throttlePredicate(e):
@@ -868,10 +1160,3 @@ def throttlePredicate(e):
     elif e.status == 400 and 'Rate exceeded' in e.body:
         return True
     return False
-
-@contextmanager
-def out_exception( object_type, object_name ):
-    try:
-        yield
-    except:
-        log.warn( "Failed to remove %s '%s'", object_type, object_name, exc_info=True )
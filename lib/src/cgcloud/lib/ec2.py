@@ -1,17 +1,23 @@
 import errno
 import logging
+import re
+import threading
 import time
-from collections import Iterator
+from collections import Iterator, defaultdict
 from operator import attrgetter
 
 from bd2k.util.exceptions import panic
 from bd2k.util.retry import retry
 from boto.ec2.ec2object import TaggedEC2Object
+from boto.ec2.image import Image
 from boto.ec2.instance import Instance
 from boto.ec2.spotinstancerequest import SpotInstanceRequest
+from boto.ec2.volume import Volume
 from boto.exception import EC2ResponseError, BotoServerError
 
-from cgcloud.lib.util import UserError
+from cgcloud.lib.context import throttlePredicate
+from cgcloud.lib.polling import PollingSchedule
+from cgcloud.lib.util import UserError, partition_seq, pmap
 
 a_short_time = 5
 
@@ -52,20 +58,15 @@ class EC2VolumeHelper( object ):
             volume.add_tag( 'Name', self.name )
             log.info( '... created %s.', volume.id )
             volume = self.__lookup( )
+        elif volume.status == 'creating':
+            # The volume may have been provisioned by the client, see provision_volumes()
+            self.__wait_transition( volume, { 'creating' }, 'available' )
         self.volume = volume
 
     def attach( self, instance_id, device ):
-        if self.volume.attach_data.instance_id == instance_id:
-            log.info( "Volume '%s' already attached to instance '%s'." %
-                      (self.volume.id, instance_id) )
-        else:
+        if self.volume.attach_data.instance_id != instance_id:
             self.__assert_attachable( )
-            self.ec2.attach_volume( volume_id=self.volume.id,
-                                    instance_id=instance_id,
-                                    device=device )
-            self.__wait_transition( self.volume, { 'available' }, 'in-use' )
-            if self.volume.attach_data.instance_id != instance_id:
-                raise UserError( "Volume %s is not attached to this instance." )
+        attach_volume( self.ec2, self.volume, instance_id, device )
 
     def __lookup( self ):
         """
@@ -95,6 +96,73 @@ class EC2VolumeHelper( object ):
                              % (self.name, self.volume.zone, expected_zone) )
 
 
+def attach_volume( ec2, volume, instance_id, device ):
+    """
+    Attach the given EBS volume to the given instance unless it is already attached to it. Wait
+    for the attachment to complete. Tolerates the volume being attached to the same instance
+    concurrently, by another process.
+
+    :type volume: boto.ec2.volume.Volume
+    """
+    if volume.attach_data.instance_id == instance_id:
+        log.info( "Volume '%s' already attached to instance '%s'.", volume.id, instance_id )
+    else:
+        try:
+            ec2.attach_volume( volume_id=volume.id, instance_id=instance_id, device=device )
+        except EC2ResponseError as e:
+            if e.error_code != 'VolumeInUse':
+                raise
+            volume.update( )
+            if volume.attach_data.instance_id != instance_id:
+                raise
+            log.info( "Volume '%s' concurrently attached to instance '%s'.",
+                      volume.id, instance_id )
+        wait_transition( volume, { 'available' }, 'in-use', attrgetter( 'status' ) )
+        if volume.attach_data.instance_id != instance_id:
+            raise UserError( "Volume %s is not attached to instance %s."
+                             % (volume.id, instance_id) )
+
+
+def provision_volumes( ec2, volumes, size, volume_type='standard', pool_size=8 ):
+    """
+    Ensure that an EBS volume exists for each of the given names. Existing volumes are looked up
+    with as few requests as possible, missing ones are created concurrently. This function
+    doesn't wait for the created volumes to become available, their status will be 'creating'.
+
+    :param list[(str,str)] volumes: pairs of the name of a volume and the availability zone it
+    should be in
+
+    :return: a dictionary mapping each of the given names to the corresponding volume
+
+    :rtype: dict[str,Volume]
+    """
+    zones = dict( volumes )
+    existing = { }
+    for batch in partition_seq( zones.keys( ), ResourceWaiter.max_filter_values ):
+        for volume in ec2.get_all_volumes( filters={ 'tag:Name': batch } ):
+            name = volume.tags[ 'Name' ]
+            if name in existing:
+                raise UserError( "More than one EBS volume named %s" % name )
+            existing[ name ] = volume
+    for name, volume in existing.iteritems( ):
+        if volume.zone != zones[ name ]:
+            raise UserError( "Availability zone of EBS volume %s is %s but should be %s."
+                             % (name, volume.zone, zones[ name ]) )
+    missing = [ name for name in zones if name not in existing ]
+    if missing:
+        log.info( 'Creating %i EBS volume(s) ...', len( missing ) )
+
+        def create_volume( name ):
+            return ec2.create_volume( size, zones[ name ], volume_type=volume_type )
+
+        created = dict( zip( missing, pmap( create_volume, missing, pool_size=pool_size ) ) )
+        tag_objects_persistently( ec2, [ (volume, dict( Name=name ))
+            for name, volume in created.iteritems( ) ] )
+        log.info( '... requested %s.', ', '.join( v.id for v in created.itervalues( ) ) )
+        existing.update( created )
+    return existing
+
+
 class UnexpectedResourceState( Exception ):
     def __init__( self, resource, to_state, state ):
         super( UnexpectedResourceState, self ).__init__(
@@ -108,20 +176,270 @@ def wait_transition( resource, from_states, to_state, state_getter=attrgetter( '
     of the given 'from' states to the specified 'to' state. If the instance is found in a state
     other that the to state or any of the from states, an exception will be thrown.
 
+    The resource is polled via the process-wide ResourceWaiter for its kind such that concurrent
+    waits on many resources of the same kind share a single Describe* request per cycle.
+
     :param resource: the resource to monitor
     :param from_states:
         a set of states that the resource is expected to be in before the  transition occurs
     :param to_state: the state of the resource when this method returns
     """
-    state = state_getter( resource )
-    while state in from_states:
-        time.sleep( a_short_time )
-        for attempt in retry_ec2( ):
-            with attempt:
-                resource.update( validate=True )
-        state = state_getter( resource )
-    if state != to_state:
-        raise UnexpectedResourceState( resource, to_state, state )
+    wait_transitions( [ resource ], from_states, to_state, state_getter )
+
+
+def wait_transitions( resources, from_states, to_state, state_getter=attrgetter( 'state' ) ):
+    """
+    Like wait_transition() but for any number of resources of the same kind. Returns as soon as
+    every resource left the given 'from' states. Raises UnexpectedResourceState for the first
+    resource found in a state other than the 'to' state, after all resources have transitioned.
+    """
+    resources = list( resources )
+    if resources:
+        unexpected = None
+        waiter = ResourceWaiter.for_resource( resources[ 0 ] )
+        for resource in waiter.transitions( resources, from_states, state_getter, to_state ):
+            state = state_getter( resource )
+            if state != to_state and unexpected is None:
+                unexpected = UnexpectedResourceState( resource, to_state, state )
+        if unexpected is not None:
+            raise unexpected
+
+
+class ResourceWaiter( object ):
+    """
+    Tracks the state of any number of EC2 resources of one kind (instances, volumes or images)
+    in one region. Threads waiting on resources register them with the waiter. In each polling
+    cycle, one of the waiting threads issues a single, filtered Describe* request for all
+    registered resources, updates the registered resource objects in place and wakes up the
+    other waiting threads. This keeps the number of requests independent of the number of
+    resources being waited on, avoiding the request throttling that one update() call per
+    resource per cycle would cause with hundreds of concurrent waits.
+
+    Unless a fixed interval is given, the time between cycles is dictated by the most urgent of
+    the PollingSchedule instances of the pending waits. Throttled Describe* requests don't fail
+    the waits, they make the schedules back off instead.
+
+    >>> from bd2k.util.expando import Expando
+    >>> class FauxResource( Expando ):
+    ...     def _update( self, other ):
+    ...         self.__dict__.update( other.__dict__ )
+    >>> calls = [ ]
+    >>> def describe( connection, ids ):
+    ...     calls.append( sorted( ids ) )
+    ...     return [ FauxResource( id=id, state='running' ) for id in ids ]
+    >>> waiter = ResourceWaiter( 'faux', describe, interval=0 )
+    >>> a = FauxResource( id='i-a', state='pending', connection=None )
+    >>> b = FauxResource( id='i-b', state='pending', connection=None )
+    >>> [ r.id for r in waiter.transitions( [ a, b ], { 'pending' } ) ]
+    ['i-a', 'i-b']
+    >>> calls
+    [['i-a', 'i-b']]
+
+    A resource that EC2 keeps omitting from the response, e.g. because it was deleted, is
+    waited on for a number of cycles, tolerating eventual consistency, and then reported:
+
+    >>> waiter.describe = lambda connection, ids: [ ]
+    >>> c = FauxResource( id='i-c', state='pending', connection=None )
+    >>> list( waiter.transitions( [ c ], { 'pending' }, to_state='running' ) ) # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    UnexpectedResourceState: Expected state of ... to be 'running' but got 'missing'
+    >>> len( calls ), waiter.missing
+    (1, {})
+    """
+
+    # The maximum number of values EC2 accepts for a single filter
+    max_filter_values = 200
+
+    # The number of consecutive polling cycles in which a resource may be absent from the
+    # response before it is considered to not exist
+    max_missing_cycles = 20
+
+    def __init__( self, kind, describe, interval=None ):
+        """
+        :param str kind: a human-readable name for the kind of resources tracked by this waiter
+
+        :param describe: a callable that takes an EC2 connection and a list of resource IDs and
+        returns the resource objects with those IDs, omitting any IDs EC2 doesn't know about (yet)
+
+        :param float|None interval: the number of seconds between polling cycles or None to
+        derive that number from the expected duration of the transitions being waited on
+        """
+        super( ResourceWaiter, self ).__init__( )
+        self.kind = kind
+        self.describe = describe
+        self.interval = interval
+        self.condition = threading.Condition( )
+        # Maps a resource ID to the list of registered objects representing that resource. Each
+        # waiting thread registers its own object so there may be more than one per ID.
+        self.resources = { }
+        # The PollingSchedule instances of all pending waits
+        self.schedules = [ ]
+        self.polling = False
+        self.next_poll = None
+        # Incremented at the end of every polling cycle
+        self.cycle = 0
+        # Maps the ID of each registered resource that was absent from the response of the
+        # previous polling cycle to the number of consecutive cycles it has been absent
+        self.missing = { }
+
+    def transitions( self, resources, from_states, state_getter=attrgetter( 'state' ),
+                     to_state=None ):
+        """
+        Yield each of the given resources as soon as its state is no longer in the given set of
+        states.
+
+        :param str|None to_state: the state the resources are expected to transition to. Used
+        to look up the expected duration of the transition and to learn from it. If None,
+        the transition is assumed to take an unknown amount of time.
+
+        :rtype: Iterator
+        """
+        pending, schedules = [ ], { }
+        for resource in resources:
+            from_state = state_getter( resource )
+            if from_state in from_states:
+                pending.append( (resource, from_state) )
+                if self.interval is None and from_state not in schedules:
+                    schedules[ from_state ] = PollingSchedule( self.kind, from_state,
+                                                               to_state or 'unknown' )
+            else:
+                yield resource
+        if not pending:
+            return
+        self.__register( [ r for r, _ in pending ], schedules.values( ) )
+        try:
+            while pending:
+                self.__await_cycle( )
+                with self.condition:
+                    missing = [ r for r, _ in pending
+                                if self.missing.get( r.id, 0 ) > self.max_missing_cycles ]
+                if missing:
+                    raise UnexpectedResourceState( missing[ 0 ], to_state, 'missing' )
+                done = [ (r, s) for r, s in pending if state_getter( r ) not in from_states ]
+                if done:
+                    self.__unregister( [ r for r, _ in done ], [ ] )
+                    for resource, from_state in done:
+                        pending.remove( (resource, from_state) )
+                        if to_state is not None and from_state in schedules:
+                            schedules[ from_state ].observe( state_getter( resource ) )
+                        yield resource
+        finally:
+            self.__unregister( [ r for r, _ in pending ], schedules.values( ) )
+
+    def __register( self, resources, schedules ):
+        with self.condition:
+            next_poll = time.time( ) + self.__delay( schedules )
+            if not self.resources or next_poll < self.next_poll:
+                self.next_poll = next_poll
+                # Wake up threads waiting for a later cycle
+                self.condition.notify_all( )
+            for resource in resources:
+                self.resources.setdefault( resource.id, [ ] ).append( resource )
+            self.schedules.extend( schedules )
+
+    def __unregister( self, resources, schedules ):
+        with self.condition:
+            for resource in resources:
+                objects = self.resources[ resource.id ]
+                objects.remove( resource )
+                if not objects:
+                    del self.resources[ resource.id ]
+                    self.missing.pop( resource.id, None )
+            for schedule in schedules:
+                self.schedules.remove( schedule )
+
+    def __delay( self, schedules ):
+        if self.interval is not None:
+            return self.interval
+        elif schedules:
+            return min( schedule.delay( ) for schedule in schedules )
+        else:
+            return a_short_time
+
+    def __await_cycle( self ):
+        """
+        Return after the next polling cycle completed, possibly performing that cycle in the
+        current thread.
+        """
+        with self.condition:
+            cycle = self.cycle
+            while True:
+                if self.cycle != cycle:
+                    return
+                delay = self.next_poll - time.time( )
+                if self.polling or delay > 0:
+                    self.condition.wait( max( delay, 0 ) if not self.polling else None )
+                else:
+                    self.polling = True
+                    break
+            ids = list( self.resources )
+            connection = next( objects[ 0 ].connection
+                               for objects in self.resources.itervalues( ) )
+        fresh, throttled, complete = [ ], False, False
+        try:
+            try:
+                for batch in partition_seq( ids, self.max_filter_values ):
+                    for attempt in retry_ec2( ):
+                        with attempt:
+                            fresh.extend( self.describe( connection, batch ) )
+                complete = True
+            except BotoServerError as e:
+                if throttlePredicate( e ):
+                    log.info( 'Request throttled while polling %s state, backing off.', self.kind )
+                    throttled = True
+                else:
+                    raise
+        finally:
+            with self.condition:
+                for resource in fresh:
+                    for obj in self.resources.get( resource.id, ( ) ):
+                        obj._update( resource )
+                if complete:
+                    found = set( resource.id for resource in fresh )
+                    for id in ids:
+                        if id in found or id not in self.resources:
+                            self.missing.pop( id, None )
+                        else:
+                            self.missing[ id ] = self.missing.get( id, 0 ) + 1
+                for schedule in self.schedules:
+                    if throttled:
+                        schedule.throttled( )
+                    else:
+                        schedule.polled( )
+                self.polling = False
+                self.next_poll = time.time( ) + self.__delay( self.schedules )
+                self.cycle += 1
+                self.condition.notify_all( )
+
+    _waiters = { }
+    _waiters_lock = threading.Lock( )
+
+    _describers = {
+        Instance: ('instance',
+                   lambda ec2, ids: ec2.get_only_instances( filters={ 'instance-id': ids } )),
+        Volume: ('volume',
+                 lambda ec2, ids: ec2.get_all_volumes( filters={ 'volume-id': ids } )),
+        Image: ('image',
+                lambda ec2, ids: ec2.get_all_images( filters={ 'image-id': ids } )) }
+
+    @classmethod
+    def for_resource( cls, resource ):
+        """
+        Return the process-wide waiter for the kind and region of the given resource.
+
+        :rtype: ResourceWaiter
+        """
+        resource_type = next( t for t in cls._describers if isinstance( resource, t ) )
+        key = (resource_type, resource.region and resource.region.name)
+        with cls._waiters_lock:
+            try:
+                return cls._waiters[ key ]
+            except KeyError:
+                kind, describe = cls._describers[ resource_type ]
+                waiter = cls( kind, describe )
+                cls._waiters[ key ] = waiter
+                return waiter
 
 
 def running_on_ec2( ):
@@ -135,139 +453,51 @@ def running_on_ec2( ):
             raise
 
 
-from collections import namedtuple
-
-InstanceType = namedtuple( 'InstanceType', [
-    'name',  # the API name of the instance type
-    'cores',  # the number of cores
-    'ecu',  # the computational power of the core times the number of cores
-    'memory',  # RAM in GB
-    'virtualization_types',  # the supported virtualization types, in order of preference
-    'disks',  # the number of ephemeral (aka 'instance store') volumes
-    'disk_type',  # the type of ephemeral volume
-    'disk_capacity',  # the capacity of each ephemeral volume in GB
-    'spot_availability'  # can this instance type be used on the spot market?
-] )
-
-hvm = 'hvm'  # hardware virtualization
-pv = 'paravirtual'  # para-virtualization
-ssd = 'SSD'  # solid-state disk
-hdd = 'HDD'  # spinning disk
-variable_ecu = -1  # variable ecu
-
-_ec2_instance_types = [
-    # current generation instance types
-    InstanceType( 't2.nano', 1, variable_ecu, 0.5, [ hvm ], 0, None, 0, False ),
-    InstanceType( 't2.micro', 1, variable_ecu, 1, [ hvm ], 0, None, 0, False ),
-    InstanceType( 't2.small', 1, variable_ecu, 2, [ hvm ], 0, None, 0, False ),
-    InstanceType( 't2.medium', 2, variable_ecu, 4, [ hvm ], 0, None, 0, False ),
-    InstanceType( 't2.large', 2, variable_ecu, 8, [ hvm ], 0, None, 0, False ),
-    InstanceType( 't2.xlarge', 4, variable_ecu, 16, [ hvm ], 0, None, 0, False ),
-    InstanceType( 't2.2xlarge', 8, variable_ecu, 32, [ hvm ], 0, None, 0, False ),
-
-    InstanceType( 'm3.medium', 1, 3, 3.75, [ hvm, pv ], 1, ssd, 4, True ),
-    InstanceType( 'm3.large', 2, 6.5, 7.5, [ hvm, pv ], 1, ssd, 32, True ),
-    InstanceType( 'm3.xlarge', 4, 13, 15, [ hvm, pv ], 2, ssd, 40, True ),
-    InstanceType( 'm3.2xlarge', 8, 26, 30, [ hvm, pv ], 2, ssd, 80, True ),
-
-    InstanceType( 'm4.large', 2, 6.5, 8, [ hvm ], 0, None, 0, True ),
-    InstanceType( 'm4.xlarge', 4, 13, 16, [ hvm ], 0, None, 0, True ),
-    InstanceType( 'm4.2xlarge', 8, 26, 32, [ hvm ], 0, None, 0, True ),
-    InstanceType( 'm4.4xlarge', 16, 53.5, 64, [ hvm ], 0, None, 0, True ),
-    InstanceType( 'm4.10xlarge', 40, 124.5, 160, [ hvm ], 0, None, 0, True ),
-
-    InstanceType( 'c4.large', 2, 8, 3.75, [ hvm ], 0, None, 0, True ),
-    InstanceType( 'c4.xlarge', 4, 16, 7.5, [ hvm ], 0, None, 0, True ),
-    InstanceType( 'c4.2xlarge', 8, 31, 15, [ hvm ], 0, None, 0, True ),
-    InstanceType( 'c4.4xlarge', 16, 62, 30, [ hvm ], 0, None, 0, True ),
-    InstanceType( 'c4.8xlarge', 36, 132, 60, [ hvm ], 0, None, 0, True ),
-
-    InstanceType( 'c3.large', 2, 7, 3.75, [ hvm, pv ], 2, ssd, 16, True ),
-    InstanceType( 'c3.xlarge', 4, 14, 7.5, [ hvm, pv ], 2, ssd, 40, True ),
-    InstanceType( 'c3.2xlarge', 8, 28, 15, [ hvm, pv ], 2, ssd, 80, True ),
-    InstanceType( 'c3.4xlarge', 16, 55, 30, [ hvm, pv ], 2, ssd, 160, True ),
-    InstanceType( 'c3.8xlarge', 32, 108, 60, [ hvm, pv ], 2, ssd, 320, True ),
-
-    InstanceType( 'g2.2xlarge', 8, 26, 15, [ hvm ], 1, ssd, 60, True ),
-
-    InstanceType( 'r3.large', 2, 6.5, 15, [ hvm ], 1, ssd, 32, True ),
-    InstanceType( 'r3.xlarge', 4, 13, 30.5, [ hvm ], 1, ssd, 80, True ),
-    InstanceType( 'r3.2xlarge', 8, 26, 61, [ hvm ], 1, ssd, 160, True ),
-    InstanceType( 'r3.4xlarge', 16, 52, 122, [ hvm ], 1, ssd, 320, True ),
-    InstanceType( 'r3.8xlarge', 32, 104, 244, [ hvm ], 2, ssd, 320, True ),
-
-    InstanceType( 'i2.xlarge', 4, 14, 30.5, [ hvm ], 1, ssd, 800, False ),
-    InstanceType( 'i2.2xlarge', 8, 27, 61, [ hvm ], 2, ssd, 800, False ),
-    InstanceType( 'i2.4xlarge', 16, 53, 122, [ hvm ], 4, ssd, 800, False ),
-    InstanceType( 'i2.8xlarge', 32, 104, 244, [ hvm ], 8, ssd, 800, False ),
-
-    InstanceType( 'd2.xlarge', 4, 14, 30.5, [ hvm ], 3, hdd, 2000, True ),
-    InstanceType( 'd2.2xlarge', 8, 28, 61, [ hvm ], 6, hdd, 2000, True ),
-    InstanceType( 'd2.4xlarge', 16, 56, 122, [ hvm ], 12, hdd, 2000, True ),
-    InstanceType( 'd2.8xlarge', 36, 116, 244, [ hvm ], 24, hdd, 2000, True ),
-
-    InstanceType( 'x1.16xlarge', 64, 174.5, 976, [ hvm ], 1, ssd, 1920, True ),
-    InstanceType( 'x1.32xlarge', 128, 349, 1952, [ hvm ], 2, ssd, 1920, True ),
-
-    # previous generation instance types
-    InstanceType( 'm1.small', 1, 1, 1.7, [ pv ], 1, hdd, 160, True ),
-    InstanceType( 'm1.medium', 1, 2, 3.75, [ pv ], 1, hdd, 410, True ),
-    InstanceType( 'm1.large', 2, 4, 7.5, [ pv ], 2, hdd, 420, True ),
-    InstanceType( 'm1.xlarge', 4, 8, 15, [ pv ], 4, hdd, 420, True ),
-
-    InstanceType( 'c1.medium', 2, 5, 1.7, [ pv ], 1, hdd, 350, True ),
-    InstanceType( 'c1.xlarge', 8, 20, 7, [ pv ], 4, hdd, 420, True ),
-
-    InstanceType( 'cc2.8xlarge', 32, 88, 60.5, [ hvm ], 4, hdd, 840, True ),
-
-    InstanceType( 'm2.xlarge', 2, 6.5, 17.1, [ pv ], 1, hdd, 420, True ),
-    InstanceType( 'm2.2xlarge', 4, 13, 34.2, [ pv ], 1, hdd, 850, True ),
-    InstanceType( 'm2.4xlarge', 8, 26, 68.4, [ pv ], 2, hdd, 840, True ),
-
-    InstanceType( 'cr1.8xlarge', 32, 88, 244, [ hvm ], 2, ssd, 120, True ),
-
-    InstanceType( 'hi1.4xlarge', 16, 35, 60.5, [ hvm, pv ], 2, ssd, 1024, True ),
-    InstanceType( 'hs1.8xlarge', 16, 35, 117, [ hvm, pv ], 24, hdd, 2048, False ),
-
-    InstanceType( 't1.micro', 1, variable_ecu, 0.615, [ pv ], 0, None, 0, True ) ]
-
-ec2_instance_types = dict( (_.name, _) for _ in _ec2_instance_types )
-
-
 def wait_instances_running( ec2, instances ):
     """
     Wait until no instance in the given iterable is 'pending'. Yield every instance that
-    entered the running state as soon as it does.
+    entered the running state as soon as it does. The time between polls follows the expected
+    duration of the pending-to-running transition, which is refined with every instance observed
+    to complete that transition.
 
     :param boto.ec2.connection.EC2Connection ec2: the EC2 connection to use for making requests
     :param Iterator[Instance] instances: the instances to wait on
     :rtype: Iterator[Instance]
     """
+    schedule = PollingSchedule( 'instance', 'pending', 'running' )
     running_ids = set( )
     other_ids = set( )
+    # The IDs of instances seen pending, i.e. those whose transition can be learned from
+    seen_pending_ids = set( )
     while True:
-        pending_ids = set( )
+        pending = [ ]
         for i in instances:
             if i.state == 'pending':
-                pending_ids.add( i.id )
-            elif i.state == 'running':
-                assert i.id not in running_ids
-                running_ids.add( i.id )
-                yield i
+                pending.append( i )
+                seen_pending_ids.add( i.id )
             else:
-                assert i.id not in other_ids
-                other_ids.add( i.id )
+                if i.state == 'running':
+                    assert i.id not in running_ids
+                    running_ids.add( i.id )
+                else:
+                    assert i.id not in other_ids
+                    other_ids.add( i.id )
+                if i.id in seen_pending_ids:
+                    schedule.observe( i.state )
                 yield i
         log.info( '%i instance(s) pending, %i running, %i other.',
-                  *map( len, (pending_ids, running_ids, other_ids) ) )
-        if not pending_ids:
+                  len( pending ), len( running_ids ), len( other_ids ) )
+        if not pending:
             break
-        seconds = max( a_short_time, min( len( pending_ids ), 10 * a_short_time ) )
-        log.info( 'Sleeping for %is', seconds )
-        time.sleep( seconds )
-        for attempt in retry_ec2( ):
-            with attempt:
-                instances = ec2.get_only_instances( list( pending_ids ) )
+        delay = schedule.delay( )
+        log.info( 'Sleeping for %.1fs', delay )
+        time.sleep( delay )
+        # If the request is throttled, the pending instances are simply examined again
+        instances = pending
+        with schedule.polling( ):
+            for attempt in retry_ec2( ):
+                with attempt:
+                    instances = ec2.get_only_instances( [ i.id for i in pending ] )
 
 
 def wait_spot_requests_active( ec2, requests, timeout=None, tentative=False ):
@@ -288,9 +518,12 @@ def wait_spot_requests_active( ec2, requests, timeout=None, tentative=False ):
 
     if timeout is not None:
         timeout = time.time( ) + timeout
+    schedule = PollingSchedule( 'spot-request', 'open', 'active' )
     active_ids = set( )
     other_ids = set( )
     open_ids = None
+    # The IDs of requests seen open, i.e. those whose transition can be learned from
+    seen_open_ids = set( )
 
     def cancel( ):
         log.warn( 'Cancelling remaining %i spot requests.', len( open_ids ) )
@@ -303,10 +536,12 @@ def wait_spot_requests_active( ec2, requests, timeout=None, tentative=False ):
     try:
         while True:
             open_ids, eval_ids, fulfill_ids = set( ), set( ), set( )
-            batch = [ ]
+            batch, open_requests = [ ], [ ]
             for r in requests:
                 if r.state == 'open':
+                    open_requests.append( r )
                     open_ids.add( r.id )
+                    seen_open_ids.add( r.id )
                     if r.status.code == 'pending-evaluation':
                         eval_ids.add( r.id )
                     elif r.status.code == 'pending-fulfillment':
@@ -314,13 +549,15 @@ def wait_spot_requests_active( ec2, requests, timeout=None, tentative=False ):
                     else:
                         log.info( 'Request %s entered status %s indicating that it will not be '
                                   'fulfilled anytime soon.', r.id, r.status.code )
-                elif r.state == 'active':
-                    assert r.id not in active_ids
-                    active_ids.add( r.id )
-                    batch.append( r )
                 else:
-                    assert r.id not in other_ids
-                    other_ids.add( r.id )
+                    if r.state == 'active':
+                        assert r.id not in active_ids
+                        active_ids.add( r.id )
+                    else:
+                        assert r.id not in other_ids
+                        other_ids.add( r.id )
+                    if r.id in seen_open_ids:
+                        schedule.observe( r.state )
                     batch.append( r )
             if batch:
                 yield batch
@@ -329,15 +566,18 @@ def wait_spot_requests_active( ec2, requests, timeout=None, tentative=False ):
                       *map( len, (open_ids, eval_ids, fulfill_ids, active_ids, other_ids) ) )
             if not open_ids or tentative and not eval_ids and not fulfill_ids:
                 break
-            sleep_time = 2 * a_short_time
+            sleep_time = schedule.delay( )
             if timeout is not None and time.time( ) + sleep_time >= timeout:
                 log.warn( 'Timed out waiting for spot requests.' )
                 break
-            log.info( 'Sleeping for %is', sleep_time )
+            log.info( 'Sleeping for %.1fs', sleep_time )
             time.sleep( sleep_time )
-            for attempt in retry_ec2( retry_while=spot_request_not_found ):
-                with attempt:
-                    requests = ec2.get_all_spot_instance_requests( list( open_ids ) )
+            # If the request is throttled, the open requests are simply examined again
+            requests = open_requests
+            with schedule.polling( ):
+                for attempt in retry_ec2( retry_while=spot_request_not_found ):
+                    with attempt:
+                        requests = ec2.get_all_spot_instance_requests( list( open_ids ) )
     except:
         if open_ids:
             with panic( log ):
@@ -353,23 +593,47 @@ def create_spot_instances( ec2, price, image_id, spec,
     """
     :rtype: Iterator[list[Instance]]
     """
+    return create_diversified_spot_instances( ec2, price, image_id, [ (spec, num_instances) ],
+                                              timeout=timeout, tentative=tentative, tags=tags )
 
-    def spotRequestNotFound( e ):
-        return e.error_code == "InvalidSpotInstanceRequestID.NotFound"
 
-    for attempt in retry_ec2( retry_for=a_long_time,
-                              retry_while=inconsistencies_detected ):
-        with attempt:
-            requests = ec2.request_spot_instances( price, image_id, count=num_instances, **spec )
+def create_diversified_spot_instances( ec2, price, image_id, markets,
+                                       timeout=None, tentative=False, tags=None ):
+    """
+    Place spot requests in any number of markets, i.e. combinations of instance type and
+    availability zone, and wait on all of them together. Batches of instances are yielded as
+    soon as any market fulfills requests such that a thin market only delays the instances
+    requested from that market.
+
+    :param list[(dict,int)] markets: pairs of a spec, i.e. the keyword arguments to
+    request_spot_instances() that define the market, and the number of instances to request in
+    that market
+
+    :rtype: Iterator[list[Instance]]
+    """
+
+    requests = [ ]
+    try:
+        for spec, num_instances in markets:
+            if num_instances:
+                for attempt in retry_ec2( retry_for=a_long_time,
+                                          retry_while=inconsistencies_detected ):
+                    with attempt:
+                        requests.extend( ec2.request_spot_instances( price, image_id,
+                                                                     count=num_instances,
+                                                                     **spec ) )
+    except:
+        if requests:
+            with panic( log ):
+                log.warn( 'Cancelling %i spot requests.', len( requests ) )
+                ec2.cancel_spot_instance_requests( [ r.id for r in requests ] )
+        raise
 
     if tags is not None:
-        for requestID in (request.id for request in requests):
-            for attempt in retry_ec2( retry_while=spotRequestNotFound ):
-                with attempt:
-                    ec2.create_tags( [ requestID ], tags )
+        tag_objects_persistently( ec2, [ (request, tags) for request in requests ] )
 
     num_active, num_other = 0, 0
-    # noinspection PyUnboundLocalVariable,PyTypeChecker
+    # noinspection PyTypeChecker
     # request_spot_instances's type annotation is wrong
     for batch in wait_spot_requests_active( ec2,
                                             requests,
@@ -432,3 +696,139 @@ def tag_object_persistently( tagged_ec2_object, tags_dict ):
     for attempt in retry_ec2( ):
         with attempt:
             tagged_ec2_object.add_tags( tags_dict )
+
+
+def tag_objects_persistently( ec2, tagged_objects, pool_size=8,
+                              retry_after=a_short_time, retry_for=10 * a_short_time ):
+    """
+    Tag any number of EC2 objects using as few CreateTags requests as possible. Objects that get
+    the same tags are tagged in a single request. A tag shared by objects with otherwise
+    different tags is applied to all of them in a separate request, but only if that lowers the
+    total number of requests. Independent requests are made concurrently. Like
+    tag_object_persistently(), this function retries requests failing with "NotFound" types of
+    errors but it only retries them for the objects that EC2 has not made visible yet.
+
+    :param ec2: the EC2 connection to use for making requests
+
+    :param list[(TaggedEC2Object,dict)] tagged_objects: pairs of an EC2 object and a
+    dictionary of tags to be applied to that object
+
+    >>> from boto.ec2.instance import Instance
+    >>> calls, invisible = [ ], { 'i-b' }
+    >>> class FauxEC2( object ):
+    ...     def create_tags( self, ids, tags ):
+    ...         calls.append( (sorted( ids ), sorted( tags.items( ) )) )
+    ...         missing = invisible.intersection( ids )
+    ...         if missing:
+    ...             invisible.clear( )
+    ...             raise EC2ResponseError( 400, 'Bad Request', body=not_found_body % missing )
+    >>> not_found_body = ( '<Response><Errors><Error><Code>InvalidInstanceID.NotFound</Code>'
+    ...                    '<Message>The instance ID %r does not exist</Message>'
+    ...                    '</Error></Errors></Response>' )
+    >>> instances = [ Instance( ) for i in range( 4 ) ]
+    >>> for i, c in zip( instances, 'abcd' ): i.id = 'i-' + c
+    >>> tag_objects_persistently( FauxEC2( ), [
+    ...     (i, dict( Name='foo', Owner='bar' )) for i in instances[ :3 ]
+    ... ] + [ (instances[ 3 ], dict( Name='foo', Owner='bar', cluster_ordinal='0' )) ],
+    ... pool_size=0, retry_after=0 )
+    >>> for call in sorted( calls ): print call
+    (['i-a', 'i-b', 'i-c'], [('Name', 'foo'), ('Owner', 'bar')])
+    (['i-a', 'i-c'], [('Name', 'foo'), ('Owner', 'bar')])
+    (['i-b'], [('Name', 'foo'), ('Owner', 'bar')])
+    (['i-d'], [('Name', 'foo'), ('Owner', 'bar'), ('cluster_ordinal', '0')])
+    >>> instances[ 3 ].tags[ 'cluster_ordinal' ]
+    '0'
+
+    Tagging all four instances with the shared tags in a request of their own wouldn't have
+    saved a request, nor would it for a cluster of nodes that only differ in their ordinal:
+
+    >>> del calls[ : ]
+    >>> nodes = [ Instance( ) for n in range( 100 ) ]
+    >>> for n, i in enumerate( nodes ): i.id = 'i-%i' % n
+    >>> tag_objects_persistently( FauxEC2( ), [
+    ...     (i, dict( Name='foo', cluster_ordinal=str( n ) )) for n, i in enumerate( nodes )
+    ... ], pool_size=0 )
+    >>> len( calls )
+    100
+
+    In the following case it does save a request:
+
+    >>> del calls[ : ]
+    >>> tag_objects_persistently( FauxEC2( ), [
+    ...     (instances[ 0 ], dict( Name='foo', Owner='bar' )),
+    ...     (instances[ 1 ], dict( Name='foo' )),
+    ...     (instances[ 2 ], dict( Owner='bar' )) ], pool_size=0 )
+    >>> for call in sorted( calls ): print call
+    (['i-a', 'i-b'], [('Name', 'foo')])
+    (['i-a', 'i-c'], [('Owner', 'bar')])
+    """
+    tags_by_id = defaultdict( dict )
+    for obj, tags in tagged_objects:
+        tags_by_id[ obj.id ].update( tags )
+    # Find the tags that are shared by more than one object, grouping them by set of objects
+    ids_by_tag = defaultdict( set )
+    for id, tags in tags_by_id.iteritems( ):
+        for tag in tags.iteritems( ):
+            ids_by_tag[ tag ].add( id )
+    shared = defaultdict( dict )
+    for (key, value), ids in ids_by_tag.iteritems( ):
+        if len( ids ) > 1:
+            shared[ frozenset( ids ) ][ key ] = value
+    shared = sorted( shared.items( ), key=lambda group: (len( group[ 0 ] ), sorted( group[ 0 ] )) )
+
+    def plan( shared ):
+        """
+        Return the requests needed to apply the given shared tags in requests of their own and
+        the remaining tags of each object in one request per distinct set of remaining tags.
+        """
+        covered = defaultdict( set )
+        for ids, tags in shared:
+            for id in ids:
+                covered[ id ].update( tags.iterkeys( ) )
+        ids_by_remainder = defaultdict( set )
+        for id, tags in tags_by_id.iteritems( ):
+            remainder = frozenset( (key, value) for key, value in tags.iteritems( )
+                                   if key not in covered[ id ] )
+            if remainder:
+                ids_by_remainder[ remainder ].add( id )
+        return shared + [ (frozenset( ids ), dict( remainder ))
+            for remainder, ids in ids_by_remainder.iteritems( ) ]
+
+    # Starting with the smallest group of objects, stop sharing tags unless it saves requests
+    requests = plan( shared )
+    for group in list( shared ):
+        candidate = [ other for other in shared if other is not group ]
+        candidate_requests = plan( candidate )
+        if len( candidate_requests ) <= len( requests ):
+            shared, requests = candidate, candidate_requests
+    deadline = time.time( ) + retry_for
+
+    def create_tags( (ids, tags) ):
+        __create_tags_persistently( ec2, sorted( ids ), tags, retry_after, deadline )
+
+    pmap( create_tags, requests, pool_size=pool_size )
+    for obj, tags in tagged_objects:
+        obj.tags.update( tags )
+
+
+def __create_tags_persistently( ec2, ids, tags, retry_after, deadline ):
+    while True:
+        try:
+            ec2.create_tags( ids, tags )
+        except EC2ResponseError as e:
+            if not not_found( e ) or time.time( ) > deadline:
+                raise
+            # The error message names the objects that aren't visible yet, the remaining ones
+            # can be tagged right away.
+            missing = [ id for id in ids if re.search( r'\b%s\b' % re.escape( id ),
+                                                       e.error_message or '' ) ]
+            if missing:
+                visible = [ id for id in ids if id not in missing ]
+                if visible:
+                    __create_tags_persistently( ec2, visible, tags, retry_after, deadline )
+                ids = missing
+            log.info( 'Object(s) %s not visible yet, retrying to tag them in %is.',
+                      ', '.join( ids ), retry_after )
+            time.sleep( retry_after )
+        else:
+            break
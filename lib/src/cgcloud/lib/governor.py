@@ -0,0 +1,261 @@
+import logging
+import threading
+import time
+
+from bd2k.util import sync_memoize
+
+log = logging.getLogger( __name__ )
+
+
+class TokenBucket( object ):
+    """
+    A thread-safe token bucket that limits the rate at which requests are issued. Each request
+    consumes one token. Tokens are replenished at a given rate, up to a given capacity which
+    determines the size of bursts. A request that finds the bucket empty reserves the next
+    token and waits until it becomes available, so concurrent callers are spread out evenly
+    instead of all retrying at the same time.
+
+    The rate adapts to throttling by the server, using additive-increase/multiplicative-decrease
+    (AIMD): every throttled request cuts the rate by a constant factor, at most once per
+    cooldown period, and every successful request raises it by a constant amount, up to the
+    configured maximum.
+
+    >>> now = [ 0.0 ]
+    >>> def sleep( seconds ): now[ 0 ] += seconds
+    >>> b = TokenBucket( max_rate=2, capacity=2, clock=lambda: now[ 0 ], sleep=sleep )
+    >>> [ b.acquire( ) for i in range( 5 ) ]
+    [0.0, 0.0, 0.5, 0.5, 0.5]
+    >>> b.throttled( ), b.rate
+    (True, 1.0)
+    >>> b.throttled( ), b.rate
+    (False, 1.0)
+    >>> b.acquire( )
+    1.0
+    >>> for i in range( 20 ): b.succeeded( )
+    >>> b.rate
+    2.0
+    """
+
+    # The factor by which the rate is reduced when a request is throttled
+    decrease_factor = 0.5
+
+    # The amount in requests per second by which the rate is increased after a successful request
+    increase = 0.1
+
+    # The minimum time in seconds between two rate reductions. A burst of concurrent requests
+    # is likely to be throttled in its entirety and should only reduce the rate once.
+    cooldown = 1.0
+
+    # The rate in requests per second below which the rate is never reduced
+    min_rate = 0.1
+
+    def __init__( self, max_rate, capacity=None, clock=time.time, sleep=time.sleep ):
+        """
+        :param float max_rate: the initial and maximum rate in requests per second
+
+        :param float capacity: the maximum number of tokens in the bucket, i.e. the size of the
+        largest burst of requests. The default is one second worth of requests at the maximum rate.
+        """
+        super( TokenBucket, self ).__init__( )
+        self.max_rate = float( max_rate )
+        self.rate = self.max_rate
+        self.capacity = float( capacity or max( 1.0, self.max_rate ) )
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock( )
+        self.tokens = self.capacity
+        self.last_refill = clock( )
+        self.last_decrease = None
+
+    def __refill( self ):
+        now = self.clock( )
+        elapsed = max( 0.0, now - self.last_refill )
+        self.tokens = min( self.capacity, self.tokens + elapsed * self.rate )
+        self.last_refill = now
+        return now
+
+    def acquire( self ):
+        """
+        Take a token from the bucket, waiting for it if necessary. Returns the number of seconds
+        waited.
+        """
+        with self.lock:
+            self.__refill( )
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if delay:
+            self.sleep( delay )
+        return delay
+
+    def try_acquire( self ):
+        """
+        Take a token from the bucket if one is available, without waiting. Returns True if a
+        token was taken.
+        """
+        with self.lock:
+            self.__refill( )
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            else:
+                return False
+
+    def throttled( self ):
+        """
+        Record that a request was throttled by the server. Returns True if the rate was reduced
+        as a result.
+        """
+        with self.lock:
+            now = self.__refill( )
+            if self.last_decrease is None or now - self.last_decrease >= self.cooldown:
+                self.last_decrease = now
+                self.rate = max( self.min_rate, self.rate * self.decrease_factor )
+                # Stop the current burst
+                self.tokens = min( self.tokens, 0.0 )
+                return True
+            else:
+                return False
+
+    def succeeded( self ):
+        """
+        Record that a request went through without being throttled.
+        """
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.__refill( )
+                self.rate = min( self.max_rate, self.rate + self.increase )
+
+    def set_max_rate( self, max_rate ):
+        with self.lock:
+            self.__refill( )
+            self.max_rate = float( max_rate )
+            self.rate = min( self.rate, self.max_rate )
+
+
+class Governor( object ):
+    """
+    Limits the rate of requests to AWS across all threads of the process. Requests are
+    accounted for in a separate token bucket for each combination of service and API action,
+    mirroring how AWS throttles requests. The governor is installed into boto connections
+    underneath boto's own retry logic such that every attempt at a request, including those
+    retried by boto, passes through the governor.
+
+    >>> g = Governor( max_rate=10, clock=lambda: 0, sleep=lambda s: None )
+    >>> g.bucket( 'ec2', 'DescribeInstances' ) is g.bucket( 'ec2', 'DescribeInstances' )
+    True
+    >>> g.bucket( 'ec2', 'DescribeInstances' ) is g.bucket( 'ec2', 'RunInstances' )
+    False
+    >>> g.set_max_rate( 5 )
+    >>> g.bucket( 'ec2', 'DescribeInstances' ).rate, g.bucket( 'iam', 'GetUser' ).max_rate
+    (5.0, 5.0)
+    """
+
+    # The default maximum rate in requests per second for each service and action. It is well
+    # above what AWS sustains for most actions, so by default requests are only slowed down once
+    # AWS starts throttling them and the rate backs off from there.
+    default_max_rate = 100.0
+
+    # Substrings of the body of an HTTP response that indicate that the request was throttled
+    throttling_markers = ('RequestLimitExceeded',
+                          'Request limit exceeded',
+                          'Rate exceeded',
+                          '<Code>Throttling</Code>',
+                          '<Code>SlowDown</Code>')
+
+    def __init__( self, max_rate=None, clock=time.time, sleep=time.sleep ):
+        super( Governor, self ).__init__( )
+        self.max_rate = float( max_rate or self.default_max_rate )
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock( )
+        self.buckets = { }
+
+    def bucket( self, service, action ):
+        """
+        Return the token bucket for the given AWS service and API action.
+
+        :rtype: TokenBucket
+        """
+        key = (service, action)
+        with self.lock:
+            try:
+                return self.buckets[ key ]
+            except KeyError:
+                bucket = TokenBucket( self.max_rate, clock=self.clock, sleep=self.sleep )
+                self.buckets[ key ] = bucket
+                return bucket
+
+    def set_max_rate( self, max_rate ):
+        """
+        Change the maximum rate of all current and future token buckets.
+        """
+        with self.lock:
+            self.max_rate = float( max_rate or self.default_max_rate )
+            buckets = self.buckets.values( )
+        for bucket in buckets:
+            bucket.set_max_rate( self.max_rate )
+
+    @classmethod
+    def is_throttled( cls, response ):
+        """
+        Test if the given HTTP response from AWS indicates that the request was throttled.
+        """
+        if response.status in (400, 503):
+            # boto's HTTPResponse caches the body so reading it here doesn't prevent boto
+            # from reading it again.
+            body = response.read( )
+            return any( marker in body for marker in cls.throttling_markers )
+        else:
+            return False
+
+    def install( self, connection, service ):
+        """
+        Route all requests made by the given boto connection through this governor.
+
+        :param boto.connection.AWSAuthConnection connection: the connection
+
+        :param str service: the name of the service the connection talks to, e.g. 'ec2'
+
+        :return: the connection
+        """
+        mexe = connection._mexe
+
+        def governed_mexe( request, sender=None, override_num_retries=None, retry_handler=None ):
+            # Query APIs like EC2 and IAM identify the action by a request parameter, REST APIs
+            # like S3 by the HTTP method.
+            action = request.params.get( 'Action' ) or request.method
+            bucket = self.bucket( service, action )
+
+            # boto invokes the sender once per attempt
+            def governed_sender( http_connection, method, path, body, headers ):
+                bucket.acquire( )
+                if sender is None:
+                    http_connection.request( method, path, body, headers )
+                    response = http_connection.getresponse( )
+                else:
+                    response = sender( http_connection, method, path, body, headers )
+                if self.is_throttled( response ):
+                    if bucket.throttled( ):
+                        log.info( '%s %s requests are being throttled, reducing rate to %.2f/s.',
+                                  service, action, bucket.rate )
+                else:
+                    bucket.succeeded( )
+                return response
+
+            return mexe( request,
+                         sender=governed_sender,
+                         override_num_retries=override_num_retries,
+                         retry_handler=retry_handler )
+
+        connection._mexe = governed_mexe
+        return connection
+
+
+@sync_memoize
+def aws_governor( ):
+    """
+    Return the process-wide governor for requests to AWS.
+
+    :rtype: Governor
+    """
+    return Governor( )
@@ -0,0 +1,194 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from bd2k.util import sync_memoize
+
+from cgcloud.lib.util import cache_dir
+
+log = logging.getLogger( __name__ )
+
+
+class IdentityCache( object ):
+    """
+    Remembers facts about the AWS identity behind a set of credentials, like the account ID or
+    the IAM user name, that would otherwise cost one or more requests to AWS in every
+    invocation. Entries are keyed by access key ID and region and expire after a given number of
+    seconds. The cache is persisted to a file such that it carries over between invocations.
+    Access key IDs are hashed before being used as keys. Failed lookups, i.e. lookups that yield
+    None, are not cached.
+
+    >>> now = [ 0.0 ]
+    >>> cache = IdentityCache( path=None, ttl=60, clock=lambda: now[ 0 ] )
+    >>> lookups = [ ]
+    >>> def lookup( ):
+    ...     lookups.append( now[ 0 ] )
+    ...     return '123456789012'
+    >>> cache.get( 'AKID', 'us-west-2', 'account', lookup )
+    '123456789012'
+    >>> cache.get( 'AKID', 'us-west-2', 'account', lookup ), lookups
+    ('123456789012', [0.0])
+    >>> cache.get( 'AKID', 'us-east-1', 'account', lookup ), lookups
+    ('123456789012', [0.0, 0.0])
+    >>> now[ 0 ] = 61.0
+    >>> cache.get( 'AKID', 'us-west-2', 'account', lookup ), lookups
+    ('123456789012', [0.0, 0.0, 61.0])
+    >>> cache.invalidate( 'AKID' )
+    2
+    >>> cache.get( 'AKID', 'us-west-2', 'user_name', lambda: None ) is None
+    True
+    >>> cache.invalidate( )
+    0
+
+    Individual lookups may expire sooner than the cache's default:
+
+    >>> cache.get( 'AKID', 'us-west-2', 'group', lambda: [ 'alice' ], ttl=10 )
+    ['alice']
+    >>> now[ 0 ] = 72.0
+    >>> cache.get( 'AKID', 'us-west-2', 'group', lambda: [ 'alice', 'bob' ], ttl=10 )
+    ['alice', 'bob']
+    """
+
+    # The default number of seconds after which an entry expires
+    default_ttl = 24 * 60 * 60
+
+    def __init__( self, path, ttl=None, clock=time.time ):
+        """
+        :param str|None path: the path of the file to load the cache from and save it to or None
+        if the cache shouldn't be persisted
+
+        :param float ttl: the number of seconds after which an entry expires. Zero disables the
+        cache.
+        """
+        super( IdentityCache, self ).__init__( )
+        self.path = path
+        self.ttl = self.default_ttl if ttl is None else float( ttl )
+        self.clock = clock
+        self.lock = threading.Lock( )
+        self.entries = { }
+        if path is not None:
+            self.entries = self.__load( )
+
+    @staticmethod
+    def _key( access_key_id, region ):
+        return '%s:%s' % (hashlib.sha1( access_key_id ).hexdigest( ), region)
+
+    def get( self, access_key_id, region, name, lookup, ttl=None ):
+        """
+        Return the value of the named fact about the given credentials in the given region,
+        invoking the given callable to look it up if the cache has no current value for it.
+
+        :param float ttl: the number of seconds after which the value expires, if that is to be
+        sooner than the expiry of other entries in this cache
+        """
+        value = self.peek( access_key_id, region, name, ttl=ttl )
+        if value is None:
+            value = lookup( )
+            if value is not None:
+                self.put( access_key_id, region, name, value )
+        return value
+
+    def peek( self, access_key_id, region, name, ttl=None ):
+        """
+        Return the current value of the named fact about the given credentials in the given
+        region or None if the cache has no current value for it.
+        """
+        ttl = self.ttl if ttl is None else min( self.ttl, ttl )
+        if not ttl or access_key_id is None:
+            return None
+        key = self._key( access_key_id, region )
+        with self.lock:
+            entry = self.entries.get( key, { } ).get( name )
+        if entry is not None and self.clock( ) - entry[ 'time' ] < ttl:
+            return entry[ 'value' ]
+        else:
+            return None
+
+    def put( self, access_key_id, region, name, value ):
+        """
+        Set the value of the named fact about the given credentials in the given region. A value
+        of None removes the fact from the cache.
+
+        >>> cache = IdentityCache( path=None )
+        >>> cache.put( 'AKID', 'us-west-2', 'foo', 'bar' )
+        >>> cache.peek( 'AKID', 'us-west-2', 'foo' )
+        'bar'
+        >>> cache.put( 'AKID', 'us-west-2', 'foo', None )
+        >>> cache.peek( 'AKID', 'us-west-2', 'foo' ) is None
+        True
+        """
+        if not self.ttl or access_key_id is None:
+            return
+        key = self._key( access_key_id, region )
+
+        def update( entries ):
+            facts = entries.setdefault( key, { } )
+            if value is None:
+                facts.pop( name, None )
+            else:
+                facts[ name ] = dict( value=value, time=self.clock( ) )
+
+        with self.lock:
+            self.__update( update )
+
+    def invalidate( self, access_key_id=None ):
+        """
+        Remove all entries for the given access key ID or all entries if None. Returns the number
+        of entries removed, one per access key ID and region.
+        """
+        prefix = None if access_key_id is None else self._key( access_key_id, '' )
+
+        def invalidate( entries ):
+            keys = [ key for key in entries if prefix is None or key.startswith( prefix ) ]
+            for key in keys:
+                del entries[ key ]
+            return len( keys )
+
+        with self.lock:
+            return self.__update( invalidate )
+
+    def __load( self ):
+        try:
+            with open( self.path ) as f:
+                return json.load( f )
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            log.warn( 'Ignoring corrupt identity cache in %s.', self.path )
+        return { }
+
+    def __update( self, f ):
+        """
+        Apply the given function to the entries and save them. Other processes may have written
+        to the file so the entries are reloaded first. Returns the return value of the function.
+        """
+        if self.path is None:
+            return f( self.entries )
+        self.entries = self.__load( )
+        result = f( self.entries )
+        dir_path, file_name = os.path.split( self.path )
+        with tempfile.NamedTemporaryFile( prefix=file_name + '.',
+                                          dir=dir_path,
+                                          delete=False ) as tmp:
+            json.dump( self.entries, tmp, indent=4, sort_keys=True )
+        os.rename( tmp.name, self.path )
+        return result
+
+
+@sync_memoize
+def identity_cache( ):
+    """
+    Returns the process-wide IdentityCache instance, backed by a file in the cache directory.
+    The value of the environment variable CGCLOUD_IDENTITY_CACHE_TTL, if that variable is
+    present, overrides the default time to live of its entries, in seconds.
+
+    :rtype: IdentityCache
+    """
+    return IdentityCache( os.path.join( cache_dir( ), 'identity.json' ),
+                          ttl=os.environ.get( 'CGCLOUD_IDENTITY_CACHE_TTL' ) )
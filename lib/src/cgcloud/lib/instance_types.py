@@ -0,0 +1,203 @@
+import json
+import logging
+import os
+from collections import namedtuple
+
+from bd2k.util import memoize
+from pkg_resources import resource_string
+
+from cgcloud.lib.util import UserError
+
+log = logging.getLogger( __name__ )
+
+InstanceType = namedtuple( 'InstanceType', [
+    'name',  # the API name of the instance type
+    'cores',  # the number of cores
+    'ecu',  # the computational power of the core times the number of cores, None if unpublished
+    'memory',  # RAM in GB
+    'virtualization_types',  # the supported virtualization types, in order of preference
+    'disks',  # the number of ephemeral (aka 'instance store') volumes
+    'disk_type',  # the type of ephemeral volume
+    'disk_capacity',  # the capacity of each ephemeral volume in GB
+    'nvme',  # are the ephemeral volumes exposed as NVMe devices?
+    'network',  # the network performance as advertised by AWS, e.g. 'High' or '10 Gigabit'
+    'spot_availability',  # can this instance type be used on the spot market?
+    'prices'  # maps region name to on-demand price in dollars per hour
+] )
+
+hvm = 'hvm'  # hardware virtualization
+pv = 'paravirtual'  # para-virtualization
+ssd = 'SSD'  # solid-state disk
+hdd = 'HDD'  # spinning disk
+
+
+class InstanceTypeCatalog( object ):
+    """
+    An indexed collection of EC2 instance types that can be queried by hardware requirements and
+    ranked by price.
+
+    >>> catalog = InstanceTypeCatalog.load( )
+    >>> catalog[ 'm3.large' ].cores
+    2
+    >>> 'c5d.large' in catalog, 'foo.large' in catalog
+    (True, False)
+    >>> catalog[ 'foo.large' ]
+    Traceback (most recent call last):
+    ...
+    UserError: Unknown instance type 'foo.large'
+
+    >>> catalog.cheapest( 'us-west-2', min_cores=16, min_memory=60, min_disks=2,
+    ...                   disk_type=ssd ).name
+    'm5d.4xlarge'
+    >>> [ t.name for t in catalog.find( min_cores=64, nvme=True ) ]
+    ['m5d.24xlarge', 'c5d.18xlarge', 'i3.16xlarge']
+    >>> [ t.name for t in catalog.rank( catalog.find( min_cores=64, nvme=True ),
+    ...                                 'us-west-2', by='price_per_core' ) ]
+    ['c5d.18xlarge', 'm5d.24xlarge', 'i3.16xlarge']
+    >>> catalog.price_per( catalog[ 'r5.large' ], 'us-west-2', 'memory' )
+    0.007875
+    >>> catalog.price_per( catalog[ 'r5.large' ], 'eu-west-1', 'memory' ) is None
+    True
+    """
+
+    # The catalog file format version this code understands
+    version = 1
+
+    # The criteria by which instance types can be ranked
+    rankings = ('price', 'price_per_core', 'price_per_gb')
+
+    def __init__( self, instance_types ):
+        """
+        :param list[InstanceType] instance_types: the instance types, in the order in which they
+        should be listed
+        """
+        super( InstanceTypeCatalog, self ).__init__( )
+        self.instance_types = list( instance_types )
+        self.by_name = dict( (t.name, t) for t in self.instance_types )
+
+    @classmethod
+    def load( cls, path=None ):
+        """
+        Load a catalog from the JSON file at the given path or, if no path is given, from the
+        catalog file that ships with this package.
+
+        :rtype: InstanceTypeCatalog
+        """
+        if path is None:
+            doc = resource_string( __name__, 'instance_types.json' )
+        else:
+            with open( path ) as f:
+                doc = f.read( )
+        doc = json.loads( doc, object_hook=_str_dict )
+        version = doc.get( 'version' )
+        if version != cls.version:
+            raise UserError( "Instance type catalog %s is of version %s but only version %i is "
+                             "supported." % (path or 'instance_types.json', version, cls.version) )
+        return cls( InstanceType( **t ) for t in doc[ 'instance_types' ] )
+
+    def __getitem__( self, name ):
+        """
+        :rtype: InstanceType
+        """
+        try:
+            return self.by_name[ name ]
+        except KeyError:
+            raise UserError( "Unknown instance type '%s'" % name )
+
+    def __contains__( self, name ):
+        return name in self.by_name
+
+    def __iter__( self ):
+        return iter( self.instance_types )
+
+    def names( self ):
+        return [ t.name for t in self.instance_types ]
+
+    def find( self, min_cores=0, min_memory=0, min_disks=0, disk_type=None, nvme=None, spot=None,
+              virtualization_type=None, region=None ):
+        """
+        Return the instance types meeting all of the given requirements, in catalog order.
+
+        :param str disk_type: if not None, the required type of ephemeral volumes
+        :param bool nvme: if not None, whether the ephemeral volumes must or must not be NVMe
+        :param bool spot: if not None, whether the type must or must not be available on the
+        spot market
+        :param str region: if not None, only include types with a known price in that region
+
+        :rtype: list[InstanceType]
+        """
+        return [ t for t in self.instance_types
+            if t.cores >= min_cores
+            and t.memory >= min_memory
+            and t.disks >= min_disks
+            and (disk_type is None or t.disk_type == disk_type)
+            and (nvme is None or t.nvme == nvme)
+            and (spot is None or t.spot_availability == spot)
+            and (virtualization_type is None or virtualization_type in t.virtualization_types)
+            and (region is None or region in t.prices) ]
+
+    @staticmethod
+    def price_per( instance_type, region, resource=None ):
+        """
+        Return the on-demand price of the given instance type in the given region, optionally
+        divided by the amount of the given resource, 'cores' or 'memory', or None if the
+        price is not known.
+
+        :type instance_type: InstanceType
+        :rtype: float|None
+        """
+        price = instance_type.prices.get( region )
+        if price is not None and resource is not None:
+            price /= getattr( instance_type, resource )
+        return price
+
+    def rank( self, instance_types, region, by='price' ):
+        """
+        Sort the given instance types by ascending price, price per core or price per GB of RAM
+        in the given region. Types without a known price in that region are omitted.
+
+        :rtype: list[InstanceType]
+        """
+        resource = { 'price': None, 'price_per_core': 'cores', 'price_per_gb': 'memory' }[ by ]
+        priced = [ (self.price_per( t, region, resource ), t) for t in instance_types ]
+        return [ t for p, t in sorted( priced, key=lambda (p, t): p ) if p is not None ]
+
+    def cheapest( self, region, **requirements ):
+        """
+        Return the cheapest instance type in the given region that meets the given requirements,
+        see find() for details.
+
+        :rtype: InstanceType
+        """
+        ranked = self.rank( self.find( region=region, **requirements ), region )
+        if not ranked:
+            raise UserError( "No instance type in %s meets the requirements." % region )
+        return ranked[ 0 ]
+
+
+def _str_dict( d ):
+    """
+    A JSON object hook that converts unicode keys and string values to str.
+    """
+
+    def _str( v ):
+        if isinstance( v, unicode ):
+            return str( v )
+        elif isinstance( v, list ):
+            return map( _str, v )
+        else:
+            return v
+
+    return dict( (_str( k ), _str( v )) for k, v in d.iteritems( ) )
+
+
+@memoize
+def instance_type_catalog( ):
+    """
+    Return the process-wide instance type catalog. The value of the environment variable
+    CGCLOUD_INSTANCE_TYPES, if that variable is present, is the path of a catalog file that
+    overrides the one shipped with this package.
+
+    :rtype: InstanceTypeCatalog
+    """
+    return InstanceTypeCatalog.load( os.environ.get( 'CGCLOUD_INSTANCE_TYPES' ) )
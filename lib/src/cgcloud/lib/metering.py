@@ -0,0 +1,256 @@
+import json
+import logging
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+
+from bd2k.util import sync_memoize
+
+from cgcloud.lib.governor import Governor
+
+log = logging.getLogger( __name__ )
+
+ApiCall = namedtuple( 'ApiCall', [
+    'service',  # the AWS service, e.g. 'ec2' or 'iam'
+    'operation',  # the API action, e.g. 'DescribeInstances', or the HTTP method for S3
+    'start',  # the time the call was made, in seconds since the epoch
+    'latency',  # the duration of the call in seconds, including retries
+    'attempts',  # the number of HTTP requests made for the call, 1 + the number of retries
+    'throttles',  # the number of attempts that were throttled by AWS
+    'status',  # the HTTP status of the last attempt or the name of the exception it raised
+    'thread',  # the name of the thread that made the call
+    'phase',  # the activity during which the call was made or None if unknown
+    'subject'  # the object, typically a box, on whose behalf the call was made or None
+] )
+
+Activity = namedtuple( 'Activity', [
+    'phase',  # see ApiCall.phase
+    'subject',  # see ApiCall.subject
+    'thread',  # see ApiCall.thread
+    'start',
+    'duration' ] )
+
+
+class Meter( object ):
+    """
+    Records the requests made to AWS, along with the activity and subject they were made for.
+    Activities are tracked per thread and nest, an activity inherits the subject of the
+    enclosing one unless it specifies its own.
+
+    >>> now = [ 0.0 ]
+    >>> m = Meter( clock=lambda: now[ 0 ] )
+    >>> m.enable( )
+    >>> with m.activity( 'prepare', subject='foo' ):
+    ...     m.record( 'ec2', 'DescribeImages', 0.0, latency=0.5, attempts=1, throttles=0,
+    ...               status=200 )
+    ...     with m.activity( 'tag' ):
+    ...         m.record( 'ec2', 'CreateTags', 0.0, latency=1.5, attempts=3, throttles=2,
+    ...                   status=200 )
+    ...     now[ 0 ] = 4.0
+    >>> m.record( 'iam', 'GetUser', 0.0, latency=0.25, attempts=1, throttles=0, status=403 )
+    >>> m.calls[ 1 ].phase, m.calls[ 1 ].subject, m.calls[ 2 ].phase
+    ('tag', 'foo', None)
+    >>> m.summarize( 'operation' ) # doctest: +NORMALIZE_WHITESPACE
+    [('CreateTags', 1, 2, 2, 0, 1.5, 1.5),
+     ('DescribeImages', 1, 0, 0, 0, 0.5, 0.5),
+     ('GetUser', 1, 0, 0, 1, 0.25, 0.25)]
+    >>> m.summarize( 'phase' ) # doctest: +NORMALIZE_WHITESPACE
+    [('tag', 1, 2, 2, 0, 1.5, 1.5),
+     ('prepare', 1, 0, 0, 0, 0.5, 0.5),
+     (None, 1, 0, 0, 1, 0.25, 0.25)]
+    >>> m.wall_times( )
+    [('prepare', 1, 4.0), ('tag', 1, 0.0)]
+    """
+
+    def __init__( self, clock=time.time ):
+        super( Meter, self ).__init__( )
+        self.clock = clock
+        self.enabled = False
+        self.lock = threading.Lock( )
+        self.local = threading.local( )
+        self.calls = [ ]
+        self.activities = [ ]
+
+    def enable( self ):
+        self.enabled = True
+
+    def __stack( self ):
+        try:
+            return self.local.stack
+        except AttributeError:
+            stack = self.local.stack = [ ]
+            return stack
+
+    def current( self ):
+        """
+        Return the phase and subject of the current thread's innermost activity.
+        """
+        stack = self.__stack( )
+        return stack[ -1 ] if stack else (None, None)
+
+    @contextmanager
+    def activity( self, phase, subject=None ):
+        """
+        A context manager for an activity of the current thread. AWS requests made in its body
+        are accounted to the given phase and subject.
+
+        :param str phase: a short name for the activity, e.g. 'prepare'
+
+        :param subject: an object describing what the activity is performed for or a callable
+        returning such an object. A callable is invoked whenever a request is recorded, so the
+        description may change over the course of the activity.
+        """
+        if not self.enabled:
+            yield
+            return
+        stack = self.__stack( )
+        outer_phase, outer_subject = self.current( )
+        stack.append( (phase, outer_subject if subject is None else subject) )
+        start = self.clock( )
+        try:
+            yield
+        finally:
+            _, subject = stack.pop( )
+            # Nested activities of the same phase would be counted twice
+            if phase != outer_phase:
+                activity = Activity( phase=phase,
+                                     subject=self.__label( subject ),
+                                     thread=threading.current_thread( ).name,
+                                     start=start,
+                                     duration=self.clock( ) - start )
+                with self.lock:
+                    self.activities.append( activity )
+
+    @staticmethod
+    def __label( subject ):
+        if callable( subject ):
+            subject = subject( )
+        return None if subject is None else str( subject )
+
+    def record( self, service, operation, start, latency, attempts, throttles, status ):
+        phase, subject = self.current( )
+        call = ApiCall( service=service,
+                        operation=operation,
+                        start=start,
+                        latency=latency,
+                        attempts=attempts,
+                        throttles=throttles,
+                        status=status,
+                        thread=threading.current_thread( ).name,
+                        phase=phase,
+                        subject=self.__label( subject ) )
+        with self.lock:
+            self.calls.append( call )
+
+    def install( self, connection, service ):
+        """
+        Record all requests made by the given boto connection. Should be installed after the
+        governor such that time spent waiting for the governor is included in the latency.
+
+        :param boto.connection.AWSAuthConnection connection: the connection
+
+        :param str service: the name of the service the connection talks to, e.g. 'ec2'
+
+        :return: the connection
+        """
+        mexe = connection._mexe
+
+        def metered_mexe( request, sender=None, override_num_retries=None, retry_handler=None ):
+            operation = request.params.get( 'Action' ) or request.method
+            counts = dict( attempts=0, throttles=0, status=None )
+
+            # boto invokes the sender once per attempt
+            def metered_sender( http_connection, method, path, body, headers ):
+                counts[ 'attempts' ] += 1
+                if sender is None:
+                    http_connection.request( method, path, body, headers )
+                    response = http_connection.getresponse( )
+                else:
+                    response = sender( http_connection, method, path, body, headers )
+                counts[ 'status' ] = response.status
+                if Governor.is_throttled( response ):
+                    counts[ 'throttles' ] += 1
+                return response
+
+            start = self.clock( )
+            try:
+                return mexe( request,
+                             sender=metered_sender,
+                             override_num_retries=override_num_retries,
+                             retry_handler=retry_handler )
+            except Exception as e:
+                counts[ 'status' ] = type( e ).__name__
+                raise
+            finally:
+                self.record( service, operation, start,
+                             latency=self.clock( ) - start, **counts )
+
+        connection._mexe = metered_mexe
+        return connection
+
+    def summarize( self, key ):
+        """
+        Aggregate the recorded calls by the given attribute of ApiCall. Returns one tuple per
+        distinct value of that attribute, consisting of the value, the number of calls, retries,
+        throttles and errors, the total and the maximum latency. The tuples are sorted by
+        descending total latency.
+
+        :param str key: the name of an attribute of ApiCall, e.g. 'operation' or 'phase'
+
+        :rtype: list[tuple]
+        """
+        with self.lock:
+            calls = list( self.calls )
+        groups = OrderedDict( )
+        for call in calls:
+            group = groups.setdefault( getattr( call, key ), [ 0, 0, 0, 0, 0.0, 0.0 ] )
+            group[ 0 ] += 1
+            group[ 1 ] += call.attempts - 1
+            group[ 2 ] += call.throttles
+            group[ 3 ] += not isinstance( call.status, int ) or call.status >= 400
+            group[ 4 ] += call.latency
+            group[ 5 ] = max( group[ 5 ], call.latency )
+        rows = [ (value,) + tuple( group ) for value, group in groups.iteritems( ) ]
+        rows.sort( key=lambda row: row[ 5 ], reverse=True )
+        return rows
+
+    def wall_times( self ):
+        """
+        Return one tuple per phase, consisting of the phase, the number of times an activity of
+        that phase was performed and the total time spent in those activities, summed over all
+        threads. The tuples are sorted by descending total time.
+
+        :rtype: list[tuple]
+        """
+        with self.lock:
+            activities = list( self.activities )
+        totals = OrderedDict( )
+        for activity in activities:
+            total = totals.setdefault( activity.phase, [ 0, 0.0 ] )
+            total[ 0 ] += 1
+            total[ 1 ] += activity.duration
+        rows = [ (phase,) + tuple( total ) for phase, total in totals.iteritems( ) ]
+        rows.sort( key=lambda row: row[ 2 ], reverse=True )
+        return rows
+
+    def dump( self, path ):
+        """
+        Write all recorded calls and activities to the given file, as JSON.
+        """
+        with self.lock:
+            doc = dict( calls=[ call._asdict( ) for call in self.calls ],
+                        activities=[ activity._asdict( ) for activity in self.activities ] )
+        with open( path, 'w' ) as f:
+            json.dump( doc, f, indent=4 )
+
+
+@sync_memoize
+def aws_meter( ):
+    """
+    Return the process-wide meter for requests to AWS. It is disabled until enable() is invoked
+    on it.
+
+    :rtype: Meter
+    """
+    return Meter( )
@@ -0,0 +1,103 @@
+import sys
+import threading
+
+
+def prefetching_pager( fetch_page ):
+    """
+    Yields the items of a paginated AWS listing, fetching the next page in a background thread
+    while the items of the current page are being consumed. At most one page is fetched ahead.
+
+    :param callable fetch_page: a function that takes the marker or token identifying a page,
+    None for the first page, and returns a tuple of the items on that page and the marker or
+    token identifying the next page or None if there is no next page. The function is invoked
+    in a background thread so it needs to look up the boto connection it uses when it is invoked.
+
+    >>> pages = { None: ( [ 1, 2 ], 'a' ), 'a': ( [ 3 ], 'b' ), 'b': ( [ ], None ) }
+    >>> fetched = [ ]
+    >>> def fetch_page( marker ):
+    ...     fetched.append( marker )
+    ...     return pages[ marker ]
+    >>> items = prefetching_pager( fetch_page )
+    >>> next( items ), fetched
+    (1, [None, 'a'])
+    >>> list( items ), fetched
+    ([2, 3], [None, 'a', 'b'])
+
+    Errors are raised in the consuming thread:
+
+    >>> def fail( marker ):
+    ...     if marker: raise RuntimeError( 'page %s' % marker )
+    ...     return [ 1 ], 'x'
+    >>> list( prefetching_pager( fail ) )
+    Traceback (most recent call last):
+    ...
+    RuntimeError: page x
+    """
+    fetch = _PageFetch( fetch_page, None )
+    while fetch is not None:
+        items, marker = fetch.result( )
+        fetch = None if marker is None else _PageFetch( fetch_page, marker )
+        for item in items:
+            yield item
+
+
+def iam_pager( fetch_page, result_attribute_name ):
+    """
+    A prefetching_pager() for IAM listings that are paginated with markers.
+
+    :param callable fetch_page: a function that takes a marker, None for the first page, and
+    returns the response of an IAM List* request, e.g. lambda marker: iam.list_roles(
+    marker=marker ).
+
+    :param str result_attribute_name: the name of the attribute of the response that holds the
+    items, e.g. 'roles'
+    """
+
+    def fetch( marker ):
+        result = fetch_page( marker )
+        items = getattr( result, result_attribute_name )
+        return items, result.marker if result.is_truncated == 'true' else None
+
+    return prefetching_pager( fetch )
+
+
+def ec2_pager( fetch_page ):
+    """
+    A prefetching_pager() for EC2 listings that are paginated with NextToken.
+
+    :param callable fetch_page: a function that takes a token, None for the first page, and
+    returns the boto ResultSet of a Describe* request
+    """
+
+    def fetch( token ):
+        result = fetch_page( token )
+        return result, result.next_token or None
+
+    return prefetching_pager( fetch )
+
+
+class _PageFetch( threading.Thread ):
+    """
+    A thread that fetches a single page.
+    """
+
+    def __init__( self, fetch_page, marker ):
+        super( _PageFetch, self ).__init__( name='PageFetch' )
+        self.daemon = True
+        self.fetch_page = fetch_page
+        self.marker = marker
+        self.page = None
+        self.exc_info = None
+        self.start( )
+
+    def run( self ):
+        try:
+            self.page = self.fetch_page( self.marker )
+        except:
+            self.exc_info = sys.exc_info( )
+
+    def result( self ):
+        self.join( )
+        if self.exc_info is not None:
+            raise self.exc_info[ 0 ], self.exc_info[ 1 ], self.exc_info[ 2 ]
+        return self.page
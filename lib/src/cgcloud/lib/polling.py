@@ -0,0 +1,224 @@
+import atexit
+import errno
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from bd2k.util import sync_memoize
+from boto.exception import BotoServerError
+
+from cgcloud.lib.context import throttlePredicate
+from cgcloud.lib.util import cache_dir
+
+log = logging.getLogger( __name__ )
+
+
+class TransitionTimes( object ):
+    """
+    The expected duration in seconds of state transitions of EC2 resources, keyed by the kind of
+    resource, the state it transitions from and the state it transitions to. Starts out with
+    built-in estimates and refines them with every observed transition, using an exponential
+    moving average. The estimates are persisted to a file such that they carry over between
+    invocations.
+
+    >>> times = TransitionTimes( path=None )
+    >>> times.expected( 'instance', 'pending', 'running' )
+    30.0
+    >>> times.observe( 'instance', 'pending', 'running', 50 )
+    >>> times.expected( 'instance', 'pending', 'running' )
+    34.0
+    >>> times.expected( 'instance', 'foo', 'bar' )
+    20.0
+    """
+
+    defaults = {
+        'instance:pending>running': 30,
+        'instance:stopped>running': 30,
+        'instance:running>stopped': 60,
+        'instance:stopping>stopped': 30,
+        'instance:running>terminated': 45,
+        'instance:stopped>terminated': 30,
+        'instance:shutting-down>terminated': 30,
+        'instance:without-public-ip>with-public-ip': 5,
+        'image:pending>available': 300,
+        'image:undiscoverable>discoverable': 30,
+        'volume:creating>available': 10,
+        'volume:available>in-use': 10,
+        'spot-request:open>active': 60 }
+
+    default = 20
+
+    # The weight of a new observation in the moving average
+    weight = 0.2
+
+    def __init__( self, path ):
+        """
+        :param str|None path: the path of the file to load estimates from and save them to or
+        None if the estimates shouldn't be persisted
+        """
+        super( TransitionTimes, self ).__init__( )
+        self.path = path
+        self.lock = threading.Lock( )
+        self.times = { }
+        self.dirty = False
+        if path is not None:
+            self.__load( )
+
+    @staticmethod
+    def _key( kind, from_state, to_state ):
+        return '%s:%s>%s' % (kind, from_state, to_state)
+
+    def expected( self, kind, from_state, to_state ):
+        """
+        :rtype: float
+        """
+        key = self._key( kind, from_state, to_state )
+        with self.lock:
+            return float( self.times.get( key ) or self.defaults.get( key, self.default ) )
+
+    def observe( self, kind, from_state, to_state, duration ):
+        key = self._key( kind, from_state, to_state )
+        with self.lock:
+            expected = self.times.get( key ) or self.defaults.get( key, self.default )
+            self.times[ key ] = (1 - self.weight) * expected + self.weight * duration
+            if not self.dirty and self.path is not None:
+                atexit.register( self.save )
+            self.dirty = True
+
+    def __load( self ):
+        try:
+            with open( self.path ) as f:
+                times = json.load( f )
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            log.warn( 'Ignoring corrupt transition times in %s.', self.path )
+        else:
+            self.times.update( (k, float( v )) for k, v in times.iteritems( ) )
+
+    def save( self ):
+        with self.lock:
+            if self.dirty:
+                dir_path, file_name = os.path.split( self.path )
+                with tempfile.NamedTemporaryFile( prefix=file_name + '.',
+                                                  dir=dir_path,
+                                                  delete=False ) as f:
+                    json.dump( self.times, f, indent=4, sort_keys=True )
+                os.rename( f.name, self.path )
+                self.dirty = False
+
+
+@sync_memoize
+def transition_times( ):
+    """
+    Returns the process-wide TransitionTimes instance, backed by a file in the cache directory.
+
+    :rtype: TransitionTimes
+    """
+    return TransitionTimes( os.path.join( cache_dir( ), 'transition_times.json' ) )
+
+
+class PollingSchedule( object ):
+    """
+    Determines how long to wait before polling the state of a resource that is expected to
+    transition from one given state to another. Early on, while the transition is unlikely to be
+    complete, polls are far apart. The closer the expected time of completion, the shorter the
+    delay. Once that time has passed, the delay grows again, slowly. After a throttled request,
+    the delay backs off exponentially, with random jitter such that concurrent pollers don't move
+    in lockstep.
+
+    >>> now = [ 0 ]
+    >>> times = TransitionTimes( path=None )
+    >>> s = PollingSchedule( 'image', 'pending', 'available', times=times, clock=lambda: now[ 0 ] )
+    >>> s.delay( )
+    60.0
+    >>> now[ 0 ] = 280
+    >>> s.delay( )
+    10.0
+    >>> now[ 0 ] = 299.5
+    >>> s.delay( )
+    1.0
+    >>> now[ 0 ] = 340
+    >>> s.delay( )
+    10.0
+    >>> s.throttled( ); s.throttled( ); s.throttled( ); s.throttled( ); s.throttled( )
+    >>> 16 <= s.delay( ) <= 32
+    True
+    >>> s.polled( )
+    >>> s.delay( )
+    10.0
+    >>> s.observe( 'available' )
+    >>> times.expected( 'image', 'pending', 'available' )
+    308.0
+    """
+
+    min_delay = 1.0
+    max_delay = 60.0
+
+    def __init__( self, kind, from_state, to_state, times=None, clock=time.time ):
+        super( PollingSchedule, self ).__init__( )
+        self.kind = kind
+        self.from_state = from_state
+        self.to_state = to_state
+        self.times = transition_times( ) if times is None else times
+        self.expected = self.times.expected( kind, from_state, to_state )
+        self.clock = clock
+        self.start = clock( )
+        self.throttles = 0
+
+    def delay( self ):
+        """
+        Return the number of seconds to wait before the next poll.
+
+        :rtype: float
+        """
+        remaining = self.expected - (self.clock( ) - self.start)
+        delay = remaining / 2 if remaining > 0 else -remaining / 4
+        delay = min( max( delay, self.min_delay ), self.max_delay )
+        if self.throttles:
+            cap = max( delay, min( self.max_delay, self.min_delay * 2 ** self.throttles ) )
+            delay = cap / 2 + random.uniform( 0, cap / 2 )
+        return delay
+
+    def sleep( self ):
+        """
+        Wait before the next poll. Returns the number of seconds waited.
+        """
+        delay = self.delay( )
+        time.sleep( delay )
+        return delay
+
+    def throttled( self ):
+        self.throttles += 1
+
+    def polled( self ):
+        self.throttles = 0
+
+    @contextmanager
+    def polling( self ):
+        """
+        A context manager for a poll. Throttling errors raised in the body are swallowed and
+        cause subsequent delays to back off. Once a poll succeeds, the back-off is reset.
+        """
+        try:
+            yield
+        except BotoServerError as e:
+            if throttlePredicate( e ):
+                self.throttled( )
+                log.info( 'Request throttled while polling %s state, backing off.', self.kind )
+            else:
+                raise
+        else:
+            self.polled( )
+
+    def observe( self, to_state ):
+        """
+        Record that the resource transitioned to the given state.
+        """
+        self.times.observe( self.kind, self.from_state, to_state, self.clock( ) - self.start )
@@ -0,0 +1,316 @@
+import errno
+import logging
+import math
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+log = logging.getLogger( __name__ )
+
+
+class PortProber( object ):
+    """
+    Waits for a TCP port to accept connections on any number of hosts, using a single thread.
+    Connection attempts are made with non-blocking sockets and multiplexed with poll(), or with
+    select() on platforms that lack poll(). A host whose port refuses the connection or doesn't
+    answer within a timeout is tried again after a delay that doubles with every failed attempt,
+    up to a maximum. As soon as the port of a host accepts a connection, the host is removed from
+    the prober and the given callback is invoked with the key the host was added under. The
+    callback is invoked on the prober's thread so it should return quickly, e.g. by handing the
+    host off to a thread pool.
+
+    >>> server = socket.socket( )
+    >>> server.bind( ('127.0.0.1', 0) )
+    >>> server.listen( 5 )
+    >>> opened = [ ]
+    >>> prober = PortProber( opened.append, port=server.getsockname( )[ 1 ], min_backoff=0.01 )
+    >>> prober.add( 'a', '127.0.0.1' )
+    >>> prober.wait( timeout=10 ), opened
+    (True, ['a'])
+
+    A port that refuses connections is probed until the host is discarded:
+
+    >>> closed = socket.socket( )
+    >>> closed.bind( ('127.0.0.1', 0) )
+    >>> prober.port = closed.getsockname( )[ 1 ]
+    >>> prober.add( 'b', '127.0.0.1' )
+    >>> prober.wait( timeout=0.1 ), prober.discard( 'b' ), prober.wait( timeout=0 )
+    (False, True, True)
+    >>> prober.close( )
+    >>> server.close( )
+    >>> closed.close( )
+    """
+
+    # The maximum number of connection attempts in flight at any time. Each attempt holds a file
+    # descriptor so this keeps the prober well below the default per-process limit of 1024.
+    max_connecting = 512
+
+    def __init__( self, callback, port=22, timeout=5, min_backoff=1, max_backoff=30 ):
+        """
+        :param callable callback: the function to invoke with the key of each host whose port
+        accepts connections. Any exception raised by it is raised again by wait(). Should the
+        prober's thread itself fail, wait() and add() raise the exception that caused it.
+
+        :param float timeout: the number of seconds to wait for a connection attempt to succeed
+
+        :param float min_backoff: the number of seconds to wait after the first failed attempt
+
+        :param float max_backoff: the maximum number of seconds to wait between attempts
+        """
+        super( PortProber, self ).__init__( )
+        self.callback = callback
+        self.port = port
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.condition = threading.Condition( )
+        # Maps the key of each pending host to its _Target
+        self.targets = { }
+        # The number of callbacks currently being invoked
+        self.dispatching = 0
+        self.exc_info = None
+        # The exception that ended the prober's thread, if any
+        self.failure = None
+        self.closed = False
+        self.wakeup_fds = os.pipe( )
+        self.thread = threading.Thread( target=self.__run, name='PortProber' )
+        self.thread.daemon = True
+        self.thread.start( )
+
+    def add( self, key, host ):
+        """
+        Start probing the port on the given host.
+
+        :param key: a hashable object identifying the host, passed to the callback
+
+        :param str host: the host name or IP address of the host
+        """
+        with self.condition:
+            self.__check_failure( )
+            if key in self.targets:
+                raise ValueError( "Already probing '%s'" % key )
+            self.targets[ key ] = _Target( key, host )
+        self.__wakeup( )
+
+    def discard( self, key ):
+        """
+        Stop probing the host with the given key. Returns True if the host was being probed or
+        False if it isn't, e.g. because its port accepted a connection.
+        """
+        with self.condition:
+            discarded = self.targets.pop( key, None ) is not None
+            self.condition.notify_all( )
+        self.__wakeup( )
+        return discarded
+
+    def pending( self ):
+        """
+        Return the keys of the hosts being probed.
+        """
+        with self.condition:
+            return self.targets.keys( )
+
+    def wait( self, timeout=None ):
+        """
+        Wait until no host is being probed anymore or until the given number of seconds have
+        passed. Returns True in the former case and False in the latter.
+        """
+        deadline = None if timeout is None else time.time( ) + timeout
+        with self.condition:
+            while self.exc_info is None and self.failure is None and (
+                        self.targets or self.dispatching):
+                remaining = None if deadline is None else deadline - time.time( )
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait( remaining )
+            if self.exc_info is not None:
+                exc_info, self.exc_info = self.exc_info, None
+                raise exc_info[ 0 ], exc_info[ 1 ], exc_info[ 2 ]
+            self.__check_failure( )
+            return True
+
+    def close( self ):
+        with self.condition:
+            self.closed = True
+            self.targets.clear( )
+        self.__wakeup( )
+        self.thread.join( )
+        for fd in self.wakeup_fds:
+            os.close( fd )
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        self.close( )
+
+    def __wakeup( self ):
+        os.write( self.wakeup_fds[ 1 ], 'x' )
+
+    def __check_failure( self ):
+        if self.failure is not None:
+            raise self.failure[ 0 ], self.failure[ 1 ], self.failure[ 2 ]
+
+    def __run( self ):
+        connecting = [ ]
+        try:
+            self.__probe( connecting )
+        except:
+            log.error( 'Port prober failed.', exc_info=True )
+            with self.condition:
+                self.failure = sys.exc_info( )
+                self.condition.notify_all( )
+        finally:
+            for target in connecting:
+                target.close( )
+
+    def __probe( self, connecting ):
+        """
+        Probe the pending hosts until the prober is closed, tracking the targets with a
+        connection attempt in flight in the given list.
+        """
+        while True:
+            opened = [ ]
+            with self.condition:
+                if self.closed:
+                    break
+                now = time.time( )
+                # Close the sockets of hosts that were discarded
+                for target in connecting:
+                    if self.targets.get( target.key ) is not target:
+                        target.close( )
+                connecting[ : ] = [ target for target in connecting if target.socket is not None ]
+                for target in self.targets.itervalues( ):
+                    if len( connecting ) >= self.max_connecting:
+                        break
+                    if target.socket is None and target.next_attempt <= now:
+                        if target.connect( self.port, now + self.timeout ):
+                            opened.append( target )
+                        elif target.socket is not None:
+                            connecting.append( target )
+                        else:
+                            self.__back_off( target, now )
+                deadlines = [ target.deadline for target in connecting ]
+                if len( connecting ) < self.max_connecting:
+                    deadlines.extend( target.next_attempt for target in self.targets.itervalues( )
+                                      if target.socket is None )
+            if not opened:
+                timeout = max( min( deadlines ) - now, 0 ) if deadlines else None
+                readable, writable = _wait( self.wakeup_fds[ 0 ],
+                                            [ t.socket for t in connecting ],
+                                            timeout )
+                if readable:
+                    os.read( self.wakeup_fds[ 0 ], 4096 )
+                with self.condition:
+                    now = time.time( )
+                    for target in connecting:
+                        if target.socket in writable:
+                            error = target.socket.getsockopt( socket.SOL_SOCKET, socket.SO_ERROR )
+                            target.close( )
+                            if error:
+                                self.__back_off( target, now )
+                            else:
+                                opened.append( target )
+                        elif target.deadline <= now:
+                            target.close( )
+                            self.__back_off( target, now )
+            with self.condition:
+                opened = [ target for target in opened
+                           if self.targets.get( target.key ) is target ]
+                for target in opened:
+                    del self.targets[ target.key ]
+                self.dispatching += len( opened )
+            for target in opened:
+                log.debug( 'Port %i on %s accepted a connection after %i attempt(s).',
+                           self.port, target.host, target.attempts + 1 )
+                try:
+                    self.callback( target.key )
+                except:
+                    with self.condition:
+                        if self.exc_info is None:
+                            self.exc_info = sys.exc_info( )
+                finally:
+                    with self.condition:
+                        self.dispatching -= 1
+                        self.condition.notify_all( )
+
+    def __back_off( self, target, now ):
+        delay = min( self.min_backoff * 2 ** target.attempts, self.max_backoff )
+        target.attempts += 1
+        target.next_attempt = now + delay
+
+
+class _Target( object ):
+    """
+    The state of probing a single host.
+    """
+
+    def __init__( self, key, host ):
+        super( _Target, self ).__init__( )
+        self.key = key
+        self.host = host
+        self.attempts = 0
+        self.next_attempt = 0
+        self.socket = None
+        self.deadline = None
+
+    def connect( self, port, deadline ):
+        """
+        Start a connection attempt. Returns True if the attempt succeeded immediately. Otherwise
+        the socket attribute is None if the attempt failed immediately.
+        """
+        s = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        s.setblocking( 0 )
+        try:
+            error = s.connect_ex( (self.host, port) )
+        except socket.error:
+            error = errno.EHOSTUNREACH
+        if error == 0:
+            s.close( )
+            return True
+        elif error in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.socket, self.deadline = s, deadline
+        else:
+            s.close( )
+        return False
+
+    def close( self ):
+        if self.socket is not None:
+            self.socket.close( )
+            self.socket = None
+
+
+def _wait( fd, sockets, timeout ):
+    """
+    Wait until the given file descriptor is readable, any of the given sockets is writable or the
+    given number of seconds have passed, whichever comes first. Returns a boolean indicating
+    whether the file descriptor is readable and the set of writable sockets. Unlike select(),
+    poll() isn't limited to file descriptors below FD_SETSIZE so it is used where available.
+
+    >>> r, w = os.pipe( )
+    >>> _wait( r, [ ], 0 )
+    (False, set([]))
+    >>> os.write( w, 'x' ), _wait( r, [ ], None )
+    (1, (True, set([])))
+    >>> os.close( r ), os.close( w )
+    (None, None)
+    """
+    if hasattr( select, 'poll' ):
+        poll = select.poll( )
+        poll.register( fd, select.POLLIN )
+        sockets_by_fd = { }
+        for s in sockets:
+            sockets_by_fd[ s.fileno( ) ] = s
+            # A failed connection attempt is signalled by POLLERR or POLLHUP, which poll() reports
+            # regardless of the registered events, so any event means the attempt completed.
+            poll.register( s, select.POLLOUT )
+        events = poll.poll( None if timeout is None else int( math.ceil( timeout * 1000 ) ) )
+        readable = any( event_fd == fd for event_fd, _ in events )
+        writable = set( sockets_by_fd[ event_fd ] for event_fd, _ in events if event_fd != fd )
+    else:
+        readable, writable, _ = select.select( [ fd ], sockets, [ ], timeout )
+        readable, writable = bool( readable ), set( writable )
+    return readable, writable
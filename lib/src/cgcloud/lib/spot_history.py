@@ -0,0 +1,241 @@
+import calendar
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from bd2k.util import sync_memoize
+from boto.utils import parse_ts
+
+from cgcloud.lib.paging import ec2_pager
+from cgcloud.lib.util import cache_dir
+
+log = logging.getLogger( __name__ )
+
+class SpotPrice( namedtuple( 'SpotPrice', [ 'timestamp', 'availability_zone', 'price' ] ) ):
+    """
+    A single data point of the spot price history of an instance type. The timestamp is in
+    seconds since the epoch.
+    """
+    __slots__ = ( )
+
+
+class SpotHistoryStore( object ):
+    """
+    Keeps the spot price history of instance types in a local SQLite database, keyed by region,
+    instance type and product description. For each key, the store remembers the time window it
+    has history for, such that subsequent requests for the same key only fetch the records that
+    were added to EC2 since the last fetch. Requests for a window that was fetched less than
+    max_age seconds ago don't fetch anything at all.
+
+    >>> now = [ 1000.0 ]
+    >>> fetches = [ ]
+    >>> def fetch( start, end ):
+    ...     fetches.append( (start, end) )
+    ...     return [ SpotPrice( t, 'us-west-2a', t / 1000.0 ) for t in range( 0, int( end ), 100 )
+    ...              if t >= start ]
+    >>> store = SpotHistoryStore( path=None, max_age=60, clock=lambda: now[ 0 ] )
+    >>> key = ( 'us-west-2', 'm3.large', 'Linux/UNIX' )
+    >>> [ h.timestamp for h in store.history( *key, start=700, fetch=fetch ) ], fetches
+    ([900, 800, 700], [(700, 1000.0)])
+
+    Within max_age, the store doesn't fetch:
+
+    >>> now[ 0 ] = 1050.0
+    >>> len( store.history( *key, start=800, fetch=fetch ) ), fetches
+    (2, [(700, 1000.0)])
+
+    Later, it only fetches what's new and when asked for more history, what's older:
+
+    >>> now[ 0 ] = 1250.0
+    >>> [ h.timestamp for h in store.history( *key, start=500, fetch=fetch ) ]
+    [1200, 1100, 1000, 900, 800, 700, 600, 500]
+    >>> fetches
+    [(700, 1000.0), (1000.0, 1250.0), (500, 700.0)]
+    """
+
+    # Records older than this many seconds are removed from the store
+    retention = 90 * 24 * 60 * 60
+
+    def __init__( self, path, max_age=5 * 60, clock=time.time ):
+        """
+        :param str|None path: the path to the database file or None if the store should only be
+        kept in memory
+
+        :param float max_age: the number of seconds for which the stored history is considered
+        current
+        """
+        super( SpotHistoryStore, self ).__init__( )
+        self.max_age = max_age
+        self.clock = clock
+        self.lock = threading.Lock( )
+        self.db = sqlite3.connect( ':memory:' if path is None else path,
+                                   timeout=60, check_same_thread=False )
+        with self.lock, self.db:
+            self.db.executescript( """
+                CREATE TABLE IF NOT EXISTS price (
+                    region TEXT, instance_type TEXT, product TEXT,
+                    zone TEXT, timestamp INTEGER, price REAL,
+                    PRIMARY KEY ( region, instance_type, product, timestamp, zone ) );
+                CREATE TABLE IF NOT EXISTS coverage (
+                    region TEXT, instance_type TEXT, product TEXT,
+                    start REAL, end REAL,
+                    PRIMARY KEY ( region, instance_type, product ) );""" )
+
+    def history( self, region, instance_type, product, start, fetch, end=None ):
+        """
+        Return the spot price history for the given key between the given start and end time,
+        most recent data point first, fetching any part of the window not covered by the store.
+
+        :param float start: the start of the window, in seconds since the epoch
+
+        :param float|None end: the end of the window, in seconds since the epoch, or None for now
+
+        :param callable fetch: a function that takes a start and end time in seconds since the
+        epoch and returns an iterable of SpotPrice instances for that window
+
+        :rtype: list[SpotPrice]
+        """
+        return list( self.iter_history( region, instance_type, product, start, fetch, end ) )
+
+    # The number of data points to read from the database at a time
+    page_size = 1000
+
+    def iter_history( self, region, instance_type, product, start, fetch, end=None ):
+        """
+        Like history() but yields the data points, reading them from the database a page at a
+        time, such that the memory used is independent of the length of the history.
+
+        >>> store = SpotHistoryStore( path=None, clock=lambda: 10.0 )
+        >>> store.page_size = 2
+        >>> fetch = lambda start, end: [ SpotPrice( 5, z, 0.1 ) for z in 'abc' ]
+        >>> [ h.availability_zone for h in store.iter_history( 'r', 't', 'p', 0, fetch ) ]
+        [u'c', u'b', u'a']
+
+        :rtype: collections.Iterator[SpotPrice]
+        """
+        key = (region, instance_type, product)
+        now = self.clock( )
+        if end is None:
+            end = now
+        coverage = self.__coverage( key )
+        if coverage is None:
+            windows = [ (start, now) ]
+        else:
+            covered_start, covered_end = coverage
+            windows = [ ]
+            if now - covered_end > self.max_age and end > covered_end:
+                windows.append( (covered_end, now) )
+            if start < covered_start:
+                windows.append( (start, covered_start) )
+        for window_start, window_end in windows:
+            log.info( 'Fetching spot price history for %s in %s from %s to %s.',
+                      instance_type, region,
+                      time.ctime( window_start ), time.ctime( window_end ) )
+            self.__store( key, fetch( window_start, window_end ), window_start, window_end )
+        # Page through the data points by (timestamp, zone), most recent first
+        last = (end, None)
+        while True:
+            with self.lock:
+                rows = self.db.execute( """
+                    SELECT timestamp, zone, price FROM price
+                    WHERE region = ? AND instance_type = ? AND product = ? AND timestamp >= ?
+                    AND ( timestamp < ? OR timestamp = ? AND ( ? IS NULL OR zone < ? ) )
+                    ORDER BY timestamp DESC, zone DESC LIMIT ?""",
+                                        key + (start, last[ 0 ], last[ 0 ],
+                                               last[ 1 ], last[ 1 ], self.page_size) ).fetchall( )
+            for row in rows:
+                yield SpotPrice( *row )
+            if len( rows ) < self.page_size:
+                break
+            last = rows[ -1 ][ :2 ]
+
+    def __coverage( self, key ):
+        with self.lock:
+            return self.db.execute( """
+                SELECT start, end FROM coverage
+                WHERE region = ? AND instance_type = ? AND product = ?""", key ).fetchone( )
+
+    def __store( self, key, prices, start, end ):
+        rows = [ key + (p.availability_zone, p.timestamp, p.price) for p in prices ]
+        with self.lock, self.db:
+            self.db.executemany( 'INSERT OR REPLACE INTO price VALUES ( ?, ?, ?, ?, ?, ? )', rows )
+            coverage = self.db.execute( """
+                SELECT start, end FROM coverage
+                WHERE region = ? AND instance_type = ? AND product = ?""", key ).fetchone( )
+            if coverage is not None:
+                start, end = min( start, coverage[ 0 ] ), max( end, coverage[ 1 ] )
+            horizon = self.clock( ) - self.retention
+            if start < horizon:
+                self.db.execute( """
+                    DELETE FROM price
+                    WHERE region = ? AND instance_type = ? AND product = ? AND timestamp < ?""",
+                                 key + (horizon,) )
+                start = horizon
+            self.db.execute( 'INSERT OR REPLACE INTO coverage VALUES ( ?, ?, ?, ?, ? )',
+                             key + (start, end) )
+
+
+def spot_price( history ):
+    """
+    Convert a boto SpotPriceHistory object to a SpotPrice.
+
+    >>> from boto.ec2.spotpricehistory import SpotPriceHistory
+    >>> h = SpotPriceHistory( )
+    >>> h.timestamp, h.availability_zone, h.price = '2016-01-01T00:00:10.000Z', 'us-west-2a', 0.5
+    >>> spot_price( h )
+    SpotPrice(timestamp=1451606410, availability_zone='us-west-2a', price=0.5)
+    """
+    return SpotPrice( timestamp=calendar.timegm( parse_ts( history.timestamp ).timetuple( ) ),
+                      availability_zone=history.availability_zone,
+                      price=history.price )
+
+
+def spot_price_history( ctx, instance_type, days, product='Linux/UNIX', stream=False ):
+    """
+    Return the spot price history of the given instance type in the region of the given context
+    over the given number of days, most recent data point first. The history is kept in the
+    process-wide SpotHistoryStore such that only data points that were added since the last
+    invocation need to be requested from EC2.
+
+    :param cgcloud.lib.context.Context ctx: the context whose region and EC2 connection to use
+
+    :param bool stream: if True, return an iterator over the data points instead of a list
+
+    :rtype: list[SpotPrice]|collections.Iterator[SpotPrice]
+    """
+
+    def fetch( start, end ):
+        start, end = (datetime.datetime.utcfromtimestamp( t ).isoformat( ) + 'Z'
+                      for t in (start, end))
+        return (spot_price( h ) for h in ec2_pager(
+            lambda token: ctx.ec2.get_spot_price_history( start_time=start,
+                                                          end_time=end,
+                                                          instance_type=instance_type,
+                                                          product_description=product,
+                                                          max_results=1000,
+                                                          next_token=token ) ))
+
+    store = spot_history_store( )
+    history = store.iter_history if stream else store.history
+    return history( ctx.region, instance_type, product,
+                    start=time.time( ) - datetime.timedelta( days=days ).total_seconds( ),
+                    fetch=fetch )
+
+
+@sync_memoize
+def spot_history_store( ):
+    """
+    Returns the process-wide SpotHistoryStore instance, backed by a database in the cache
+    directory. The value of the environment variable CGCLOUD_SPOT_HISTORY_MAX_AGE, if that
+    variable is present, overrides the number of seconds for which the stored history is
+    considered current.
+
+    :rtype: SpotHistoryStore
+    """
+    max_age = os.environ.get( 'CGCLOUD_SPOT_HISTORY_MAX_AGE' )
+    return SpotHistoryStore( os.path.join( cache_dir( ), 'spot_history.sqlite' ),
+                             **({ } if max_age is None else dict( max_age=float( max_age ) )) )
@@ -0,0 +1,143 @@
+import errno
+import logging
+import os
+import re
+import tempfile
+import threading
+from collections import defaultdict
+
+from bd2k.util import sync_memoize
+from bd2k.util.files import mkdir_p
+
+from cgcloud.lib.util import cache_dir
+
+log = logging.getLogger( __name__ )
+
+
+class SshPubkeyCache( object ):
+    """
+    Remembers SSH public keys by the fingerprint of the EC2 key pair they belong to, in memory
+    and, optionally, in a directory with one file per key. The public key stored in S3 for a
+    given fingerprint never changes, so entries don't expire. Concurrent lookups of the same
+    fingerprint are serialized such that only one of them invokes the fetch function.
+
+    >>> fetches = [ ]
+    >>> def fetch( fingerprint ):
+    ...     fetches.append( fingerprint )
+    ...     return 'ssh-rsa AAAA' + fingerprint.replace( ':', '' )
+    >>> cache = SshPubkeyCache( path=None )
+    >>> cache.get( '00:01', fetch ), cache.get( '00:01', fetch ), fetches
+    ('ssh-rsa AAAA0001', 'ssh-rsa AAAA0001', ['00:01'])
+    >>> cache.discard( '00:01' )
+    >>> cache.get( '00:01', fetch ), fetches
+    ('ssh-rsa AAAA0001', ['00:01', '00:01'])
+
+    Many threads asking for the same key at the same time cause only one fetch:
+
+    >>> from cgcloud.lib.util import pmap
+    >>> keys = pmap( lambda _: cache.get( '00:02', fetch ), range( 20 ), pool_size=10 )
+    >>> set( keys ), fetches.count( '00:02' )
+    (set(['ssh-rsa AAAA0002']), 1)
+
+    Only fingerprints consisting of colon-separated hex digits are persisted, others are cached
+    in memory:
+
+    >>> import shutil
+    >>> path = tempfile.mkdtemp( )
+    >>> cache = SshPubkeyCache( path=path )
+    >>> cache.get( '00:03', fetch ), cache.get( 'Zm9v/+=', fetch ), cache.get( 'Zm9v/+=', fetch )
+    ('ssh-rsa AAAA0003', 'ssh-rsa AAAAZm9v/+=', 'ssh-rsa AAAAZm9v/+=')
+    >>> os.listdir( path ), fetches.count( 'Zm9v/+=' )
+    (['0003.pub'], 1)
+    >>> cache.discard( 'Zm9v/+=' )
+    >>> shutil.rmtree( path )
+    """
+
+    fingerprint_re = re.compile( r'^[0-9a-f]{2}(:[0-9a-f]{2})*$' )
+
+    def __init__( self, path ):
+        """
+        :param str|None path: the path to the directory to persist the cache in or None if the
+        cache should only be kept in memory
+        """
+        super( SshPubkeyCache, self ).__init__( )
+        self.path = path
+        self.lock = threading.Lock( )
+        self.locks = defaultdict( threading.Lock )
+        self.entries = { }
+        if path is not None:
+            mkdir_p( path )
+
+    def get( self, fingerprint, fetch ):
+        """
+        Return the public key for the given fingerprint, invoking the given function with the
+        fingerprint as the only argument if the cache doesn't have it.
+        """
+        with self.lock:
+            lock = self.locks[ fingerprint ]
+        with lock:
+            ssh_pubkey = self.entries.get( fingerprint )
+            if ssh_pubkey is None:
+                ssh_pubkey = self.__load( fingerprint )
+                if ssh_pubkey is None:
+                    ssh_pubkey = fetch( fingerprint )
+                    self.__save( fingerprint, ssh_pubkey )
+                self.entries[ fingerprint ] = ssh_pubkey
+            return ssh_pubkey
+
+    def discard( self, fingerprint ):
+        """
+        Remove the public key for the given fingerprint, e.g. because it turned out to be corrupt.
+        """
+        with self.lock:
+            lock = self.locks[ fingerprint ]
+        with lock:
+            self.entries.pop( fingerprint, None )
+            file_path = self.__file_path( fingerprint )
+            if file_path is not None:
+                try:
+                    os.unlink( file_path )
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+    def __file_path( self, fingerprint ):
+        if self.path is None:
+            return None
+        # The fingerprint comes from EC2 but it's used as a file name so better be careful. Other
+        # fingerprint formats, like the base64-encoded SHA-256 digests of ED25519 key pairs,
+        # are only cached in memory.
+        if not self.fingerprint_re.match( fingerprint ):
+            return None
+        return os.path.join( self.path, fingerprint.replace( ':', '' ) + '.pub' )
+
+    def __load( self, fingerprint ):
+        file_path = self.__file_path( fingerprint )
+        if file_path is not None:
+            try:
+                with open( file_path ) as f:
+                    return f.read( )
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return None
+
+    def __save( self, fingerprint, ssh_pubkey ):
+        file_path = self.__file_path( fingerprint )
+        if file_path is not None:
+            with tempfile.NamedTemporaryFile( prefix=os.path.basename( file_path ) + '.',
+                                              dir=self.path,
+                                              delete=False ) as tmp:
+                tmp.write( ssh_pubkey )
+            os.rename( tmp.name, file_path )
+
+
+@sync_memoize
+def ssh_pubkey_cache( ):
+    """
+    Returns the process-wide SshPubkeyCache instance, backed by a directory in the cache
+    directory.
+
+    :rtype: SshPubkeyCache
+    """
+    return SshPubkeyCache( os.path.join( cache_dir( ), 'ssh_pubkeys' ) )
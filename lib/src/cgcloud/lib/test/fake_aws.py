@@ -0,0 +1,477 @@
+import fnmatch
+import hashlib
+import itertools
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+from bd2k.util.expando import Expando
+from boto.ec2.blockdevicemapping import BlockDeviceType, BlockDeviceMapping
+from boto.ec2.image import Image
+from boto.ec2.instance import Instance, Reservation, InstanceState, InstancePlacement
+from boto.ec2.keypair import KeyPair
+from boto.ec2.securitygroup import SecurityGroup
+from boto.exception import EC2ResponseError, BotoServerError
+from boto.regioninfo import RegionInfo
+
+from cgcloud.lib.context import Context
+
+
+class FakeAWS( object ):
+    """
+    An in-memory stand-in for the parts of the EC2, IAM and S3 APIs that Context and Box use to
+    create, list and terminate boxes and clusters. Every API call takes a configurable amount of
+    time and is counted. Instances go through the pending, running, shutting-down and
+    terminated states in configurable amounts of time and, just like in EC2, newly created
+    instances are invisible to Describe* and CreateTags requests for a while.
+
+    >>> aws = FakeAWS( 'us-west-2', latency=0, boot_time=0, consistency_delay=0 )
+    >>> image_id = aws.add_image( 'foo_bar_2016-01-01' )
+    >>> ec2 = aws.ec2
+    >>> r = ec2.run_instances( image_id, min_count=2, max_count=2, instance_type='t2.micro',
+    ...                        key_name='foo', placement='us-west-2a' )
+    >>> ids = [ i.id for i in r.instances ]
+    >>> ec2.create_tags( ids, dict( Name='foo' ) )
+    True
+    >>> [ i.state for i in ec2.get_only_instances( filters={ 'tag:Name': 'foo' } ) ]
+    ['running', 'running']
+    >>> ec2.terminate_instances( ids[ :1 ] ) and None
+    >>> sorted( aws.calls.items( ) )
+    [('ec2:CreateTags', 1), ('ec2:DescribeInstances', 1), ('ec2:RunInstances', 1), \
+('ec2:TerminateInstances', 1)]
+    """
+
+    account = '123456789012'
+
+    def __init__( self, region, user_name='bench',
+                  latency=0.05, boot_time=2.0, termination_time=2.0, consistency_delay=1.0,
+                  clock=time.time ):
+        """
+        :param float latency: the time in seconds every API call takes
+
+        :param float boot_time: the time in seconds an instance spends in the pending state
+
+        :param float termination_time: the time in seconds an instance spends in the
+        shutting-down state
+
+        :param float consistency_delay: the time in seconds during which a newly created instance
+        can't be described or tagged
+        """
+        super( FakeAWS, self ).__init__( )
+        self.region = region
+        self.user_name = user_name
+        self.latency = latency
+        self.boot_time = boot_time
+        self.termination_time = termination_time
+        self.consistency_delay = consistency_delay
+        self.clock = clock
+        self.lock = threading.RLock( )
+        self.calls = Counter( )
+        self.ids = itertools.count( )
+        self.instances = { }
+        self.images = { }
+        self.security_groups = { }
+        self.key_pairs = { user_name: Expando( name=user_name, fingerprint='00' * 16 ) }
+        self.roles = { }
+        self.instance_profiles = { }
+        self.ec2 = FakeEC2( self )
+        self.iam = FakeIAM( self )
+        self.s3 = FakeS3( self )
+
+    def call( self, service, action ):
+        """
+        Account for an API call and simulate its latency.
+        """
+        with self.lock:
+            self.calls[ service + ':' + action ] += 1
+        if self.latency:
+            time.sleep( self.latency )
+
+    def new_id( self, prefix ):
+        return '%s-%08x' % (prefix, next( self.ids ))
+
+    def add_image( self, name, tags=None ):
+        """
+        Register an HVM image with the given name and tags and return its ID.
+        """
+        with self.lock:
+            image_id = self.new_id( 'ami' )
+            self.images[ image_id ] = Expando( id=image_id, name=name, tags=dict( tags or { } ) )
+        return image_id
+
+    def add_key_pairs( self, *names ):
+        """
+        Register a key pair for each of the given names, with a fingerprint derived from the name.
+        """
+        with self.lock:
+            for name in names:
+                fingerprint = ':'.join( '%02x' % ord( c ) for c in hashlib.md5( name ).digest( ) )
+                self.key_pairs[ name ] = Expando( name=name, fingerprint=fingerprint )
+
+    @contextmanager
+    def patch_context( self ):
+        """
+        Make every Context use this fake instead of connecting to AWS, for the duration of the
+        context manager.
+        """
+        fake = self
+        names = ('ec2', 'vpc', 'iam', 's3', 'sns', 'sqs')
+        originals = dict( (name, Context.__dict__[ name ]) for name in names )
+
+        def unsupported( ctx ):
+            raise NotImplementedError( 'The fake does not support this service' )
+
+        Context.ec2 = Context.vpc = property( lambda ctx: fake.ec2 )
+        Context.iam = property( lambda ctx: fake.iam )
+        Context.s3 = property( lambda ctx: fake.s3 )
+        Context.sns = Context.sqs = property( unsupported )
+        try:
+            yield self
+        finally:
+            for name, original in originals.iteritems( ):
+                setattr( Context, name, original )
+
+
+def _error( status, code, message ):
+    return EC2ResponseError( status, 'Error',
+                             body='<Response><Errors><Error><Code>%s</Code><Message>%s</Message>'
+                                  '</Error></Errors><RequestID>0</RequestID></Response>'
+                                  % (code, message) )
+
+
+class FakeEC2( object ):
+    def __init__( self, aws ):
+        super( FakeEC2, self ).__init__( )
+        self.aws = aws
+        self.region = RegionInfo( name=aws.region )
+
+    # Instances
+
+    def run_instances( self, image_id, min_count=1, max_count=1, key_name=None,
+                       security_group_ids=None, instance_type=None, placement=None, subnet_id=None,
+                       instance_profile_arn=None, block_device_map=None, **kwargs ):
+        self.aws.call( 'ec2', 'RunInstances' )
+        now = self.aws.clock( )
+        reservation = Reservation( self )
+        with self.aws.lock:
+            if image_id not in self.aws.images:
+                raise _error( 400, 'InvalidAMIID.NotFound', "The image id '[%s]' does not exist"
+                              % image_id )
+            for i in range( max_count ):
+                instance_id = self.aws.new_id( 'i' )
+                self.aws.instances[ instance_id ] = Expando(
+                    id=instance_id,
+                    image_id=image_id,
+                    instance_type=instance_type,
+                    key_name=key_name,
+                    placement=placement or self.aws.region + 'a',
+                    launch_time=now,
+                    terminate_time=None,
+                    private_ip_address='10.%i.%i.%i' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                    tags={ } )
+                reservation.instances.append( self.__instance( instance_id, now ) )
+        return reservation
+
+    def __state( self, record, now ):
+        if record.terminate_time is None:
+            return 'pending' if now < record.launch_time + self.aws.boot_time else 'running'
+        elif now < record.terminate_time + self.aws.termination_time:
+            return 'shutting-down'
+        else:
+            return 'terminated'
+
+    def __visible( self, record, now ):
+        return now >= record.launch_time + self.aws.consistency_delay
+
+    def __instance( self, instance_id, now ):
+        record = self.aws.instances[ instance_id ]
+        instance = Instance( self )
+        instance.id = instance_id
+        instance.image_id = record.image_id
+        instance.instance_type = record.instance_type
+        instance.key_name = record.key_name
+        instance.launch_time = datetime.utcfromtimestamp( record.launch_time ).isoformat( ) + 'Z'
+        instance.private_ip_address = record.private_ip_address
+        instance._placement = InstancePlacement( zone=record.placement )
+        state = self.__state( record, now )
+        instance._state = InstanceState( name=state )
+        if state == 'running':
+            instance.ip_address = '203.0.113.1'
+            instance.public_dns_name = 'ec2-203-0-113-1.compute.amazonaws.com'
+        instance.tags.update( record.tags )
+        return instance
+
+    def __find_instances( self, instance_ids, filters ):
+        now = self.aws.clock( )
+        with self.aws.lock:
+            if instance_ids is not None:
+                if isinstance( instance_ids, basestring ):
+                    instance_ids = [ instance_ids ]
+                missing = [ i for i in instance_ids
+                    if i not in self.aws.instances
+                    or not self.__visible( self.aws.instances[ i ], now ) ]
+                if missing:
+                    raise _error( 400, 'InvalidInstanceID.NotFound',
+                                  "The instance IDs '%s' do not exist" % ', '.join( missing ) )
+            else:
+                instance_ids = [ i for i, r in self.aws.instances.iteritems( )
+                    if self.__visible( r, now ) ]
+            instances = [ self.__instance( i, now ) for i in sorted( instance_ids ) ]
+        return [ i for i in instances if _matches( i, filters ) ]
+
+    def get_only_instances( self, instance_ids=None, filters=None, dry_run=False,
+                            max_results=None ):
+        self.aws.call( 'ec2', 'DescribeInstances' )
+        return self.__find_instances( instance_ids, filters )
+
+    def get_all_reservations( self, instance_ids=None, filters=None, dry_run=False,
+                              max_results=None ):
+        self.aws.call( 'ec2', 'DescribeInstances' )
+        instances = self.__find_instances( instance_ids, filters )
+        if instances:
+            reservation = Reservation( self )
+            reservation.instances = instances
+            return [ reservation ]
+        else:
+            return [ ]
+
+    get_all_instances = get_all_reservations
+
+    def terminate_instances( self, instance_ids=None, dry_run=False ):
+        self.aws.call( 'ec2', 'TerminateInstances' )
+        now = self.aws.clock( )
+        with self.aws.lock:
+            for instance_id in instance_ids:
+                record = self.aws.instances[ instance_id ]
+                if record.terminate_time is None:
+                    record.terminate_time = now
+            return [ self.__instance( i, now ) for i in instance_ids ]
+
+    # Tags
+
+    def create_tags( self, resource_ids, tags, dry_run=False ):
+        self.aws.call( 'ec2', 'CreateTags' )
+        now = self.aws.clock( )
+        with self.aws.lock:
+            missing = [ i for i in resource_ids
+                if i.startswith( 'i-' ) and not self.__visible( self.aws.instances[ i ], now ) ]
+            if missing:
+                raise _error( 400, 'InvalidInstanceID.NotFound',
+                              "The instance IDs '%s' do not exist" % ', '.join( missing ) )
+            for resource_id in resource_ids:
+                if resource_id.startswith( 'i-' ):
+                    self.aws.instances[ resource_id ].tags.update( tags )
+                elif resource_id.startswith( 'ami-' ):
+                    self.aws.images[ resource_id ].tags.update( tags )
+                else:
+                    raise NotImplementedError( resource_id )
+        return True
+
+    # Images
+
+    def __image( self, record ):
+        image = Image( self )
+        image.id = record.id
+        image.name = record.name
+        image.state = 'available'
+        image.virtualization_type = 'hvm'
+        image.root_device_name = '/dev/sda1'
+        image.block_device_mapping = BlockDeviceMapping( )
+        image.block_device_mapping[ '/dev/sda1' ] = BlockDeviceType( snapshot_id='snap-0',
+                                                                     size=8 )
+        image.tags.update( record.tags )
+        return image
+
+    def get_all_images( self, image_ids=None, owners=None, executable_by=None, filters=None,
+                        dry_run=False ):
+        self.aws.call( 'ec2', 'DescribeImages' )
+        with self.aws.lock:
+            images = [ self.__image( r ) for r in self.aws.images.itervalues( )
+                if image_ids is None or r.id in image_ids ]
+        return [ i for i in images if _matches( i, filters ) ]
+
+    def get_image( self, image_id, dry_run=False ):
+        images = self.get_all_images( image_ids=[ image_id ] )
+        return images[ 0 ] if images else None
+
+    # Security groups
+
+    def create_security_group( self, name, description, vpc_id=None, dry_run=False ):
+        self.aws.call( 'ec2', 'CreateSecurityGroup' )
+        with self.aws.lock:
+            if name in self.aws.security_groups:
+                raise _error( 400, 'InvalidGroup.Duplicate',
+                              "The security group '%s' already exists" % name )
+            record = Expando( id=self.aws.new_id( 'sg' ), name=name, vpc_id=vpc_id, rules=[ ] )
+            self.aws.security_groups[ name ] = record
+            return self.__security_group( record )
+
+    def __security_group( self, record ):
+        group = SecurityGroup( self, name=record.name, id=record.id )
+        group.vpc_id = record.vpc_id
+        return group
+
+    def get_all_security_groups( self, groupnames=None, group_ids=None, filters=None,
+                                 dry_run=False ):
+        self.aws.call( 'ec2', 'DescribeSecurityGroups' )
+        with self.aws.lock:
+            records = self.aws.security_groups.values( )
+        names = (filters or { }).get( 'group-name' )
+        return [ self.__security_group( r ) for r in records if names in (None, r.name) ]
+
+    def authorize_security_group( self, group_id=None, **rule ):
+        self.aws.call( 'ec2', 'AuthorizeSecurityGroupIngress' )
+        with self.aws.lock:
+            record = next( r for r in self.aws.security_groups.itervalues( ) if r.id == group_id )
+            if rule in record.rules:
+                raise _error( 400, 'InvalidPermission.Duplicate', 'The rule already exists' )
+            record.rules.append( rule )
+        return True
+
+    # Key pairs
+
+    def get_all_key_pairs( self, keynames=None, filters=None, dry_run=False ):
+        self.aws.call( 'ec2', 'DescribeKeyPairs' )
+        with self.aws.lock:
+            records = self.aws.key_pairs.values( )
+        key_pairs = [ ]
+        for record in records:
+            if keynames is None or record.name in keynames:
+                key_pair = KeyPair( self )
+                key_pair.name, key_pair.fingerprint = record.name, record.fingerprint
+                key_pairs.append( key_pair )
+        return [ k for k in key_pairs if _matches( k, filters ) ]
+
+    def get_key_pair( self, keyname, dry_run=False ):
+        key_pairs = self.get_all_key_pairs( keynames=[ keyname ] )
+        return key_pairs[ 0 ] if key_pairs else None
+
+    def close( self ):
+        pass
+
+
+def _matches( resource, filters ):
+    """
+    >>> i = Expando( id='i-1', tags={ 'Name': 'foo_bar' } )
+    >>> _matches( i, { 'tag:Name': 'foo_*' } ), _matches( i, { 'instance-id': [ 'i-2' ] } )
+    (True, False)
+    """
+    for name, values in (filters or { }).iteritems( ):
+        if isinstance( values, basestring ):
+            values = [ values ]
+        if name.startswith( 'tag:' ):
+            actual = resource.tags.get( name[ 4: ] )
+        elif name in ('instance-id', 'image-id'):
+            actual = resource.id
+        elif name in ('name', 'key-name'):
+            actual = resource.name
+        elif name == 'instance-state-name':
+            actual = resource.state
+        else:
+            raise NotImplementedError( "Filter '%s' is not supported by the fake" % name )
+        if actual is None or not any( fnmatch.fnmatchcase( actual, v ) for v in values ):
+            return False
+    return True
+
+
+def _iam_error( status, code, message ):
+    return BotoServerError( status, 'Error',
+                            body='<ErrorResponse><Error><Code>%s</Code><Message>%s</Message>'
+                                 '</Error></ErrorResponse>' % (code, message) )
+
+
+class FakeIAM( object ):
+    aws_access_key_id = 'AKIDEXAMPLE'
+
+    def __init__( self, aws ):
+        super( FakeIAM, self ).__init__( )
+        self.aws = aws
+
+    def get_user( self, user_name=None ):
+        self.aws.call( 'iam', 'GetUser' )
+        user_name = user_name or self.aws.user_name
+        return Expando( user_name=user_name,
+                        arn='arn:aws:iam::%s:user/%s' % (self.aws.account, user_name) )
+
+    def create_role( self, role_name, assume_role_policy_document=None, path=None ):
+        self.aws.call( 'iam', 'CreateRole' )
+        with self.aws.lock:
+            if role_name in self.aws.roles:
+                raise _iam_error( 409, 'EntityAlreadyExists', 'Role %s exists' % role_name )
+            self.aws.roles[ role_name ] = { }
+
+    def list_role_policies( self, role_name, marker=None, max_items=None ):
+        self.aws.call( 'iam', 'ListRolePolicies' )
+        with self.aws.lock:
+            return Expando( policy_names=list( self.aws.roles[ role_name ] ) )
+
+    def get_role_policy( self, role_name, policy_name ):
+        self.aws.call( 'iam', 'GetRolePolicy' )
+        with self.aws.lock:
+            try:
+                return Expando( policy_document=self.aws.roles[ role_name ][ policy_name ] )
+            except KeyError:
+                raise _iam_error( 404, 'NoSuchEntity', 'No policy %s' % policy_name )
+
+    def put_role_policy( self, role_name, policy_name, policy_document ):
+        self.aws.call( 'iam', 'PutRolePolicy' )
+        with self.aws.lock:
+            self.aws.roles[ role_name ][ policy_name ] = policy_document
+
+    def delete_role_policy( self, role_name, policy_name ):
+        self.aws.call( 'iam', 'DeleteRolePolicy' )
+        with self.aws.lock:
+            del self.aws.roles[ role_name ][ policy_name ]
+
+    def __profile( self, name ):
+        record = self.aws.instance_profiles[ name ]
+        roles = Expando( member=Expando( role_name=record.role ) ) if record.role else Expando( )
+        return Expando( arn='arn:aws:iam::%s:instance-profile/%s' % (self.aws.account, name),
+                        roles=roles )
+
+    def get_instance_profile( self, instance_profile_name ):
+        self.aws.call( 'iam', 'GetInstanceProfile' )
+        with self.aws.lock:
+            if instance_profile_name not in self.aws.instance_profiles:
+                raise _iam_error( 404, 'NoSuchEntity', 'No instance profile %s'
+                                  % instance_profile_name )
+            profile = self.__profile( instance_profile_name )
+        return Expando( get_instance_profile_response=Expando(
+            get_instance_profile_result=Expando( instance_profile=profile ) ) )
+
+    def create_instance_profile( self, instance_profile_name, path=None ):
+        self.aws.call( 'iam', 'CreateInstanceProfile' )
+        with self.aws.lock:
+            self.aws.instance_profiles[ instance_profile_name ] = Expando( role=None )
+            profile = self.__profile( instance_profile_name )
+        return Expando( create_instance_profile_response=Expando(
+            create_instance_profile_result=Expando( instance_profile=profile ) ) )
+
+    def add_role_to_instance_profile( self, instance_profile_name, role_name ):
+        self.aws.call( 'iam', 'AddRoleToInstanceProfile' )
+        with self.aws.lock:
+            self.aws.instance_profiles[ instance_profile_name ].role = role_name
+
+    def remove_role_from_instance_profile( self, instance_profile_name, role_name ):
+        self.aws.call( 'iam', 'RemoveRoleFromInstanceProfile' )
+        with self.aws.lock:
+            self.aws.instance_profiles[ instance_profile_name ].role = None
+
+    def close( self ):
+        pass
+
+
+class FakeS3( object ):
+    """
+    S3 is only used for storing SSH public keys, which the boxes used with this fake are
+    expected to manage themselves.
+    """
+
+    def __init__( self, aws ):
+        super( FakeS3, self ).__init__( )
+        self.aws = aws
+
+    def close( self ):
+        pass
@@ -0,0 +1,138 @@
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from unittest import TestCase
+from urlparse import parse_qs
+
+from boto.ec2.connection import EC2Connection
+from boto.regioninfo import RegionInfo
+
+from cgcloud.lib.governor import Governor, TokenBucket
+from cgcloud.lib.util import pmap
+
+
+class ThrottlingEC2( ThreadingMixIn, HTTPServer ):
+    """
+    A local stand-in for the EC2 API that answers DescribeRegions requests. Requests in excess
+    of a given rate are rejected the same way EC2 rejects them, with a RequestLimitExceeded error.
+    """
+    daemon_threads = True
+
+    def __init__( self, rate ):
+        HTTPServer.__init__( self, ('localhost', 0), ThrottlingEC2Handler )
+        self.bucket = TokenBucket( rate )
+        self.lock = threading.Lock( )
+        self.accepted = 0
+        self.throttled = 0
+
+    def admit( self ):
+        admitted = self.bucket.try_acquire( )
+        with self.lock:
+            if admitted:
+                self.accepted += 1
+            else:
+                self.throttled += 1
+        return admitted
+
+
+class ThrottlingEC2Handler( BaseHTTPRequestHandler ):
+    protocol_version = 'HTTP/1.1'
+
+    throttled_body = ('<?xml version="1.0" encoding="UTF-8"?>'
+                      '<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+                      '<Message>Request limit exceeded.</Message></Error></Errors>'
+                      '<RequestID>1</RequestID></Response>')
+
+    regions_body = ('<?xml version="1.0" encoding="UTF-8"?>'
+                    '<DescribeRegionsResponse xmlns="http://ec2.amazonaws.com/doc/2014-10-01/">'
+                    '<requestId>1</requestId><regionInfo><item><regionName>local</regionName>'
+                    '<regionEndpoint>localhost</regionEndpoint></item></regionInfo>'
+                    '</DescribeRegionsResponse>')
+
+    def do_POST( self ):
+        params = parse_qs( self.rfile.read( int( self.headers[ 'Content-Length' ] ) ) )
+        assert params[ 'Action' ] == [ 'DescribeRegions' ]
+        if self.server.admit( ):
+            self.respond( 200, self.regions_body )
+        else:
+            self.respond( 503, self.throttled_body )
+
+    def respond( self, status, body ):
+        self.send_response( status )
+        self.send_header( 'Content-Type', 'text/xml' )
+        self.send_header( 'Content-Length', str( len( body ) ) )
+        self.end_headers( )
+        self.wfile.write( body )
+
+    def log_message( self, *args ):
+        pass
+
+
+class GovernorTests( TestCase ):
+    """
+    Stress tests for the governor, using many threads against a local EC2 stand-in that
+    throttles requests.
+    """
+    server_rate = 100
+    num_threads = 32
+    num_requests = 240
+
+    def setUp( self ):
+        super( GovernorTests, self ).setUp( )
+        self.server = ThrottlingEC2( self.server_rate )
+        self.server_thread = threading.Thread( target=self.server.serve_forever )
+        self.server_thread.daemon = True
+        self.server_thread.start( )
+
+    def tearDown( self ):
+        self.server.shutdown( )
+        self.server.server_close( )
+        super( GovernorTests, self ).tearDown( )
+
+    def _connect( self ):
+        return EC2Connection( aws_access_key_id='AKIDEXAMPLE',
+                              aws_secret_access_key='secret',
+                              region=RegionInfo( name='local', endpoint='localhost' ),
+                              port=self.server.server_port,
+                              is_secure=False )
+
+    def _hammer( self, ec2, num_requests ):
+        def describe_regions( i ):
+            return [ r.name for r in ec2.get_all_regions( ) ]
+
+        start = time.time( )
+        results = pmap( describe_regions, range( num_requests ), pool_size=self.num_threads )
+        self.assertEqual( results, [ [ 'local' ] ] * num_requests )
+        self.assertEqual( self.server.accepted, num_requests )
+        return time.time( ) - start
+
+    def test_adapts_to_throttling( self ):
+        """
+        With a maximum rate well above what the server accepts, the governor should quickly
+        adapt such that only a small fraction of requests is throttled and all of them succeed
+        eventually, either on the first attempt or when boto retries them.
+        """
+        governor = Governor( max_rate=2 * self.server_rate )
+        ec2 = governor.install( self._connect( ), 'ec2' )
+        self._hammer( ec2, self.num_requests )
+        # The rate creeps back up after the throttling subsides, possibly above the server's rate,
+        # so it is only guaranteed to be well below the maximum.
+        self.assertLess( governor.bucket( 'ec2', 'DescribeRegions' ).rate,
+                         1.5 * self.server_rate )
+        # Only the initial burst of requests, one per thread, should be throttled
+        self.assertLess( self.server.throttled, self.num_requests / 4 )
+
+    def test_max_rate( self ):
+        """
+        With a maximum rate below what the server accepts, no request should be throttled and
+        the requests should be spread out over the expected amount of time.
+        """
+        max_rate = self.server_rate / 2
+        num_requests = self.num_requests / 2
+        governor = Governor( max_rate=max_rate )
+        ec2 = governor.install( self._connect( ), 'ec2' )
+        duration = self._hammer( ec2, num_requests )
+        self.assertEqual( self.server.throttled, 0 )
+        # The initial burst is free, the remaining requests are issued at the maximum rate
+        self.assertGreaterEqual( duration, (num_requests - max_rate) / float( max_rate ) )
@@ -16,6 +16,7 @@ from itertools import islice, count
 from math import sqrt
 from textwrap import dedent
 
+from bd2k.util.files import mkdir_p
 from bd2k.util.iterables import concat
 from bd2k.util.strings import interpolate
 
@@ -217,6 +218,18 @@ def abreviated_snake_case_class_name( cls, root_cls=object ):
     return camel_to_snake( name, separator='-' )
 
 
+def cache_dir( ):
+    """
+    Returns the path to the local directory in which cgcloud keeps data that should persist
+    between invocations, creating the directory if necessary. The value of the environment
+    variable CGCLOUD_CACHE_DIR, if that variable is present, overrides the default of
+    ~/.cache/cgcloud.
+    """
+    path = os.environ.get( 'CGCLOUD_CACHE_DIR' ) or os.path.expanduser( '~/.cache/cgcloud' )
+    mkdir_p( path )
+    return path
+
+
 class UserError( RuntimeError ):
     def __init__( self, message=None, cause=None ):
         if message is None == cause is None:
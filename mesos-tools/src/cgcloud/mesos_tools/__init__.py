@@ -226,7 +226,6 @@ class MesosTools( object ):
                                       name=volume_name,
                                       size=ebs_volume_size,
                                       volume_type="gp2" )
-            # TODO: handle case where volume is already attached
             device_ext = '/dev/sdf'
             device = '/dev/xvdf'
             volume.attach( self.instance_id, device_ext )
@@ -13,6 +13,7 @@ from cgcloud.core.common_iam_policies import ec2_read_only_policy
 from cgcloud.core.generic_boxes import GenericUbuntuTrustyBox
 from cgcloud.core.mesos_box import MesosBox as CoreMesosBox
 from cgcloud.core.ubuntu_box import Python27UpdateUbuntuBox
+from cgcloud.fabric.batch import remote_batch
 from cgcloud.fabric.operations import sudo, remote_open, pip, sudov
 from cgcloud.lib.util import abreviated_snake_case_class_name, heredoc
 
@@ -191,10 +192,11 @@ class MesosBoxSupport( GenericUbuntuTrustyBox, Python27UpdateUbuntuBox, CoreMeso
         """
         tools_dir = install_dir + '/tools'
         admin = self.admin_account( )
-        sudo( fmt( 'mkdir -p {tools_dir}' ) )
-        sudo( fmt( 'chown {admin}:{admin} {tools_dir}' ) )
-        run( fmt( 'virtualenv --no-pip {tools_dir}' ) )
-        run( fmt( '{tools_dir}/bin/easy_install pip==1.5.2' ) )
+        with remote_batch( ) as batch:
+            batch.sudo( fmt( 'mkdir -p {tools_dir}' ) )
+            batch.sudo( fmt( 'chown {admin}:{admin} {tools_dir}' ) )
+            batch.run( fmt( 'virtualenv --no-pip {tools_dir}' ) )
+            batch.run( fmt( '{tools_dir}/bin/easy_install pip==1.5.2' ) )
 
         with settings( forward_agent=True ):
             with self._project_artifacts( 'mesos-tools' ) as artifacts:
@@ -13,6 +13,7 @@ from cgcloud.core.cluster import ClusterBox, ClusterLeader, ClusterWorker
 from cgcloud.core.common_iam_policies import ec2_read_only_policy
 from cgcloud.core.generic_boxes import GenericUbuntuTrustyBox
 from cgcloud.core.ubuntu_box import Python27UpdateUbuntuBox
+from cgcloud.fabric.batch import remote_batch
 from cgcloud.fabric.operations import sudo, remote_open, pip, sudov
 from cgcloud.lib.util import abreviated_snake_case_class_name, heredoc
 
@@ -264,36 +265,42 @@ class SparkBox( ApacheSoftwareBox,
 
         spark_dir = var_dir + "/spark"
 
-        # Add environment variables to spark_env.sh
-        spark_env_sh_path = fmt( "{install_dir}/spark/conf/spark-env.sh" )
-        sudo( fmt( "cp {spark_env_sh_path}.template {spark_env_sh_path}" ) )
-        spark_env = dict(
-            SPARK_LOG_DIR=self._lazy_mkdir( log_dir, "spark" ),
-            SPARK_WORKER_DIR=self._lazy_mkdir( spark_dir, "work" ),
-            SPARK_LOCAL_DIRS=self._lazy_mkdir( spark_dir, "local" ),
-            JAVA_HOME='/usr/lib/jvm/java-8-oracle',
-            SPARK_MASTER_IP='spark-master',
-            HADOOP_CONF_DIR=fmt( "{install_dir}/hadoop/etc/hadoop" ),
-            SPARK_PUBLIC_DNS="$(curl -s http://169.254.169.254/latest/meta-data/public-hostname)" )
-        with remote_open( spark_env_sh_path, use_sudo=True ) as spark_env_sh:
+        with remote_batch( ) as batch:
+            # Add environment variables to spark_env.sh
+            spark_env_sh_path = fmt( "{install_dir}/spark/conf/spark-env.sh" )
+            batch.sudo( fmt( "cp {spark_env_sh_path}.template {spark_env_sh_path}" ) )
+            spark_env = dict(
+                SPARK_LOG_DIR=self._lazy_mkdir( log_dir, "spark", batch=batch ),
+                SPARK_WORKER_DIR=self._lazy_mkdir( spark_dir, "work", batch=batch ),
+                SPARK_LOCAL_DIRS=self._lazy_mkdir( spark_dir, "local", batch=batch ),
+                JAVA_HOME='/usr/lib/jvm/java-8-oracle',
+                SPARK_MASTER_IP='spark-master',
+                HADOOP_CONF_DIR=fmt( "{install_dir}/hadoop/etc/hadoop" ),
+                SPARK_PUBLIC_DNS="$(curl -s "
+                                 "http://169.254.169.254/latest/meta-data/public-hostname)" )
+            spark_env_sh = StringIO( )
             spark_env_sh.write( '\n' )
             for name, value in spark_env.iteritems( ):
                 spark_env_sh.write( fmt( 'export {name}="{value}"\n' ) )
-
-        # Configure Spark properties
-        spark_defaults = {
-            'spark.eventLog.enabled': 'true',
-            'spark.eventLog.dir': self._lazy_mkdir( spark_dir, "history" ),
-            'spark.master': 'spark://spark-master:7077'
-        }
-        spark_defaults_conf_path = fmt( "{install_dir}/spark/conf/spark-defaults.conf" )
-        sudo( fmt( "cp {spark_defaults_conf_path}.template {spark_defaults_conf_path}" ) )
-        with remote_open( spark_defaults_conf_path, use_sudo=True ) as spark_defaults_conf:
+            spark_env_sh.seek( 0 )
+            batch.put( spark_env_sh, spark_env_sh_path, use_sudo=True, append=True )
+
+            # Configure Spark properties
+            spark_defaults = {
+                'spark.eventLog.enabled': 'true',
+                'spark.eventLog.dir': self._lazy_mkdir( spark_dir, "history", batch=batch ),
+                'spark.master': 'spark://spark-master:7077'
+            }
+            spark_defaults_conf_path = fmt( "{install_dir}/spark/conf/spark-defaults.conf" )
+            batch.sudo( fmt( "cp {spark_defaults_conf_path}.template {spark_defaults_conf_path}" ) )
+            spark_defaults_conf = StringIO( )
             for name, value in spark_defaults.iteritems( ):
                 spark_defaults_conf.write( fmt( "{name}\t{value}\n" ) )
+            spark_defaults_conf.seek( 0 )
+            batch.put( spark_defaults_conf, spark_defaults_conf_path, use_sudo=True, append=True )
 
-        # Make shell auto completion easier
-        sudo( fmt( 'find {install_dir}/spark -name "*.cmd" | xargs rm' ) )
+            # Make shell auto completion easier
+            batch.sudo( fmt( 'find {install_dir}/spark -name "*.cmd" | xargs rm' ) )
 
         # Install upstart jobs
         self.__register_upstart_jobs( spark_services )
@@ -308,10 +315,11 @@ class SparkBox( ApacheSoftwareBox,
         """
         tools_dir = install_dir + '/tools'
         admin = self.admin_account( )
-        sudo( fmt( 'mkdir -p {tools_dir}' ) )
-        sudo( fmt( 'chown {admin}:{admin} {tools_dir}' ) )
-        run( fmt( 'virtualenv --no-pip {tools_dir}' ) )
-        run( fmt( '{tools_dir}/bin/easy_install pip==1.5.2' ) )
+        with remote_batch( ) as batch:
+            batch.sudo( fmt( 'mkdir -p {tools_dir}' ) )
+            batch.sudo( fmt( 'chown {admin}:{admin} {tools_dir}' ) )
+            batch.run( fmt( 'virtualenv --no-pip {tools_dir}' ) )
+            batch.run( fmt( '{tools_dir}/bin/easy_install pip==1.5.2' ) )
 
         with settings( forward_agent=True ):
             with self._project_artifacts( 'spark-tools' ) as artifacts:
@@ -371,7 +379,7 @@ class SparkBox( ApacheSoftwareBox,
         sudo( fmt( "chown root:root {script_path} && chmod 755 {script_path}" ) )
 
     @fabric_task
-    def _lazy_mkdir( self, parent, name, persistent=False ):
+    def _lazy_mkdir( self, parent, name, persistent=False, batch=None ):
         """
         __lazy_mkdir( '/foo', 'dir', True ) creates /foo/dir now and ensures that
         /mnt/persistent/foo/dir is created and bind-mounted into /foo/dir when the box starts.
@@ -384,6 +392,9 @@ class SparkBox( ApacheSoftwareBox,
         _lazy_mkdir( '/foo', 'dir', None ) will look up an instance tag named 'persist_foo_dir'
         when the box starts and then behave like _lazy_mkdir( '/foo', 'dir', True ) if that tag's
         value is 'True', or _lazy_mkdir( '/foo', 'dir', False ) if that tag's value is False.
+
+        :param cgcloud.fabric.batch.remote_batch batch: if given, the command creating the
+        directory is recorded in this batch instead of being run right away
         """
         assert self.lazy_dirs is not None
         assert '/' not in name
@@ -392,7 +403,7 @@ class SparkBox( ApacheSoftwareBox,
             assert location.startswith( '/' )
             assert not location.startswith( parent ) and not parent.startswith( location )
         logical_path = parent + '/' + name
-        sudo( 'mkdir -p "%s"' % logical_path )
+        (sudo if batch is None else batch.sudo)( 'mkdir -p "%s"' % logical_path )
         self.lazy_dirs.add( (parent, name, persistent) )
         return logical_path
 